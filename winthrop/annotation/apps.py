@@ -1,5 +1,32 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class AnnotationConfig(AppConfig):
     name = 'winthrop.annotation'
+
+    def ready(self):
+        from djiffy.models import Canvas
+        from winthrop.annotation.canvas_resolver import canvas_resolver
+        from winthrop.annotation.models import Annotation, CanvasAnnotationCount, Tag
+        from winthrop.annotation.vocabulary import vocabulary_registry
+        from winthrop.books.models import Language, PersonBook, Subject
+        from winthrop.people.models import Person
+        # keep precomputed annotation counts current
+        signals.post_save.connect(CanvasAnnotationCount.handle_save,
+                                  sender=Annotation,
+                                  dispatch_uid='canvas_annotation_count_save')
+        signals.post_delete.connect(CanvasAnnotationCount.handle_delete,
+                                    sender=Annotation,
+                                    dispatch_uid='canvas_annotation_count_delete')
+        # keep cached canvas ids by uri current
+        signals.post_save.connect(canvas_resolver.handle_save, sender=Canvas,
+                                  dispatch_uid='canvas_resolver_save')
+        signals.post_delete.connect(canvas_resolver.handle_delete, sender=Canvas,
+                                    dispatch_uid='canvas_resolver_delete')
+        # reload vocabularies for annotation data when they change
+        for model in [Tag, Language, Subject, Person, PersonBook]:
+            for signal in [signals.post_save, signals.post_delete]:
+                signal.connect(vocabulary_registry.handle_change, sender=model,
+                               dispatch_uid='annotation_vocabulary_%s_%s' %
+                               (model._meta.label_lower, id(signal)))
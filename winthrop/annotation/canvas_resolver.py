@@ -0,0 +1,145 @@
+'''
+In-process cache of canvas ids by URI, so that associating annotations
+with the canvas they belong to doesn't require a database lookup for
+every annotation that is saved.
+'''
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import cache
+
+from winthrop.common import request_cache
+
+
+class CanvasResolver(object):
+    '''Least-recently-used cache of :class:`djiffy.models.Canvas` ids
+    keyed on canvas URI, including URIs that don't match any canvas.
+    Entries are removed by canvas save and delete signals; changes are
+    also recorded with a version number in the django cache, so that
+    resolvers in other processes are cleared when they are out of date
+    (e.g. so that canvases added by an import are found).  The version
+    is read from the cache once per request (see
+    :mod:`~winthrop.common.request_cache`) or batch.
+
+    :param max_entries: maximum number of URIs to keep
+    '''
+
+    #: cache key for the current canvas version
+    version_cache_key = 'canvas_resolver_version'
+    #: number of URIs to look up in a single query
+    chunk_size = 500
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.RLock()
+        #: canvas ids keyed on URI, least recently used first; None for
+        #: URIs with no canvas
+        self.canvas_ids = OrderedDict()
+        #: version of the canvas data in the cache; None if not loaded
+        self.version = None
+
+    @classmethod
+    def current_version(cls):
+        '''Current version of canvas data, from the django cache'''
+        return request_cache.memoize(cls.version_cache_key, cls._load_version)
+
+    @classmethod
+    def _load_version(cls):
+        version = cache.get(cls.version_cache_key)
+        if version is None:
+            # start from the current time rather than zero, so that a
+            # version lost from the cache doesn't reuse old versions
+            cache.add(cls.version_cache_key, int(time.time() * 1000), None)
+            version = cache.get(cls.version_cache_key)
+        return version
+
+    @classmethod
+    def invalidate(cls):
+        '''Record a change to canvases, e.g. after a bulk update that
+        doesn't send signals; cached ids are cleared on next use.
+        Returns the new version.'''
+        try:
+            version = cache.incr(cls.version_cache_key)
+        except ValueError:
+            request_cache.forget(cls.version_cache_key)
+            return cls.current_version()
+        request_cache.remember(cls.version_cache_key, version)
+        return version
+
+    def _check_version(self):
+        version = self.current_version()
+        if version != self.version:
+            self.canvas_ids = OrderedDict()
+            self.version = version
+
+    def _add(self, uri, canvas_id):
+        self.canvas_ids[uri] = canvas_id
+        self.canvas_ids.move_to_end(uri)
+        while len(self.canvas_ids) > self.max_entries:
+            self.canvas_ids.popitem(last=False)
+
+    def resolve(self, uri):
+        '''Id of the canvas with the specified URI, or None if there is
+        no matching canvas'''
+        return self.resolve_many([uri]).get(uri)
+
+    def resolve_many(self, uris):
+        '''Look up canvas ids for a list of URIs, querying the database
+        in chunks for any that are not cached, and checking the version
+        once for the whole batch.  Returns a dictionary of canvas ids
+        keyed on URI, for URIs that match a canvas; URIs without a canvas
+        are remembered until canvases change.'''
+        from djiffy.models import Canvas
+        uris = set(uris)
+        resolved = {}
+        with self.lock:
+            self._check_version()
+            missing = []
+            for uri in uris:
+                if uri in self.canvas_ids:
+                    self.canvas_ids.move_to_end(uri)
+                    resolved[uri] = self.canvas_ids[uri]
+                else:
+                    missing.append(uri)
+
+            for i in range(0, len(missing), self.chunk_size):
+                chunk = missing[i:i + self.chunk_size]
+                found = dict(Canvas.objects.filter(uri__in=chunk)
+                                           .order_by('pk')
+                                           .values_list('uri', 'pk'))
+                for uri in chunk:
+                    resolved[uri] = found.get(uri)
+                    self._add(uri, found.get(uri))
+
+        return dict((uri, canvas_id) for uri, canvas_id in resolved.items()
+                    if canvas_id is not None)
+
+    def update(self, canvas_id):
+        '''Remove cached URIs for a changed or deleted canvas'''
+        with self.lock:
+            up_to_date = self.version is not None and \
+                self.version == self.current_version()
+            for uri in [uri for uri, pk in self.canvas_ids.items()
+                        if pk == canvas_id]:
+                del self.canvas_ids[uri]
+            version = self.invalidate()
+            # if canvases changed in another process in the meantime,
+            # clear everything on next use
+            self.version = version if up_to_date and \
+                version == self.version + 1 else None
+
+    # signal handlers
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.update(instance.pk)
+        # the URI may previously have been cached for another canvas
+        with self.lock:
+            self.canvas_ids.pop(instance.uri, None)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.update(instance.pk)
+
+
+#: shared canvas resolver for this process
+canvas_resolver = CanvasResolver()
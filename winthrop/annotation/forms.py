@@ -0,0 +1,49 @@
+from django import forms
+
+from winthrop.books.forms import FacetChoiceField
+
+
+class AnnotationSearchForm(forms.Form):
+    '''Search form for searching across
+    :class:`~winthrop.annotation.models.Annotation` content.'''
+
+    SORT_CHOICES = [
+        ('relevance', 'Relevance'),
+        ('book', 'Book'),
+    ]
+
+    query = forms.CharField(label='Keyword or Phrase', required=False)
+    sort = forms.ChoiceField(choices=SORT_CHOICES, required=False)
+    # limit to annotations in a single book, by slug
+    book = forms.SlugField(required=False)
+
+    # Solr facet choice fields
+    tag = FacetChoiceField()
+    language = FacetChoiceField()
+    anchor_language = FacetChoiceField()
+    subject = FacetChoiceField()
+    annotator = FacetChoiceField()
+
+    # map solr facet field to corresponding form input
+    solr_facet_fields = {
+        'tag_exact': 'tag',
+        'language_exact': 'language',
+        'anchor_language_exact': 'anchor_language',
+        'subject_exact': 'subject',
+        'annotator_exact': 'annotator',
+    }
+
+    # map form sort options to solr sort field
+    solr_sort_fields = {
+        'relevance': 'score desc',
+        'book': 'book_slug asc, canvas_label asc',
+    }
+
+    def get_solr_sort_field(self, sort):
+        '''Solr sort for a form sort option; relevance sort is only
+        meaningful with a keyword query, so book order is used instead
+        when there is no query.'''
+        sort = sort or 'relevance'
+        if sort == 'relevance' and not self.cleaned_data.get('query'):
+            sort = 'book'
+        return self.solr_sort_fields[sort]
@@ -0,0 +1,25 @@
+'''
+**rebuild_annotation_counts** is a custom manage command to recalculate
+the precomputed numbers of textual and graphical annotations on each
+canvas, used to display annotation indicators on the pages of a book.
+Counts are kept current as annotations are saved and deleted, so this
+is only needed after changes that bypass model signals (e.g. bulk
+updates or raw SQL), or to repair counts that are out of date.
+
+Example usage::
+
+    python manage.py rebuild_annotation_counts
+'''
+
+from django.core.management.base import BaseCommand
+
+from winthrop.annotation.models import CanvasAnnotationCount
+
+
+class Command(BaseCommand):
+    '''Recalculate annotation counts for all canvases'''
+    help = __doc__
+
+    def handle(self, *args, **kwargs):
+        total = CanvasAnnotationCount.rebuild()
+        self.stdout.write('Updated annotation counts for %d canvases' % total)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 11:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Count, Q, When
+import django.db.models.deletion
+
+
+def calculate_counts(apps, schema_editor):
+    Annotation = apps.get_model('annotation', 'Annotation')
+    CanvasAnnotationCount = apps.get_model('annotation', 'CanvasAnnotationCount')
+    counts = Annotation.objects.filter(canvas__isnull=False).order_by() \
+        .values('canvas', 'canvas__manifest') \
+        .annotate(graphical=Count(Case(When(text='', then=1))),
+                  textual=Count(Case(When(~Q(text=''), then=1))))
+    CanvasAnnotationCount.objects.bulk_create([
+        CanvasAnnotationCount(canvas_id=count['canvas'],
+                              manifest_id=count['canvas__manifest'],
+                              textual_annotation=count['textual'],
+                              graphical_annotation=count['graphical'])
+        for count in counts], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djiffy', '0003_extra_data_revisions'),
+        ('annotation', '0005_add_notes_annotator'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CanvasAnnotationCount',
+            fields=[
+                ('canvas', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='annotation_count', serialize=False, to='djiffy.Canvas')),
+                ('textual_annotation', models.IntegerField(default=0)),
+                ('graphical_annotation', models.IntegerField(default=0)),
+                ('manifest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='djiffy.Manifest')),
+            ],
+        ),
+        migrations.RunPython(calculate_counts, reverse_code=migrations.RunPython.noop),
+    ]
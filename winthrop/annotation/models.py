@@ -1,16 +1,29 @@
+import logging
+
 from annotator_store.models import BaseAnnotation
 from django.contrib.contenttypes.fields import GenericRelation
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Sum, When, \
+    prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.urls import reverse
-from djiffy.models import Canvas
+from djiffy.models import Canvas, Manifest
 
-from winthrop.books.models import Subject, Language
+from winthrop.annotation.canvas_resolver import canvas_resolver
+from winthrop.annotation.vocabulary import vocabulary_registry
+from winthrop.books.models import Book, Subject, Language
+from winthrop.common import request_cache
 from winthrop.common.models import Named, Notable
+from winthrop.common.solr import Indexable, IndexQueue
 from winthrop.footnotes.models import Footnote
 from winthrop.people.models import Person
 
 
+logger = logging.getLogger(__name__)
+
+
 # FIXME: is this actually used/needed anywhere?
 class AnnotationCount(models.Model):
     '''Mix-in for models related to annotations; adds annotation count property
@@ -37,7 +50,7 @@ class Tag(Named, Notable):
         verbose_name = 'Annotation Type'
 
 
-class Annotation(BaseAnnotation, Notable):
+class Annotation(BaseAnnotation, Notable, Indexable):
     # NOTE: do we want to associate explicitly with canvas in the db?
     # could just use uri, but faster lookup if we associate...
     canvas = models.ForeignKey(Canvas, null=True, blank=True)
@@ -58,22 +71,185 @@ class Annotation(BaseAnnotation, Notable):
 
     footnotes = GenericRelation(Footnote)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Annotation, cls).from_db(db, field_names, values)
+        # keep track of how the saved annotation is counted, so that
+        # annotation counts can be updated when it changes
+        if 'canvas_id' in field_names and 'text' in field_names:
+            instance._counted = instance.count_key()
+        return instance
+
+    def count_key(self):
+        '''Canvas id and :class:`CanvasAnnotationCount` field this
+        annotation is counted in, or None if it has no canvas.  Annotations
+        with text are counted as textual, others as graphical.'''
+        if self.canvas_id:
+            return (self.canvas_id, 'textual_annotation' if self.text
+                    else 'graphical_annotation')
+
+    #: annotation fields that relate to subjects, tags and languages,
+    #: by related model, used to find annotations to reindex
+    related_index_lookups = {
+        Subject: ['subjects'],
+        Tag: ['tags'],
+        Language: ['languages', 'anchor_languages'],
+    }
+
+    @classmethod
+    def mark_changed(cls, annotation_ids):
+        '''Update the modification time for the specified annotations,
+        e.g. when related data included in the index has changed, and
+        queue them for reindexing.'''
+        annotation_ids = list(annotation_ids)
+        if annotation_ids:
+            cls.objects.filter(pk__in=annotation_ids).update(updated=timezone.now())
+            IndexQueue.add_items(cls, annotation_ids)
+
+    @classmethod
+    def related_ids(cls, instance):
+        '''Ids of annotations associated with a subject, tag or language'''
+        query = Q()
+        for field in cls.related_index_lookups[type(instance)]:
+            query |= Q(**{field: instance})
+        return cls.objects.filter(query).values_list('pk', flat=True).distinct()
+
+    def handle_person_save(sender, instance, **kwargs):
+        '''signal handler for person save; reindex annotations by this
+        person if the authorized name has changed'''
+        if instance.authorized_name_changed:
+            annotation_ids = list(instance.annotation_set.values_list('pk', flat=True))
+            logger.debug('person save, queueing %d annotation(s) for reindexing',
+                         len(annotation_ids))
+            Annotation.mark_changed(annotation_ids)
+
+    def handle_named_save(sender, instance, **kwargs):
+        '''Signal handler for name changes to subjects, tags and
+        languages associated with annotations'''
+        if instance.name_changed:
+            annotation_ids = list(Annotation.related_ids(instance))
+            logger.debug(
+                '%s (%s) name changed, queueing %d annotation(s) for reindexing',
+                instance,
+                instance.__class__.__name__,
+                len(annotation_ids)
+            )
+            Annotation.mark_changed(annotation_ids)
+
+    def handle_related_delete(sender, instance, **kwargs):
+        '''Signal handler for deletion of subjects, tags and languages
+        associated with annotations'''
+        # find annotations before the relations are removed; they are
+        # reindexed when the queue is flushed, after the delete completes
+        annotation_ids = list(Annotation.related_ids(instance))
+        logger.debug('%s delete, queueing %d annotation(s) for reindexing',
+                     instance.__class__.__name__, len(annotation_ids))
+        Annotation.mark_changed(annotation_ids)
+
+    def handle_canvas_save(sender, instance, created=False, **kwargs):
+        '''Signal handler for canvas save; reindex annotations on the
+        canvas to update the canvas label'''
+        # a new canvas can't have annotations associated yet
+        if not created:
+            Annotation.mark_changed(instance.annotation_set.values_list('pk', flat=True))
+
+    @classmethod
+    def mark_manifests_changed(cls, manifest_ids):
+        '''Reindex annotations on the pages of the specified digital
+        editions'''
+        manifest_ids = set(manifest_ids) - set([None])
+        if manifest_ids:
+            cls.mark_changed(cls.objects.filter(
+                canvas__manifest__in=manifest_ids
+            ).values_list('pk', flat=True))
+
+    def handle_book_save(sender, instance, created=False, raw=False, **kwargs):
+        '''Signal handler for book save; reindex annotations on the pages
+        of the book's digital edition, and of the previous one if it has
+        changed, to update book id and slug'''
+        if raw:
+            return
+        if created or instance.field_changed('slug') or \
+          instance.field_changed('digital_edition_id'):
+            Annotation.mark_manifests_changed([
+                instance.digital_edition_id,
+                instance._initial['digital_edition_id']])
+
+    def handle_book_delete(sender, instance, **kwargs):
+        '''Signal handler for book delete; reindex annotations on the
+        pages of the book's digital edition to remove book id and slug'''
+        Annotation.mark_manifests_changed([instance.digital_edition_id])
+
+    #: index dependencies, to update when related items are changed
+    index_depends_on = {
+        'subjects': {
+            'post_save': handle_named_save,
+            'pre_delete': handle_related_delete,
+        },
+        'tags': {
+            'post_save': handle_named_save,
+            'pre_delete': handle_related_delete,
+        },
+        'languages': {
+            'post_save': handle_named_save,
+            'pre_delete': handle_related_delete,
+        },
+        'anchor_languages': {
+            'post_save': handle_named_save,
+            'pre_delete': handle_related_delete,
+        },
+        # annotator name; annotations are deleted with their author
+        'people.Person': {
+            'post_save': handle_person_save,
+        },
+        # canvas label
+        'djiffy.Canvas': {
+            'post_save': handle_canvas_save,
+        },
+        # book id and slug
+        'books.Book': {
+            'post_save': handle_book_save,
+            'pre_delete': handle_book_delete,
+        },
+    }
+
     def save(self, *args, **kwargs):
         # for image annotation, URI should be set to canvas URI; look up
         # canvas by URI and associate with the record
+        # (cleared if there is no match for the new uri)
+        self.set_canvas(canvas_resolver.resolve(self.uri) if self.uri else None)
+        super(Annotation, self).save(*args, **kwargs)
 
-        # if canvas is already set and uri matches annotation uri, do nothing
-        if self.canvas and self.uri == self.canvas.uri:
-            pass
-        else:
-            # otherwise, lookup canvas and associate
-            # (clear out in case there is no match for the new uri)
-            self.canvas = None
-            try:
-                self.canvas = Canvas.objects.get(uri=self.uri)
-            except Canvas.DoesNotExist:
-                pass
-        super(Annotation, self).save()
+        # set relations from extra data for a new annotation,
+        # now that it can be associated
+        pending = getattr(self, '_pending_relations', None)
+        if pending:
+            for field, values in pending.items():
+                getattr(self, field).set(values)
+            self._pending_relations = {}
+
+    def set_related_id(self, field, related_id):
+        '''Set a foreign key by id'''
+        field = self._meta.get_field(field)
+        if related_id != getattr(self, field.attname):
+            # clear any previously loaded related object
+            self.__dict__.pop(field.get_cache_name(), None)
+            setattr(self, field.attname, related_id)
+
+    def set_canvas(self, canvas_id):
+        '''Associate the annotation with a canvas by id'''
+        self.set_related_id('canvas', canvas_id)
+
+    @classmethod
+    def associate_canvases(cls, annotations):
+        '''Associate a list of annotations with canvases by URI, with a
+        fixed number of queries; for use with bulk imports, since
+        :meth:`save` is not called by `bulk_create`.'''
+        canvas_ids = canvas_resolver.resolve_many(
+            annotation.uri for annotation in annotations)
+        for annotation in annotations:
+            annotation.set_canvas(canvas_ids.get(annotation.uri))
+        return annotations
 
     def __str__(self):
         # base annotation only returns text, but that could be empty; use
@@ -83,57 +259,54 @@ class Annotation(BaseAnnotation, Notable):
                 ', '.join([tag.name for tag in self.tags.all()]),
                 ' ' if self.tags.count() else '')
 
+    # vocabulary versions are checked once per call, even outside a request
+    @request_cache.scope()
     def handle_extra_data(self, data, request):
         '''Handle any "extra" data that is not part of the stock annotation
         data model.  Use this method to customize the logic for updating
         an annotation from json request data (as sent by annotator.js).'''
 
 
-        # Catch any SQL Foreign Key issues by saving before processing the
-        # extra data using super()
-        super(Annotation, self).save()
+        # NOTE: annotations are saved once after the extra data is processed
+        # (see annotator_store create_from_request and update_from_request);
+        # relations for an annotation that has not yet been saved are set
+        # when it is saved
 
         # NOTE: Working on the presumption that any data not included in the
         # JSON Extra data should be removed if it's added to a Django database
         # field or model
+
+        # names are resolved to ids using the in-memory vocabulary
+        # registry, without database queries
         if 'author' in data:
             # TODO: Should authorized names always be distinguishable?
             # They're usually self-disambiguating. This allows for
             # author to almost 100% be treated like all other fields
-            author = Person.objects.filter(
-                authorized_name__iexact=data['author']
-            ).filter(
-                personbook__isnull=False
-            )
-            if author.exists():
-                self.author = author[0]
-            else:
-                self.author = None
+            # (unset if there is no match)
+            self.set_related_id('author', vocabulary_registry.lookup(
+                'annotators', data['author']))
             del data['author']
 
         if 'tags' in data:
             # NOTE: tag vocabulary is enforced; unrecognized tags
-            # are ignored.
-            # Add shim to ensure strings are stripped
-            data['tags'] = [tag.strip() for tag in data['tags']]
-            tags = Tag.objects.filter(name__in=data['tags'])
-            self.tags.set(tags)
+            # are ignored; tag names are stripped of whitespace
+            self.set_relation('tags', vocabulary_registry.lookup_many(
+                'tags', data['tags']))
             del data['tags']
 
         if 'languages' in data:
-            langs = Language.objects.filter(name__in=data['languages'])
-            self.languages.set(langs)
+            self.set_relation('languages', vocabulary_registry.lookup_many(
+                'languages', data['languages']))
             del data['languages']
 
         if 'anchor_languages' in data:
-            anchor_langs = Language.objects.filter(
-                name__in=data['anchor_languages'])
-            self.anchor_languages.set(anchor_langs)
+            self.set_relation('anchor_languages', vocabulary_registry.lookup_many(
+                'languages', data['anchor_languages']))
             del data['anchor_languages']
 
         if 'subjects' in data:
-            subjects = Subject.objects.filter(name__in=data['subjects'])
-            self.subjects.set(subjects)
+            self.set_relation('subjects', vocabulary_registry.lookup_many(
+                'subjects', data['subjects']))
             del data['subjects']
 
         if 'translation' in data:
@@ -159,12 +332,38 @@ class Annotation(BaseAnnotation, Notable):
 
         return data
 
-    def info(self):
+    def set_relation(self, field, values):
+        '''Set a many-to-many relation, or save it to be set when the
+        annotation is saved if it has not been saved yet'''
+        if self._state.adding:
+            if not hasattr(self, '_pending_relations'):
+                self._pending_relations = {}
+            self._pending_relations[field] = list(values)
+        else:
+            getattr(self, field).set(values)
+
+    #: placeholder id used to generate admin urls for a batch of annotations
+    admin_url_placeholder = '__id__'
+
+    @classmethod
+    def admin_url_template(cls):
+        '''Admin change url with a placeholder for the annotation id'''
+        return reverse('admin:annotation_annotation_change',
+                       args=[cls.admin_url_placeholder])
+
+    def info(self, admin_url_template=None):
         '''Passes fields that are included on the annotation model into the
-        JSON object representation of the annotation'''
+        JSON object representation of the annotation.  Takes an optional
+        admin url template (see :meth:`admin_url_template`), to avoid
+        generating the url for each annotation in a batch.'''
         # extend the default info implementation (used to generate json)
         # to include local database fields in the output
         info = super(Annotation, self).info()
+        if admin_url_template:
+            admin_url = admin_url_template.replace(self.admin_url_placeholder,
+                                                   str(self.id))
+        else:
+            admin_url = reverse('admin:annotation_annotation_change', args=[self.id])
         if self.author:
             info['author'] = self.author.authorized_name
         info.update({
@@ -172,7 +371,7 @@ class Annotation(BaseAnnotation, Notable):
             'languages': [language.name for language in self.languages.all()],
             'anchor_languages': [language.name for language in self.anchor_languages.all()],
             'subjects': [subject.name for subject in self.subjects.all()],
-            'admin_url': reverse('admin:annotation_annotation_change', args=[self.id]),
+            'admin_url': admin_url,
         })
         if self.text_translation:
             info['translation'] = self.text_translation
@@ -183,6 +382,88 @@ class Annotation(BaseAnnotation, Notable):
 
         return info
 
+    #: many-to-many relations included in :meth:`info`
+    info_relations = ['tags', 'languages', 'anchor_languages', 'subjects']
+
+    @classmethod
+    def info_many(cls, annotations):
+        '''Serialize a list or queryset of annotations, as with
+        :meth:`info`, with a fixed number of queries for related data.'''
+        if isinstance(annotations, models.QuerySet):
+            annotations = list(annotations.select_related('user', 'author')
+                                          .prefetch_related(*cls.info_relations))
+        else:
+            annotations = list(annotations)
+            prefetch_related_objects(annotations, 'user', 'author',
+                                     *cls.info_relations)
+        admin_url_template = cls.admin_url_template()
+        return [annotation.info(admin_url_template=admin_url_template)
+                for annotation in annotations]
+
+    def index_id(self):
+        '''identifier within solr'''
+        return 'annotation:{}'.format(self.pk)
+
+    @classmethod
+    def content_type(cls):
+        # content type as a string, for use in solr indexing
+        return str(cls._meta)
+
+    @classmethod
+    def prep_index_chunk(cls, chunk):
+        '''Bulk-load the related data used by :meth:`index_data` for a
+        list of annotations, so that indexing a chunk takes a fixed number
+        of queries regardless of the number of annotations in it.'''
+        prefetch_related_objects(chunk, 'author', 'canvas', 'tags',
+                                 'subjects', 'languages', 'anchor_languages')
+
+        # book id and slug for the digital edition of each annotated canvas
+        books = {}
+        manifest_ids = set(annotation.canvas.manifest_id for annotation in chunk
+                           if annotation.canvas)
+        if manifest_ids:
+            for manifest_id, book_id, slug in Book.objects \
+              .filter(digital_edition__in=manifest_ids).order_by('pk') \
+              .values_list('digital_edition', 'pk', 'slug'):
+                books.setdefault(manifest_id, (book_id, slug))
+
+        for annotation in chunk:
+            annotation._index_prefetch = {
+                'book': books.get(annotation.canvas.manifest_id)
+                        if annotation.canvas else None
+            }
+        return chunk
+
+    def index_book(self):
+        '''Id and slug of the book for the annotated canvas, if any'''
+        prefetched = getattr(self, '_index_prefetch', {})
+        if 'book' in prefetched:
+            return prefetched['book']
+        if self.canvas_id:
+            return Book.objects.filter(digital_edition__canvases=self.canvas_id) \
+                               .order_by('pk').values_list('pk', 'slug').first()
+
+    def index_data(self):
+        '''data for indexing in Solr'''
+        book_id, book_slug = self.index_book() or (None, None)
+        return {
+            'content_type': Annotation.content_type(),
+            'id': self.index_id(),
+            'annotation_text': self.text,
+            'quote': self.quote,
+            'text_translation': self.text_translation,
+            'anchor_translation': self.anchor_translation,
+            'tag': [tag.name for tag in self.tags.all()],
+            'language': [language.name for language in self.languages.all()],
+            'anchor_language': [language.name
+                                for language in self.anchor_languages.all()],
+            'subject': [subject.name for subject in self.subjects.all()],
+            'annotator': [str(self.author)] if self.author else [],
+            'canvas_label': self.canvas.label if self.canvas else None,
+            'book_id': book_id,
+            'book_slug': book_slug,
+        }
+
     img_info_to_iiif = {'w': 'width', 'h': 'height', 'x': 'x', 'y': 'y'}
 
     def iiif_image_selection(self):
@@ -209,3 +490,90 @@ class Annotation(BaseAnnotation, Notable):
             return u'<img src="%s" />' % self.canvas.image.mini_thumbnail()
     admin_thumbnail.short_description = 'Thumbnail'
     admin_thumbnail.allow_tags = True
+
+
+class CanvasAnnotationCount(models.Model):
+    '''Number of textual and graphical annotations on a canvas,
+    precomputed so that the pages of a book can be listed with annotation
+    indicators without aggregating annotations.  Counts are kept current
+    by annotation save and delete signals; use :meth:`rebuild` (or the
+    **rebuild_annotation_counts** manage command) to recalculate them,
+    e.g. after bulk changes that don't send signals.'''
+    canvas = models.OneToOneField(Canvas, primary_key=True,
+                                  related_name='annotation_count')
+    #: digital edition the canvas belongs to, for totals by book
+    manifest = models.ForeignKey(Manifest, related_name='+')
+    #: number of annotations with text
+    textual_annotation = models.IntegerField(default=0)
+    #: number of annotations without text (e.g. underlining or marks)
+    graphical_annotation = models.IntegerField(default=0)
+
+    def __str__(self):
+        return '%s: %d textual, %d graphical' % \
+            (self.canvas_id, self.textual_annotation, self.graphical_annotation)
+
+    @classmethod
+    def rebuild(cls, canvas_ids=None):
+        '''Recalculate annotation counts for all canvases, or for a list
+        of canvas ids, with a single aggregate query.  Returns the number
+        of canvases with annotations.'''
+        annotations = Annotation.objects.filter(canvas__isnull=False)
+        existing = cls.objects.all()
+        if canvas_ids is not None:
+            annotations = annotations.filter(canvas__in=canvas_ids)
+            existing = existing.filter(canvas__in=canvas_ids)
+
+        counts = annotations.order_by().values('canvas', 'canvas__manifest') \
+            .annotate(
+                graphical=Count(Case(When(text='', then=1))),
+                textual=Count(Case(When(~Q(text=''), then=1))))
+        rows = [cls(canvas_id=count['canvas'],
+                    manifest_id=count['canvas__manifest'],
+                    textual_annotation=count['textual'],
+                    graphical_annotation=count['graphical'])
+                for count in counts]
+        with transaction.atomic():
+            existing.delete()
+            cls.objects.bulk_create(rows, batch_size=500)
+        return len(rows)
+
+    @classmethod
+    def adjust(cls, count_key, delta):
+        '''Add `delta` to a count, as returned by
+        :meth:`Annotation.count_key`'''
+        canvas_id, field = count_key
+        updated = cls.objects.filter(canvas_id=canvas_id) \
+                             .update(**{field: F(field) + delta})
+        # first annotation on this canvas; calculate counts from scratch
+        if not updated and delta > 0:
+            cls.rebuild(canvas_ids=[canvas_id])
+
+    @classmethod
+    def totals(cls, manifest):
+        '''Total numbers of textual and graphical annotations for the
+        canvases in a digital edition, as a dictionary'''
+        return cls.objects.filter(manifest=manifest).aggregate(
+            textual_annotation=Coalesce(Sum('textual_annotation'), 0),
+            graphical_annotation=Coalesce(Sum('graphical_annotation'), 0))
+
+    # signal handlers
+
+    @classmethod
+    def handle_save(cls, sender, instance, **kwargs):
+        '''Update counts when an annotation is added, or moved to another
+        canvas or category'''
+        counted = getattr(instance, '_counted', None)
+        count_key = instance.count_key()
+        if count_key != counted:
+            if counted:
+                cls.adjust(counted, -1)
+            if count_key:
+                cls.adjust(count_key, 1)
+            instance._counted = count_key
+
+    @classmethod
+    def handle_delete(cls, sender, instance, **kwargs):
+        '''Update counts when an annotation is deleted'''
+        counted = getattr(instance, '_counted', instance.count_key())
+        if counted:
+            cls.adjust(counted, -1)
@@ -1,17 +1,28 @@
+from io import StringIO
 import json
 from unittest.mock import Mock, patch
 
 from django.contrib.auth import get_user_model
 from django.contrib.admin.sites import AdminSite
+from django.core.management import call_command
+from django.db.models import signals
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.urls import reverse, resolve
 
 from djiffy.models import Manifest, Canvas
+import pytest
+from SolrClient.exceptions import SolrError
 
-from .models import Annotation, Tag
+from .canvas_resolver import CanvasResolver
+from .models import Annotation, CanvasAnnotationCount, Tag
+from .vocabulary import VocabularyRegistry, vocabulary_registry
 from .admin import CanvasLinkWidget
 from winthrop.books.models import Book, Language, PersonBook, \
-    PersonBookRelationshipType
+    PersonBookRelationshipType, Subject
+from winthrop.books.views import BookPageView
+from winthrop.common import request_cache
+from winthrop.common.solr import IndexQueue
 from winthrop.people.models import Person
 from .admin import WinthropAnnotationAdmin
 
@@ -34,24 +45,39 @@ class TestAnnotation(TestCase):
         note = Annotation.objects.create(uri=canvas.uri)
         assert note.canvas == canvas
 
-        # how to check that canvas db lookup is skipped when not needed?
-        with patch('winthrop.annotation.models.Canvas') as mockcanvas:
-            mockcanvas.DoesNotExist = Canvas.DoesNotExist
+        # canvas ids are cached by uri; no canvas lookup needed
+        with self.assertNumQueries(1):
             note.save()
-            mockcanvas.objects.get.assert_not_called()
+        assert note.canvas == canvas
 
-            # if uri changes, canvas should be cleared
-            mockcanvas.objects.get.side_effect = Canvas.DoesNotExist
-            note.uri = 'http://some.thing/else'
-            note.save()
-            assert not note.canvas
-            mockcanvas.objects.get.assert_called_with(uri=note.uri)
+        # if uri changes, canvas should be cleared
+        note.uri = 'http://some.thing/else'
+        note.save()
+        assert not note.canvas
+        # canvas for a uri that wasn't previously matched
+        new_canvas = Canvas.objects.create(uri=note.uri, order=1,
+                                           short_id='b', manifest=manif)
+        note.save()
+        assert note.canvas == new_canvas
+        # canvas deleted
+        new_canvas.delete()
+        assert not Annotation.objects.create(uri=note.uri).canvas
+
+    def test_associate_canvases(self):
+        manif = Manifest.objects.create()
+        canvas = Canvas.objects.create(uri='http://so.me/iiif/id/',
+            order=0, manifest=manif)
+        notes = [Annotation(uri=canvas.uri), Annotation(uri='http://so.me/other')]
+        with self.assertNumQueries(1):
+            Annotation.associate_canvases(notes)
+        assert notes[0].canvas == canvas
+        assert notes[1].canvas is None
 
     def test_handle_extra_data(self):
 
         # Create a blank annotation object
-        # Don't save it because we want to check that handle_extra_data()
-        # calls the save before adding tags
+        # Don't save it because we want to check that tags are associated
+        # when the new annotation is saved
 
         annotation = Annotation()
         # test adding new tags
@@ -59,6 +85,9 @@ class TestAnnotation(TestCase):
         tags = ['manicule', 'underlining', 'dash', 'bogus']
         data = annotation.handle_extra_data({'tags': tags},
             Mock())   # NOTE: using Mock() for request - currently unused
+        # annotation is not saved by handle_extra_data
+        assert not Annotation.objects.filter(pk=annotation.pk).exists()
+        annotation.save()
         # existing tags should be associated with annotation
         assert annotation.tags.count() == 3
         saved_tags = [tag.name for tag in annotation.tags.all()]
@@ -199,6 +228,58 @@ class TestAnnotation(TestCase):
         data = annotation.handle_extra_data({'admin_url': 'example.com/edit_me'}, Mock())
         assert 'admin_url' not in data
 
+    def test_request_single_save(self):
+        saved = []
+
+        def record_save(sender, instance, **kwargs):
+            saved.append(instance.pk)
+
+        signals.post_save.connect(record_save, sender=Annotation)
+        try:
+            request = Mock()
+            request.user.is_anonymous.return_value = True
+            request.body = json.dumps({
+                'text': 'nota', 'uri': 'http://so.me/iiif/id/',
+                'tags': ['manicule', 'dash'], 'author': 'Bar, Foo'
+            }).encode()
+            annotation = Annotation.create_from_request(request)
+            # saved once, with tags and author associated
+            assert len(saved) == 1
+            assert annotation.tags.count() == 2
+            assert annotation.author == self.author
+
+            # updates also save once
+            request.body = json.dumps({
+                'text': 'nota bene', 'tags': ['dash']}).encode()
+            annotation.update_from_request(request)
+            assert len(saved) == 2
+            annotation = Annotation.objects.get(pk=annotation.pk)
+            assert annotation.text == 'nota bene'
+            assert [tag.name for tag in annotation.tags.all()] == ['dash']
+        finally:
+            signals.post_save.disconnect(record_save, sender=Annotation)
+
+    def test_info_many(self):
+        tags = Tag.objects.filter(name__in=['manicule', 'dash'])
+        languages = Language.objects.filter(name__in=['English', 'Latin'])
+        for i in range(3):
+            annotation = Annotation.objects.create(
+                text='note %d' % i, author=self.author, notes='notes',
+                text_translation='translation')
+            annotation.tags.set(tags)
+            annotation.languages.set(languages)
+            annotation.anchor_languages.set(languages)
+        Annotation.objects.create(text='no relations')
+
+        annotations = Annotation.objects.order_by('text')
+        expected = [annotation.info() for annotation in annotations]
+        # annotations with users and authors, and four relations
+        with self.assertNumQueries(5):
+            assert Annotation.info_many(annotations) == expected
+        # also works for a list
+        assert Annotation.info_many(list(annotations)) == expected
+        assert Annotation.info_many([]) == []
+
     def test_info(self):
         annotation = Annotation.objects.create()
         # tags should be an empty list when none are set
@@ -323,6 +404,193 @@ class TestAnnotation(TestCase):
         assert str(annotation) == annotation.text
 
 
+class TestCanvasResolver(TestCase):
+
+    def setUp(self):
+        self.manifest = Manifest.objects.create()
+        self.canvases = [
+            Canvas.objects.create(uri='http://so.me/iiif/canvas/%d' % i,
+                                  short_id=str(i), order=i,
+                                  manifest=self.manifest)
+            for i in range(3)]
+        self.resolver = CanvasResolver()
+
+    def test_resolve(self):
+        canvas = self.canvases[0]
+        assert self.resolver.resolve(canvas.uri) == canvas.pk
+        assert self.resolver.resolve('http://so.me/other') is None
+        # matches and misses are cached
+        with self.assertNumQueries(0):
+            assert self.resolver.resolve(canvas.uri) == canvas.pk
+            assert self.resolver.resolve('http://so.me/other') is None
+        # canvases added without signals or in another process are found
+        # once the change is recorded
+        Canvas.objects.bulk_create([
+            Canvas(uri='http://so.me/other', short_id='new', order=4,
+                   manifest=self.manifest)])
+        CanvasResolver.invalidate()
+        new_canvas = Canvas.objects.get(uri='http://so.me/other')
+        assert self.resolver.resolve('http://so.me/other') == new_canvas.pk
+
+    def test_resolve_many(self):
+        uris = [canvas.uri for canvas in self.canvases] + ['http://so.me/other']
+        self.resolver.chunk_size = 2
+        # looked up in chunks
+        with self.assertNumQueries(2):
+            canvas_ids = self.resolver.resolve_many(uris)
+        assert canvas_ids == dict((canvas.uri, canvas.pk)
+                                  for canvas in self.canvases)
+        # uris with and without a canvas are cached
+        with self.assertNumQueries(0):
+            assert self.resolver.resolve_many(uris) == canvas_ids
+
+    def test_max_entries(self):
+        self.resolver.max_entries = 2
+        for canvas in self.canvases:
+            self.resolver.resolve(canvas.uri)
+        # least recently used uri is removed
+        assert list(self.resolver.canvas_ids.keys()) == \
+            [canvas.uri for canvas in self.canvases[1:]]
+
+    def test_update(self):
+        canvas = self.canvases[0]
+        self.resolver.resolve(canvas.uri)
+        self.resolver.resolve(self.canvases[2].uri)
+        # canvas uri changed
+        self.resolver.handle_save(Canvas, canvas)
+        assert canvas.uri not in self.resolver.canvas_ids
+        # uri that was previously cached for another canvas
+        canvas.uri = self.canvases[2].uri
+        self.resolver.handle_save(Canvas, canvas)
+        assert self.canvases[2].uri not in self.resolver.canvas_ids
+
+        # changes in another process clear all cached ids
+        self.resolver.resolve(self.canvases[1].uri)
+        CanvasResolver.invalidate()
+        with self.assertNumQueries(1):
+            self.resolver.resolve(self.canvases[1].uri)
+
+    def test_current_version_request(self):
+        self.resolver.resolve(self.canvases[0].uri)
+        with patch('winthrop.annotation.canvas_resolver.cache') as mockcache:
+            mockcache.get.return_value = self.resolver.version
+            with request_cache.scope():
+                for canvas in self.canvases:
+                    self.resolver.resolve(canvas.uri)
+                # version read once per request
+                assert mockcache.get.call_count == 1
+                # changes made during the request are seen
+                mockcache.incr.return_value = 'next'
+                assert CanvasResolver.invalidate() == 'next'
+                assert CanvasResolver.current_version() == 'next'
+
+
+class TestVocabularyRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = VocabularyRegistry()
+        book = Book.objects.create(title='Long title', short_title='Long')
+        self.annotator = Person.objects.create(authorized_name='Bar, Foo')
+        PersonBook.objects.create(book=book, person=self.annotator,
+            relationship_type=PersonBookRelationshipType.objects.get(pk=1))
+        self.person = Person.objects.create(authorized_name='Baz, Foo')
+
+    def test_lookup(self):
+        dash = Tag.objects.get(name='dash')
+        assert self.registry.lookup('tags', 'dash') == dash.pk
+        # names are stripped
+        assert self.registry.lookup('tags', ' dash ') == dash.pk
+        assert self.registry.lookup('tags', 'bogus') is None
+        # loaded once
+        with self.assertNumQueries(0):
+            assert self.registry.lookup('tags', 'dash') == dash.pk
+
+        # annotators are matched ignoring case
+        assert self.registry.lookup('annotators', 'bar, foo') == self.annotator.pk
+        # people without a connection to a book are not annotators
+        assert self.registry.lookup('annotators', 'Baz, Foo') is None
+
+        with pytest.raises(ValueError):
+            self.registry.lookup('bogus', 'dash')
+
+    def test_lookup_added_elsewhere(self):
+        self.registry.lookup('tags', 'dash')
+        # added without invalidating the loaded vocabulary,
+        # e.g. by another process whose change hasn't been seen
+        Tag.objects.bulk_create([Tag(name='marginalia')])
+        PersonBook.objects.bulk_create([PersonBook(
+            book=Book.objects.first(), person=self.person,
+            relationship_type=PersonBookRelationshipType.objects.get(pk=1))])
+        expected = [Tag.objects.get(name='dash').pk,
+                    Tag.objects.get(name='marginalia').pk]
+        with self.assertNumQueries(1):
+            assert self.registry.lookup_many('tags', ['dash', 'marginalia']) == \
+                expected
+        # found names are kept
+        with self.assertNumQueries(0):
+            assert self.registry.lookup('tags', 'marginalia')
+        assert self.registry.lookup('annotators', 'baz, foo') == self.person.pk
+        # unknown names are checked once, until the vocabulary changes
+        with self.assertNumQueries(1):
+            assert self.registry.lookup('tags', 'bogus') is None
+        with self.assertNumQueries(0):
+            assert self.registry.lookup_many('tags', ['bogus', 'dash']) == \
+                expected[:1]
+        tag = Tag.objects.create(name='bogus')
+        assert self.registry.lookup('tags', 'bogus') == tag.pk
+
+    def test_current_version_request(self):
+        self.registry.lookup('tags', 'dash')
+        with patch('winthrop.annotation.vocabulary.cache') as mockcache:
+            mockcache.get.return_value = self.registry.versions['tags']
+            with request_cache.scope():
+                self.registry.lookup('tags', 'dash')
+                self.registry.lookup_many('tags', ['dash'])
+                # version read once per request
+                assert mockcache.get.call_count == 1
+                # changes made during the request are seen
+                mockcache.incr.return_value = 'next'
+                VocabularyRegistry.invalidate('tags')
+                assert VocabularyRegistry.current_version('tags') == 'next'
+
+    def test_lookup_many(self):
+        latin = Language.objects.get_or_create(name='Latin')[0]
+        english = Language.objects.get_or_create(name='English')[0]
+        assert self.registry.lookup_many(
+            'languages', ['Latin', 'Lojban', 'English']) == [latin.pk, english.pk]
+
+    def test_invalidate(self):
+        assert self.registry.lookup('tags', 'marginalia') is None
+        # changes to vocabulary models are picked up on next use
+        tag = Tag.objects.create(name='marginalia')
+        assert self.registry.lookup('tags', 'marginalia') == tag.pk
+        tag.delete()
+        assert self.registry.lookup('tags', 'marginalia') is None
+
+        # annotator eligibility depends on interactions with books
+        PersonBook.objects.create(book=Book.objects.first(), person=self.person,
+            relationship_type=PersonBookRelationshipType.objects.get(pk=1))
+        assert self.registry.lookup('annotators', 'Baz, Foo') == self.person.pk
+
+        # explicit invalidation, e.g. after bulk changes
+        self.registry.lookup('subjects', 'Alchemy')
+        with self.assertNumQueries(1):
+            VocabularyRegistry.invalidate('subjects')
+            self.registry.lookup('subjects', 'Alchemy')
+
+    def test_handle_extra_data_queries(self):
+        annotation = Annotation.objects.create()
+        data = {'author': 'Bar, Foo', 'tags': ['dash'], 'languages': [],
+                'anchor_languages': [], 'subjects': []}
+        annotation.handle_extra_data(dict(data), Mock())
+        # once vocabularies are loaded, only relations are queried:
+        # current ids for each of four relations, plus the tag swap
+        with self.assertNumQueries(7):
+            annotation.handle_extra_data(dict(data, tags=['manicule']), Mock())
+        assert annotation.author == self.annotator
+        assert [tag.name for tag in annotation.tags.all()] == ['manicule']
+
+
 class TestTag(TestCase):
 
     def setUp(self):
@@ -343,6 +611,249 @@ class TestTag(TestCase):
         assert test_annotation.tags.first() == tag
 
 
+class TestAnnotationIndexing(TestCase):
+    fixtures = ['sample_book_data.json']
+
+    def setUp(self):
+        self.canvas = Canvas.objects.get(pk=10465)
+        self.book = Book.objects.first()
+        self.book.digital_edition = self.canvas.manifest
+        self.book.save()
+        self.author = Person.objects.create(authorized_name='Winthrop, John')
+        self.latin = Language.objects.get_or_create(name='Latin')[0]
+        self.english = Language.objects.get_or_create(name='English')[0]
+        self.subject = Subject.objects.get_or_create(name='Alchemy')[0]
+        self.annotation = Annotation.objects.create(
+            uri=self.canvas.uri, text='Nota bene', quote='mercurius',
+            text_translation='Note well', author=self.author)
+        self.annotation.tags.set(Tag.objects.filter(name__in=['cipher', 'dash']))
+        self.annotation.languages.add(self.latin)
+        self.annotation.anchor_languages.add(self.english)
+        self.annotation.subjects.add(self.subject)
+        IndexQueue.clear()
+
+    def tearDown(self):
+        IndexQueue.clear()
+
+    def test_index_id(self):
+        assert self.annotation.index_id() == \
+            'annotation:{}'.format(self.annotation.pk)
+
+    def test_index_data(self):
+        index_data = self.annotation.index_data()
+        assert index_data['id'] == self.annotation.index_id()
+        assert index_data['content_type'] == Annotation.content_type()
+        assert index_data['annotation_text'] == 'Nota bene'
+        assert index_data['quote'] == 'mercurius'
+        assert index_data['text_translation'] == 'Note well'
+        assert index_data['anchor_translation'] == ''
+        assert sorted(index_data['tag']) == ['cipher', 'dash']
+        assert index_data['language'] == ['Latin']
+        assert index_data['anchor_language'] == ['English']
+        assert index_data['subject'] == ['Alchemy']
+        assert index_data['annotator'] == ['Winthrop, John']
+        assert index_data['canvas_label'] == self.canvas.label
+        assert index_data['book_id'] == self.book.pk
+        assert index_data['book_slug'] == self.book.slug
+
+        # no canvas or author
+        annotation = Annotation.objects.create(uri='http://some.thing/else')
+        index_data = annotation.index_data()
+        assert index_data['annotator'] == []
+        assert index_data['canvas_label'] is None
+        assert index_data['book_id'] is None
+        assert index_data['book_slug'] is None
+
+    def test_prep_index_chunk(self):
+        for i in range(3):
+            annotation = Annotation.objects.create(uri=self.canvas.uri,
+                                                   author=self.author)
+            annotation.tags.add(Tag.objects.get(name='cipher'))
+        annotations = list(Annotation.objects.all())
+        Annotation.prep_index_chunk(annotations)
+        # index data generated from bulk-loaded data only
+        with self.assertNumQueries(0):
+            docs = [annotation.index_data() for annotation in annotations]
+        assert all(doc['book_slug'] == self.book.slug for doc in docs)
+        assert all(doc['annotator'] == ['Winthrop, John'] for doc in docs)
+
+    def test_related_ids(self):
+        other = Annotation.objects.create(uri=self.canvas.uri)
+        other.languages.add(self.english)
+        # language matches either text or anchor text language
+        assert set(Annotation.related_ids(self.english)) == \
+            set([self.annotation.pk, other.pk])
+        assert list(Annotation.related_ids(self.latin)) == [self.annotation.pk]
+        assert list(Annotation.related_ids(self.subject)) == [self.annotation.pk]
+        assert list(Annotation.related_ids(Tag.objects.get(name='dash'))) == \
+            [self.annotation.pk]
+
+    def test_index_dependencies(self):
+        queued = (Annotation, self.annotation.pk)
+
+        # unchanged names don't require reindexing
+        Annotation.handle_named_save(Mock(), self.subject)
+        Annotation.handle_person_save(Mock(), self.author)
+        assert queued not in IndexQueue.pending()
+
+        tag = Tag.objects.get(name='cipher')
+        tag.name = 'ciphers'
+        Annotation.handle_named_save(Mock(), tag)
+        assert queued in IndexQueue.pending()
+
+        IndexQueue.clear()
+        self.author.authorized_name = 'Winthrop, John, 1606-1676'
+        Annotation.handle_person_save(Mock(), self.author)
+        assert queued in IndexQueue.pending()
+
+        IndexQueue.clear()
+        Annotation.handle_related_delete(Mock(), self.english)
+        assert queued in IndexQueue.pending()
+
+        # new canvases don't have annotations to reindex
+        IndexQueue.clear()
+        Annotation.handle_canvas_save(Mock(), self.canvas, created=True)
+        assert not IndexQueue.pending()
+        Annotation.handle_canvas_save(Mock(), self.canvas, created=False)
+        assert queued in IndexQueue.pending()
+
+        # book changes that don't affect the index
+        IndexQueue.clear()
+        Annotation.handle_book_save(Mock(), self.book)
+        assert not IndexQueue.pending()
+        self.book.title = 'New title'
+        Annotation.handle_book_save(Mock(), self.book)
+        assert not IndexQueue.pending()
+        # new slug
+        self.book.slug = 'new-slug'
+        Annotation.handle_book_save(Mock(), self.book)
+        assert queued in IndexQueue.pending()
+        self.book.save()
+
+        # digital edition changed; annotations on the old one are reindexed
+        IndexQueue.clear()
+        self.book.digital_edition = Manifest.objects.create(short_id='other')
+        Annotation.handle_book_save(Mock(), self.book)
+        assert queued in IndexQueue.pending()
+        self.book.save()
+
+        # book deleted
+        IndexQueue.clear()
+        self.book.digital_edition = self.canvas.manifest
+        Annotation.handle_book_delete(Mock(), self.book)
+        assert queued in IndexQueue.pending()
+
+    def test_mark_changed(self):
+        updated = self.annotation.updated
+        Annotation.mark_changed([self.annotation.pk])
+        assert (Annotation, self.annotation.pk) in IndexQueue.pending()
+        # modification time is updated for incremental indexing
+        assert Annotation.objects.get(pk=self.annotation.pk).updated > updated
+
+
+class TestCanvasAnnotationCount(TestCase):
+    fixtures = ['sample_book_data.json']
+
+    def setUp(self):
+        self.canvas = Canvas.objects.get(pk=10465)
+        self.other_canvas = Canvas.objects.create(
+            uri='http://so.me/iiif/canvas/2', order=1, label='f. 2',
+            manifest=self.canvas.manifest)
+
+    def counts(self, canvas):
+        count = CanvasAnnotationCount.objects.get(canvas=canvas)
+        return (count.textual_annotation, count.graphical_annotation)
+
+    def test_count_key(self):
+        annotation = Annotation(uri=self.canvas.uri)
+        assert annotation.count_key() is None
+        annotation.canvas = self.canvas
+        assert annotation.count_key() == (self.canvas.pk, 'graphical_annotation')
+        annotation.text = 'nota'
+        assert annotation.count_key() == (self.canvas.pk, 'textual_annotation')
+        # saved state is recorded when loaded from the database
+        annotation.save()
+        assert Annotation.objects.get(pk=annotation.pk)._counted == \
+            annotation.count_key()
+
+    def test_signals(self):
+        textual = Annotation.objects.create(uri=self.canvas.uri, text='nota')
+        Annotation.objects.create(uri=self.canvas.uri)
+        Annotation.objects.create(uri=self.canvas.uri)
+        assert self.counts(self.canvas) == (1, 2)
+        # saving without changes doesn't change counts
+        Annotation.objects.get(pk=textual.pk).save()
+        assert self.counts(self.canvas) == (1, 2)
+
+        # text removed: counted as graphical
+        textual = Annotation.objects.get(pk=textual.pk)
+        textual.text = ''
+        textual.save()
+        assert self.counts(self.canvas) == (0, 3)
+
+        # moved to another canvas
+        textual.uri = self.other_canvas.uri
+        textual.save()
+        assert self.counts(self.canvas) == (0, 2)
+        assert self.counts(self.other_canvas) == (0, 1)
+
+        Annotation.objects.get(pk=textual.pk).delete()
+        assert self.counts(self.other_canvas) == (0, 0)
+        # queryset delete also sends signals
+        Annotation.objects.filter(canvas=self.canvas).delete()
+        assert self.counts(self.canvas) == (0, 0)
+
+    def test_rebuild(self):
+        Annotation.objects.create(uri=self.canvas.uri, text='nota')
+        Annotation.objects.create(uri=self.other_canvas.uri)
+        # simulate changes that don't send signals
+        Annotation.objects.filter(canvas=self.canvas).update(text='')
+        CanvasAnnotationCount.objects.filter(canvas=self.other_canvas).delete()
+
+        assert CanvasAnnotationCount.rebuild(canvas_ids=[self.canvas.pk]) == 1
+        assert self.counts(self.canvas) == (0, 1)
+        assert not CanvasAnnotationCount.objects.filter(canvas=self.other_canvas) \
+                                                .exists()
+        assert CanvasAnnotationCount.rebuild() == 2
+        assert self.counts(self.other_canvas) == (0, 1)
+
+        # manage command rebuilds all counts
+        CanvasAnnotationCount.objects.all().delete()
+        stdout = StringIO()
+        call_command('rebuild_annotation_counts', stdout=stdout)
+        assert 'Updated annotation counts for 2 canvases' in stdout.getvalue()
+        assert self.counts(self.canvas) == (0, 1)
+
+    def test_totals(self):
+        manifest = self.canvas.manifest
+        assert CanvasAnnotationCount.totals(manifest) == \
+            {'textual_annotation': 0, 'graphical_annotation': 0}
+        Annotation.objects.create(uri=self.canvas.uri, text='nota')
+        Annotation.objects.create(uri=self.other_canvas.uri, text='bene')
+        Annotation.objects.create(uri=self.other_canvas.uri)
+        assert CanvasAnnotationCount.totals(manifest) == \
+            {'textual_annotation': 2, 'graphical_annotation': 1}
+
+    def test_book_page_counts(self):
+        book = Book.objects.first()
+        book.digital_edition = self.canvas.manifest
+        book.save()
+        Annotation.objects.create(uri=self.canvas.uri, text='nota')
+        Annotation.objects.create(uri=self.canvas.uri)
+        Annotation.objects.create(uri=self.canvas.uri)
+
+        view = BookPageView()
+        view.request = RequestFactory().get(reverse('books:pages', args=[book.slug]))
+        view.kwargs = {'slug': book.slug}
+        with self.assertNumQueries(1):
+            pages = dict((page['label'], page) for page in view.get_queryset())
+        assert pages[self.canvas.label]['textual_annotation'] == 1
+        assert pages[self.canvas.label]['graphical_annotation'] == 2
+        # canvases without annotations
+        assert pages[self.other_canvas.label]['textual_annotation'] == 0
+        assert pages[self.other_canvas.label]['graphical_annotation'] == 0
+
+
 class TestCanvasLinkWidget(TestCase):
     fixtures = ['sample_book_data.json']
 
@@ -384,6 +895,113 @@ class TestAnnotationViews(TestCase):
         data = json.loads(result.content.decode('utf-8'))
         assert data['results'][0]['text'] == 'cipher'
 
+    def test_api_create(self):
+        saved = []
+
+        def record_save(sender, instance, **kwargs):
+            saved.append(instance.pk)
+
+        self.client.login(username=self.admin.username, password=self.password)
+        signals.post_save.connect(record_save, sender=Annotation)
+        try:
+            data = {'text': 'nota', 'tags': ['dash']}
+            response = self.client.post(
+                reverse('annotation-api:annotations'), json.dumps(data),
+                content_type='application/json',
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            assert response.status_code == 303
+            # saved once when created with extra data
+            assert len(saved) == 1
+            annotation = Annotation.objects.get(pk=saved[0])
+            assert [tag.name for tag in annotation.tags.all()] == ['dash']
+
+            # saved once without extra data
+            response = self.client.post(
+                reverse('annotation-api:annotations'),
+                json.dumps({'text': 'plain'}), content_type='application/json',
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            assert response.status_code == 303
+            assert len(saved) == 2
+        finally:
+            signals.post_save.disconnect(record_save, sender=Annotation)
+
+        # ajax only
+        response = self.client.post(reverse('annotation-api:annotations'),
+                                    json.dumps(data),
+                                    content_type='application/json')
+        assert response.status_code == 400
+
+    def test_api_list_search(self):
+        for i in range(3):
+            annotation = Annotation.objects.create(
+                text='note %d' % i, quote='anchor', user=self.admin)
+            annotation.tags.set(Tag.objects.filter(name__in=['manicule', 'dash']))
+        self.client.login(username=self.admin.username, password=self.password)
+
+        expected = [annotation.info() for annotation in Annotation.objects.all()]
+        # session and user, annotations with users and authors, four relations
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('annotation-api:annotations'))
+        # same serialization as individual annotations
+        assert response.json() == json.loads(json.dumps(expected))
+
+        response = self.client.get(reverse('annotation-api:search'),
+                                   {'text': 'note', 'limit': 2})
+        data = response.json()
+        assert data['total'] == 2
+        assert len(data['rows']) == 2
+        assert all(row in json.loads(json.dumps(expected)) for row in data['rows'])
+        response = self.client.get(reverse('annotation-api:search'),
+                                   {'keyword': 'note 1'})
+        assert response.json()['rows'][0]['text'] == 'note 1'
+
+    @patch('winthrop.annotation.views.PagedSolrQuery')
+    def test_annotation_search(self, mockpsq):
+        search_url = reverse('annotation:search')
+        docs = [{'id': 'annotation:1', 'annotation_text': 'Nota bene'}]
+        facets = {'tag': {'cipher': 1}, 'language': {'Latin': 1}}
+        mockpsq.return_value.count.return_value = 1
+        mockpsq.return_value.__getitem__.return_value = docs
+        mockpsq.return_value.cached_facets.return_value = {
+            'total': 1, 'facets': facets, 'range_facets': {}}
+
+        response = self.client.get(search_url, {
+            'query': 'nota', 'tag': ['cipher', 'dash'], 'book': 'some-book'})
+        assert response.status_code == 200
+        data = response.json()
+        assert data['total'] == 1
+        assert data['results'] == docs
+        assert data['facets'] == facets
+        assert data['page'] == 1
+        assert data['num_pages'] == 1
+
+        solr_opts = mockpsq.call_args[0][0]
+        # keyword search uses the general text field
+        assert solr_opts['q'] == 'text:(nota)'
+        assert solr_opts['sort'] == 'score desc'
+        assert 'content_type:(%s)' % Annotation.content_type() in solr_opts['fq']
+        assert 'book_slug:"some-book"' in solr_opts['fq']
+        assert '{!tag=tag}tag_exact:("cipher" OR "dash")' in solr_opts['fq']
+        assert '{!ex=tag key=tag}tag_exact' in solr_opts['facet.field']
+
+        # no keyword search: sort by book instead of relevance
+        self.client.get(search_url)
+        solr_opts = mockpsq.call_args[0][0]
+        assert solr_opts['q'] == '*:*'
+        assert solr_opts['sort'] == 'book_slug asc, canvas_label asc'
+
+        # invalid form
+        response = self.client.get(search_url, {'sort': 'bogus'})
+        assert response.status_code == 400
+
+        # solr errors
+        mockpsq.return_value.cached_facets.side_effect = SolrError('Cannot parse')
+        response = self.client.get(search_url, {'query': '"nota'})
+        assert response.status_code == 400
+        mockpsq.return_value.cached_facets.side_effect = SolrError
+        response = self.client.get(search_url, {'query': 'nota'})
+        assert response.status_code == 500
+
     def test_canvas_detail(self):
         # canvas detail logic is tested in djiffy,
         # but test local customization to catch any
@@ -1,10 +1,11 @@
 from django.conf.urls import url
 from django.contrib.admin.views.decorators import staff_member_required
 
-from winthrop.annotation.views import TagAutocomplete
+from winthrop.annotation.views import AnnotationSearchView, TagAutocomplete
 
 
 urlpatterns = [
+    url(r'^search/$', AnnotationSearchView.as_view(), name='search'),
     url(r'^autocomplete/tag/$',
         staff_member_required(TagAutocomplete.as_view()), name='tag-autocomplete'),
 ]
@@ -1,8 +1,213 @@
-from .models import Tag
+from annotator_store import views as annotator_views
+from annotator_store.utils import permission_required
 from dal import autocomplete
+from django.contrib.admin.models import LogEntry, ADDITION
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.http import JsonResponse, HttpResponseBadRequest
+from django.utils.decorators import method_decorator
+from django.views.generic import ListView
+from eulcommon.djangoextras.http.responses import HttpResponseSeeOtherRedirect
+from SolrClient.exceptions import SolrError
+
+from winthrop.annotation.forms import AnnotationSearchForm
+from winthrop.annotation.models import Annotation, Tag
+from winthrop.common.solr import PagedSolrQuery, SolrPaginator, \
+    index_generation, index_settled
+from winthrop.common.views import CachedResponseMixin
 
 
 class TagAutocomplete(autocomplete.Select2QuerySetView):
     '''Basic autocomplete view for Tags'''
     def get_queryset(self):
         return Tag.objects.filter(name__icontains=self.q)
+
+
+class AnnotationList(annotator_views.Annotations):
+    '''Annotator store API annotations view; lists annotations with
+    :meth:`~winthrop.annotation.models.Annotation.info_many` to avoid
+    queries for each annotation, and saves new annotations once.'''
+
+    def get(self, request):
+        'List viewable annotations as JSON.'
+        notes = Annotation.objects.visible_to(request.user)
+        return JsonResponse(Annotation.info_many(notes), safe=False)
+
+    @method_decorator(permission_required('annotator_store.add_annotation'))
+    def post(self, request):
+        'Create a new annotation via AJAX.'
+        # creation logic adapted from annotator_store
+        if not request.is_ajax():
+            return HttpResponseBadRequest(annotator_views.non_ajax_error_msg)
+
+        note = Annotation.create_from_request(request)
+        # annotations with extra data are already saved when created
+        if note._state.adding:
+            note.save()
+
+        # create log entry for creation of the annotation
+        LogEntry.objects.log_action(
+            user_id=request.user.id,
+            content_type_id=ContentType.objects.get_for_model(note).pk,
+            object_id=note.pk,
+            object_repr=str(note),
+            change_message='Created via annotator API',
+            action_flag=ADDITION)
+
+        # annotator store API returns 303 with the new annotation url
+        return HttpResponseSeeOtherRedirect(note.get_absolute_url())
+
+
+class AnnotationSearch(annotator_views.AnnotationSearch):
+    '''Annotator store API search view; returns results with
+    :meth:`~winthrop.annotation.models.Annotation.info_many` to avoid
+    queries for each annotation.  Supports the same search fields and
+    limit and offset parameters as
+    :class:`annotator_store.views.AnnotationSearch`.'''
+
+    def get(self, request):
+        # search logic adapted from annotator_store
+        notes = Annotation.objects.visible_to(request.user)
+
+        for field in request.GET.keys():
+            search_val = request.GET[field]
+            if field == 'text':
+                notes = notes.filter(text__icontains=search_val)
+            elif field == 'quote':
+                notes = notes.filter(quote__icontains=search_val)
+            elif field == 'user':
+                notes = notes.filter(user__username=search_val)
+            elif field in Annotation.common_fields:
+                notes = notes.filter(**{field: search_val})
+            # special case: "keyword" search on multiple fields
+            elif field == 'keyword':
+                notes = notes.filter(
+                    Q(text__icontains=search_val) |
+                    Q(quote__icontains=search_val) |
+                    Q(extra_data__icontains=search_val)
+                )
+
+        # minimal pagination: limit/offset
+        limit = request.GET.get('limit', None)
+        offset = request.GET.get('offset', None)
+        # slice queryset by offset first, so limit will be relative to that
+        try:
+            if offset is not None:
+                notes = notes[int(offset):]
+            if limit is not None:
+                notes = notes[:int(limit)]
+        except ValueError:
+            # if non-numeric values are passed, just ignore them
+            pass
+
+        return JsonResponse({
+            'total': notes.count(),
+            'rows': Annotation.info_many(notes)
+        })
+
+
+class AnnotationSearchView(CachedResponseMixin, ListView):
+    '''Search annotation text, quotes and translations, with facets for
+    tags, languages, subjects and annotators, using the annotations
+    indexed in Solr.  Returns a page of results with counts and facets
+    as JSON.'''
+    model = Annotation
+    paginate_by = 50
+    paginator_class = SolrPaginator
+    form_class = AnnotationSearchForm
+    form = None
+    error_code = None
+
+    #: stored solr fields returned for each result
+    result_fields = ['id', 'annotation_text', 'quote', 'text_translation',
+                     'anchor_translation', 'tag', 'language',
+                     'anchor_language', 'subject', 'annotator',
+                     'canvas_label', 'book_id', 'book_slug']
+
+    def cache_version(self):
+        '''Cache search results until the index changes, but not while
+        recent changes may not yet be visible in Solr'''
+        if index_settled():
+            return index_generation()
+
+    def solr_query_opts(self):
+        '''Solr query options for the current request, based on the
+        search form.  Returns None if the form is not valid.'''
+        self.form = self.form_class(self.request.GET)
+        if not self.form.is_valid():
+            return None
+        search_opts = self.form.cleaned_data
+
+        solr_q = '*:*'
+        if search_opts.get('query'):
+            # searches annotation text fields and related names, with
+            # the same spelling normalization as book search
+            solr_q = 'text:(%s)' % search_opts['query']
+
+        filter_qs = ['content_type:(%s)' % Annotation.content_type()]
+        if search_opts.get('book'):
+            filter_qs.append('book_slug:"%s"' % search_opts['book'])
+
+        # tag facet filters with the form field, so they can be excluded
+        # when generating facets (as for book search)
+        for solr_field, form_field in self.form.solr_facet_fields.items():
+            field_values = search_opts.get(form_field, None)
+            if field_values:
+                filter_qs.append('{!tag=%s}%s:(%s)' % \
+                    (form_field, solr_field,
+                     ' OR '.join('"%s"' % val for val in field_values)))
+
+        facet_fields = ['{!ex=%s key=%s}%s' % (form_field, form_field, solr_field)
+                        for solr_field, form_field in self.form.solr_facet_fields.items()]
+
+        return {
+            'q': solr_q,
+            'sort': self.form.get_solr_sort_field(search_opts.get('sort')),
+            'fl': ','.join(self.result_fields),
+            'fq': filter_qs,
+            'facet': 'true',
+            'facet.field': facet_fields,
+            'facet.limit': -1,
+            'facet.sort': 'index',
+        }
+
+    def get_queryset(self, **kwargs):
+        solr_opts = self.solr_query_opts()
+        if solr_opts is None:
+            # if the form is not valid, return an empty queryset
+            # (queryset needed for django paginator)
+            return Annotation.objects.none()
+        return PagedSolrQuery(solr_opts)
+
+    def get_context_data(self, **kwargs):
+        if self.form.errors:
+            self.error_code = 400
+            return {'error': 'Search form is not valid'}
+        try:
+            context = super().get_context_data(**kwargs)
+            # facets for the same search are cached until the index changes
+            data = self.object_list.cached_facets()
+        except SolrError as err:
+            error_msg = 'Something went wrong.'
+            self.error_code = 500
+            if 'Cannot parse' in str(err):
+                error_msg = ('Unable to parse search query; '
+                             'please revise and try again.')
+                self.error_code = 400
+            return {'error': error_msg}
+
+        page = context['page_obj']
+        return {
+            'total': data['total'],
+            'page': page.number,
+            'num_pages': page.paginator.num_pages,
+            'results': list(page.object_list),
+            'facets': data['facets'],
+        }
+
+    def render_to_response(self, context, **response_kwargs):
+        response = JsonResponse(context, **response_kwargs)
+        # if something went wrong, set an error code on the response before returning
+        if 'error' in context and self.error_code:
+            response.status_code = self.error_code
+        return response
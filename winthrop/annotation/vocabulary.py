@@ -0,0 +1,183 @@
+'''
+In-process registry of the controlled vocabularies used when saving
+annotations (tags, languages, subjects and annotators), so that names
+sent by annotator.js can be resolved to database ids without queries.
+'''
+from functools import reduce
+import operator
+import threading
+import time
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from winthrop.common import request_cache
+
+
+class VocabularyRegistry(object):
+    '''Ids of :class:`~winthrop.annotation.models.Tag`,
+    :class:`~winthrop.books.models.Language`,
+    :class:`~winthrop.books.models.Subject` and annotator
+    :class:`~winthrop.people.models.Person` records, keyed on name and
+    held in memory.  Each vocabulary is loaded on first use and reloaded
+    after save and delete signals for the related models; changes are
+    also recorded with a version number in the django cache, so that a
+    vocabulary loaded in another process is reloaded when it is out of
+    date; this requires a cache shared between processes (see
+    :func:`winthrop.common.checks.cache_is_shared`).  Versions are read
+    from the cache once per request (see
+    :mod:`~winthrop.common.request_cache`).  Names that are not in the
+    loaded vocabulary are looked up in the database before they are
+    treated as unknown; names that are not found are remembered until
+    the vocabulary changes.'''
+
+    #: vocabulary names
+    vocabularies = ('tags', 'languages', 'subjects', 'annotators')
+    #: prefix for cache keys for the current version of each vocabulary
+    version_cache_prefix = 'annotation_vocabulary_version'
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        #: ids keyed on normalized name, by vocabulary
+        self.ids = {}
+        #: version of the data loaded for each vocabulary
+        self.versions = {}
+        #: normalized names not found in the database, by vocabulary
+        self.unknown = {}
+
+    @classmethod
+    def version_cache_key(cls, vocabulary):
+        return '%s:%s' % (cls.version_cache_prefix, vocabulary)
+
+    @classmethod
+    def current_version(cls, vocabulary):
+        '''Current version of a vocabulary, from the django cache'''
+        key = cls.version_cache_key(vocabulary)
+
+        def load_version():
+            version = cache.get(key)
+            if version is None:
+                # start from the current time rather than zero, so that a
+                # version lost from the cache doesn't reuse old versions
+                cache.add(key, int(time.time() * 1000), None)
+                version = cache.get(key)
+            return version
+
+        return request_cache.memoize(key, load_version)
+
+    @classmethod
+    def invalidate(cls, *vocabularies):
+        '''Record a change to the specified vocabularies (by default,
+        all of them), e.g. after a bulk update that doesn't send signals;
+        they are reloaded on next use.'''
+        for vocabulary in vocabularies or cls.vocabularies:
+            key = cls.version_cache_key(vocabulary)
+            try:
+                request_cache.remember(key, cache.incr(key))
+            except ValueError:
+                request_cache.forget(key)
+                cls.current_version(vocabulary)
+
+    @staticmethod
+    def normalize(vocabulary, name):
+        '''Normalize a name for lookup; annotator names are matched
+        without regard to case, other names exactly (ignoring leading
+        and trailing whitespace)'''
+        name = name.strip()
+        if vocabulary == 'annotators':
+            return name.lower()
+        return name
+
+    def names(self, vocabulary):
+        '''Database values for names and ids in a vocabulary'''
+        from winthrop.annotation.models import Tag
+        from winthrop.books.models import Language, Subject
+        from winthrop.people.models import Person
+
+        if vocabulary == 'tags':
+            return Tag.objects.values_list('name', 'pk')
+        if vocabulary == 'languages':
+            return Language.objects.values_list('name', 'pk')
+        if vocabulary == 'subjects':
+            return Subject.objects.values_list('name', 'pk')
+        if vocabulary == 'annotators':
+            # only people with a connection to a book can be annotators
+            return Person.objects.filter(personbook__isnull=False) \
+                                 .distinct().values_list('authorized_name', 'pk')
+        raise ValueError('Unknown vocabulary: %s' % vocabulary)
+
+    def names_matching(self, vocabulary, names):
+        '''Database values for names and ids in a vocabulary that match
+        a list of normalized names'''
+        values = self.names(vocabulary)
+        if vocabulary == 'annotators':
+            return values.filter(reduce(operator.or_, (
+                Q(authorized_name__iexact=name) for name in names)))
+        return values.filter(name__in=names)
+
+    def load(self, vocabulary):
+        '''Load names and ids for a vocabulary'''
+        with self.lock:
+            # get the version first, so that changes made while loading
+            # cause another reload
+            version = self.current_version(vocabulary)
+            ids = {}
+            # in case of duplicate names, use the first one created
+            for name, pk in self.names(vocabulary).order_by('pk'):
+                ids.setdefault(self.normalize(vocabulary, name), pk)
+            self.ids[vocabulary] = ids
+            self.unknown[vocabulary] = set()
+            self.versions[vocabulary] = version
+
+    def _get(self, vocabulary, names):
+        if self.versions.get(vocabulary) != self.current_version(vocabulary):
+            self.load(vocabulary)
+        ids = self.ids[vocabulary]
+        unknown = self.unknown[vocabulary]
+        missing = set(names) - set(ids) - unknown
+        if missing:
+            # names may have been added since the vocabulary was loaded,
+            # without this process seeing the change; check the database
+            # rather than dropping them
+            for name, pk in self.names_matching(vocabulary, missing).order_by('pk'):
+                ids.setdefault(self.normalize(vocabulary, name), pk)
+            # don't look for the same names again until the next change
+            unknown.update(missing - set(ids))
+        return ids
+
+    def lookup(self, vocabulary, name):
+        '''Id for a name in a vocabulary, or None if it is not found'''
+        name = self.normalize(vocabulary, name)
+        with self.lock:
+            return self._get(vocabulary, [name]).get(name)
+
+    def lookup_many(self, vocabulary, names):
+        '''List of ids for names in a vocabulary; names that are not
+        found are ignored'''
+        names = [self.normalize(vocabulary, name) for name in names]
+        with self.lock:
+            ids = self._get(vocabulary, names)
+            found = (ids.get(name) for name in names)
+            return [pk for pk in found if pk is not None]
+
+    # signal handlers
+
+    def handle_change(self, sender, **kwargs):
+        '''Invalidate the vocabularies that depend on the changed model'''
+        from winthrop.annotation.models import Tag
+        from winthrop.books.models import Language, PersonBook, Subject
+        from winthrop.people.models import Person
+
+        vocabularies = {
+            Tag: 'tags',
+            Language: 'languages',
+            Subject: 'subjects',
+            Person: 'annotators',
+            PersonBook: 'annotators',
+        }
+        if sender in vocabularies:
+            self.invalidate(vocabularies[sender])
+
+
+#: shared vocabulary registry for this process
+vocabulary_registry = VocabularyRegistry()
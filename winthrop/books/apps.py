@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class BooksConfig(AppConfig):
     name = 'winthrop.books'
     verbose_name = 'Bibliography'
+
+    def ready(self):
+        from winthrop.books.models import Book
+        # keep cached publication year statistics current
+        signals.post_save.connect(Book.handle_pub_year_save, sender=Book,
+                                  dispatch_uid='book_pub_year_stats_save')
+        signals.post_delete.connect(Book.handle_pub_year_delete, sender=Book,
+                                    dispatch_uid='book_pub_year_stats_delete')
@@ -1,9 +1,7 @@
 from django import forms
 from django.utils.safestring import mark_safe
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
-from django.db.models import Max, Min
 
 from winthrop.books.models import Book
 
@@ -210,31 +208,22 @@ class SearchForm(forms.Form):
         'author_desc': 'author_sort desc',
     }
 
-    PUBDATE_CACHE_KEY = 'book_pubdate_maxmin'
+    #: publication year statistics, loaded once per form instance
+    _pub_year_stats = None
 
     def pub_date_minmax(self):
         '''Get minimum and maximum values for
         :class:`~winthrop.books.models.Book` publication dates
         in the database.  Used to set placeholder values for the form
         input and to generate the Solr facet range query.
-        Value is cached to avoid repeatedly calculating it.
+        Uses :meth:`Book.pub_year_stats`, which are maintained in the cache
+        and read once per request, and only looks them up once for each
+        form.
         :returns: tuple of min, max
         '''
-        maxmin = cache.get(self.PUBDATE_CACHE_KEY)
-        if not maxmin:
-            maxmin = Book.objects \
-                .aggregate(Max('pub_year'), Min('pub_year'))
-
-            # cache as returned from django; looks like this:
-            # {'pub_date__max': 1922, 'pub_date__min': 1559}
-
-            # don't cache if values are None
-            # should only happen if no data is in the db
-            if all(maxmin.values()):
-                cache.set(self.PUBDATE_CACHE_KEY, maxmin)
-
-        # return just the min and max values
-        return maxmin['pub_year__min'], maxmin['pub_year__max']
+        if self._pub_year_stats is None:
+            self._pub_year_stats = Book.pub_year_stats()
+        return self._pub_year_stats['min'], self._pub_year_stats['max']
 
     def get_solr_sort_field(self, sort):
         '''
@@ -0,0 +1,49 @@
+'''
+**detect_sammelbands** is a custom manage command to flag catalogue
+entries for books that are bound together (sammelbands), based on
+shared call numbers, and list them for review.  Call numbers that only
+differ by volume letters (e.g. Win 60a, Win 60b) are considered to
+belong to the same volume.
+
+Example usage::
+
+    # flag sammelbands and list them
+    python manage.py detect_sammelbands
+    # list sammelbands without updating the database
+    python manage.py detect_sammelbands --dry-run
+'''
+
+from django.core.management.base import BaseCommand
+
+from winthrop.books.models import Catalogue
+
+
+class Command(BaseCommand):
+    '''Flag catalogue entries for books that are bound together'''
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='List sammelbands without updating the database'
+        )
+
+    def handle(self, *args, **kwargs):
+        self.stdout.write('Now checking for bound volumes:')
+        sammelbands = Catalogue.detect_sammelbands(dry_run=kwargs['dry_run'])
+
+        call_numbers = set(Catalogue.sammelband_key(catalogue.call_number)
+                           for catalogue in sammelbands)
+        self.stdout.write('    Number of call numbers that seem to have '
+                          'multiple bound titles: %s' % len(call_numbers))
+        if kwargs['dry_run']:
+            self.stdout.write('The following titles would be marked as sammelband:')
+        else:
+            self.stdout.write('The following titles are marked as sammelband:')
+        for i, catalogue in enumerate(sammelbands, 1):
+            self.stdout.write('    %s. Short Title: %s - NYSL Call Number: %s'
+                              % (i, catalogue.book.short_title,
+                                 catalogue.call_number))
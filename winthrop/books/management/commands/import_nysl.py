@@ -9,20 +9,35 @@ produces an output list.
 
 The expect behavior is designed for a once-off import and will produce
 duplicate book entries (but not duplicates of any entries created
-as part of book creation).
+as part of book creation).  Rows for books that would have the same
+slug as an existing book are reported as errors.
+
+Books are created in batches (use ``--batch-size`` to adjust), each in a
+single transaction, and indexed in Solr once all rows are imported.
 
 All persons created attempt to have a VIAF uri associated and all places
-have a Geonames ID assigned if possible.
+have a Geonames ID assigned if possible.  VIAF and GeoNames lookups for
+all the people and places in the spreadsheet are made before any records
+are created, in parallel (use ``--viaf-workers`` and ``--geonames-workers``
+to adjust the number of concurrent requests), and results are cached on
+disk (see **LOOKUP_CACHE_PATH**), so that running the import again
+doesn't repeat them.
 '''
 
 from collections import defaultdict
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import csv
 import re
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
 from winthrop.books.models import Book, Publisher, OwningInstitution, \
-    Catalogue
+    Catalogue, Creator, CreatorType
+from winthrop.common.lookup_cache import LookupCache
+from winthrop.common.solr import Indexable, IndexQueue
+from winthrop.people.autocomplete import PersonNameIndex
 from winthrop.people.models import Person
 from winthrop.people.viaf import ViafAPI
 from winthrop.places.models import Place
@@ -64,6 +79,11 @@ class Command(BaseCommand):
         'Editor': 'Editor',
     }
 
+    #: default number of concurrent VIAF lookups
+    viaf_workers = 8
+    #: default number of books to create at once
+    batch_size = 100
+
     # currently unused
     other_fields = [
         'Number of Pages',
@@ -86,6 +106,24 @@ class Command(BaseCommand):
             default=False,
             help='Just make sammelband connections'
         )
+        parser.add_argument(
+            '--viaf-workers',
+            type=int,
+            default=self.viaf_workers,
+            help='Number of concurrent VIAF lookups (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--geonames-workers',
+            type=int,
+            default=GeoNamesAPI.max_workers,
+            help='Number of concurrent GeoNames lookups (default: %(default)s)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=self.batch_size,
+            help='Number of books to create at once (default: %(default)s)'
+        )
 
     def handle(self, *args, **kwargs):
         input_file = kwargs['input_file']
@@ -99,19 +137,19 @@ class Command(BaseCommand):
 
         self.stats = defaultdict(int)
         if not kwargs['just_sammel']:
-            with open(input_file) as csvfile:
-                csvreader = csv.DictReader(csvfile)
-                # each row in the CSV corresponds to a book record
-                for row in csvreader:
-                    try:
-                        self.create_book(row)
-                    except Exception as err:
-                        print('Error on import for %s: %s' %
-                            (row['Short Title'][:30], err))
-                        self.stats['err'] += 1
-
-                # summarize what content was imported/created
-                self.stdout.write('''Imported content:
+            # look up and create all new people before creating books,
+            # so that VIAF requests don't hold up the import
+            self.create_people(self.read_rows(input_file),
+                               kwargs.get('viaf_workers') or self.viaf_workers)
+            self.resolve_places(self.read_rows(input_file),
+                                kwargs.get('geonames_workers'))
+
+            # each row in the CSV corresponds to a book record
+            self.import_books(self.read_rows(input_file),
+                              kwargs.get('batch_size'))
+
+            # summarize what content was imported/created
+            self.stdout.write('''Imported content:
     %(book)d books
     %(place)d places
     %(person)d people
@@ -122,6 +160,11 @@ class Command(BaseCommand):
         # Now look for is_sammelband and set the flag
         self.build_sammelband()
 
+    def read_rows(self, input_file):
+        '''Generator for the rows in the CSV file, as dicts'''
+        with open(input_file) as csvfile:
+            yield from csv.DictReader(csvfile)
+
     def viaf_lookup(self, name):
         viaf = ViafAPI()
         viafid = None
@@ -134,12 +177,104 @@ class Command(BaseCommand):
                     viafid = viaf.uri_from_id(results[0]['viafid'])
         return viafid
 
+    def viaf_years(self, viaf_id):
+        '''Birth and death years for a person from VIAF, as a list'''
+        person = Person(viaf_id=viaf_id)
+        person.set_birth_death_years()
+        return [person.birth, person.death]
+
+    def creator_name(self, name):
+        '''Clean up a creator name from the spreadsheet; returns None
+        for empty or placeholder names.'''
+        # Get rid of any last stray periods, if they exist
+        name = name.strip('?. []')
+        # Get various versions of 'Not sure' and remove name if they exist
+        if re.search(r'[Vv]arious|[A|a]nonymous|[N|n]one [G|g]iven', name):
+            return None
+        # Use four characters as a dumb filter to toss stray 'np'/'sn'
+        if len(name) <= 4:
+            return None
+        return name
+
+    def _lookup_all(self, lookup, keys, cache, workers):
+        '''Run a lookup method for each key not already in the lookup
+        cache, with a bounded number of concurrent requests; returns
+        a dict of results for all keys.  Failed lookups are reported
+        and not cached, so they will be tried again on the next run.'''
+        results = cache.get_many(keys)
+        todo = [key for key in keys if key not in results]
+
+        def safe_lookup(key):
+            try:
+                return True, lookup(key)
+            except Exception as err:
+                return False, err
+
+        found = {}
+        if todo:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for key, (success, result) in \
+                  zip(todo, executor.map(safe_lookup, todo)):
+                    if success:
+                        found[key] = result
+                    else:
+                        self.stderr.write('VIAF lookup failed for %s: %s' %
+                                          (key, result))
+                        self.stats['viaf_err'] += 1
+            cache.set_many(found)
+        results.update(found)
+        return results
+
+    def resolve_people(self, names, workers=None):
+        '''Look up VIAF ids and birth and death years for a list of
+        names; returns a dict of :class:`~winthrop.people.models.Person`
+        field values keyed on name.'''
+        workers = workers or self.viaf_workers
+        with LookupCache('viaf_suggest') as suggest_cache, \
+          LookupCache('viaf_years') as years_cache:
+            viaf_ids = self._lookup_all(self.viaf_lookup, names,
+                                        suggest_cache, workers)
+            uris = sorted(set(uri for uri in viaf_ids.values() if uri))
+            years = self._lookup_all(self.viaf_years, uris, years_cache,
+                                     workers)
+
+        people = {}
+        for name in names:
+            viaf_id = viaf_ids.get(name)
+            birth, death = years.get(viaf_id) or (None, None)
+            people[name] = {'viaf_id': viaf_id, 'birth': birth,
+                            'death': death}
+        return people
+
+    def create_people(self, rows, workers=None):
+        '''Create all people named as creators in the spreadsheet rows
+        who are not already in the database, with VIAF information.'''
+        names = []
+        for row in rows:
+            for csv_field in self.creators.values():
+                name = self.creator_name(row[csv_field])
+                if name and name not in names:
+                    names.append(name)
+        existing = set(Person.objects.filter(authorized_name__in=names)
+                       .values_list('authorized_name', flat=True))
+        names = [name for name in names if name not in existing]
+        if not names:
+            return
+
+        people = self.resolve_people(names, workers)
+        # VIAF information is already set, so no need for Person.save
+        Person.objects.bulk_create([
+            Person(authorized_name=name, **people[name]) for name in names])
+        # bulk create doesn't send signals to update autocomplete
+        PersonNameIndex.invalidate()
+        self.stats['person'] += len(names)
+
     def geonames_lookup(self, place_name):
         '''Function to wrap a GeoNames lookup and assign info.
         Returns a dict for Place generator or None'''
-        geo = GeoNamesAPI()
-        # Get the top hit and presume the API guessed correctly
-        result = geo.search(place_name, max_rows=1)
+        with GeoNamesAPI() as geo:
+            # Get the top hit and presume the API guessed correctly
+            result = geo.search(place_name, max_rows=1)
         place_dict = {}
         if result:
             place_dict['latitude'] = float(result[0]['lat'])
@@ -149,9 +284,78 @@ class Command(BaseCommand):
         else:
             return None
 
-    def create_book(self, data):
-        # create a new book and all related models from
-        # a row of data in the spreadsheet
+    def place_name(self, name):
+        '''Clean up a place name from the spreadsheet; returns None
+        for empty or placeholder names.'''
+        name = name.strip(' ?[]()')
+        if name and len((re.sub(r'[.,]', '', name))) < 3:
+            return None
+        return name or None
+
+    def resolve_places(self, rows, workers=None):
+        '''Search GeoNames for all places in the spreadsheet rows that
+        are not already in the database, so that results are cached
+        for :meth:`geonames_lookup`.'''
+        names = set(filter(None, (self.place_name(row[self.fields['pub_place']])
+                                  for row in rows)))
+        names -= set(Place.objects.filter(name__in=names)
+                     .values_list('name', flat=True))
+        if names:
+            with GeoNamesAPI() as geo:
+                geo.resolve_many(names, max_rows=1, max_workers=workers)
+
+    def load_lookups(self):
+        '''Load existing places, publishers, people, creator types and
+        book slugs, so that rows can be imported without looking up
+        each related record.'''
+        self.place_ids = dict(Place.objects.values_list('name', 'pk'))
+        self.publisher_ids = dict(Publisher.objects.values_list('name', 'pk'))
+        self.person_ids = dict(Person.objects.values_list('authorized_name', 'pk'))
+        self.creator_type_ids = dict(CreatorType.objects.values_list('name', 'pk'))
+        self.slugs = set(Book.objects.values_list('slug', flat=True))
+
+    def get_place(self, placename):
+        '''Id for the named place, creating it if necessary'''
+        if placename not in self.place_ids:
+            place_dict = self.geonames_lookup(placename)
+            if place_dict:
+                place = Place.objects.create(name=placename, **place_dict)
+            else:
+                place = Place.objects.create(
+                    name=placename,
+                    latitude=0.0,
+                    longitude=0.0,
+                )
+            self.place_ids[placename] = place.pk
+            self.stats['place'] += 1
+        return self.place_ids[placename]
+
+    def get_publisher(self, publisher_name):
+        '''Id for the named publisher, creating it if necessary'''
+        if publisher_name not in self.publisher_ids:
+            publisher = Publisher.objects.create(name=publisher_name)
+            self.publisher_ids[publisher_name] = publisher.pk
+            self.stats['publisher'] += 1
+        return self.publisher_ids[publisher_name]
+
+    def get_person(self, name):
+        '''Id for the named person, creating them if necessary (people
+        are normally created in advance by :meth:`create_people`)'''
+        if name not in self.person_ids:
+            person = Person.objects.filter(authorized_name=name).first()
+            if person is None:
+                viafid = self.viaf_lookup(name)
+                person = Person.objects.create(authorized_name=name,
+                            viaf_id=viafid)
+                self.stats['person'] += 1
+            self.person_ids[name] = person.pk
+        return self.person_ids[name]
+
+    def book_data(self, data):
+        '''Prepare a new book and the data for its related records from
+        a row of data in the spreadsheet; creates places and publishers
+        as needed.  Returns a dict with the unsaved book, a list of
+        creators as (person id, creator type id), and catalogue fields.'''
 
         # nysl books, therefore assuming all are extant
         newbook = Book(is_extant=True)
@@ -190,7 +394,7 @@ class Command(BaseCommand):
             pub_year = (re.match(r'\d+?(?=\D)', pub_year)).group(0)
 
         if pub_year:
-            newbook.pub_year = pub_year
+            newbook.pub_year = int(pub_year)
         # - is annotated; spreadsheet has variants in upper/lower case
         # and trailing periods; in some cases there are notes;
         # for now, assuming that anything ambiguous should be false here
@@ -210,24 +414,9 @@ class Command(BaseCommand):
 
         # add required relationships before saving the new book
         # - place
-        placename = data[self.fields['pub_place']].strip(' ?[]()')
-        if placename and len((re.sub(r'[.,]', '', placename))) < 3:
-            placename = None
+        placename = self.place_name(data[self.fields['pub_place']])
         if placename:
-            try:
-                place = Place.objects.get(name=placename)
-            except Place.DoesNotExist:
-                place_dict = self.geonames_lookup(placename)
-                if place_dict:
-                    place = Place.objects.create(name=placename, **place_dict)
-                else:
-                    place = Place.objects.create(
-                        name=placename,
-                        latitude=0.0,
-                        longitude=0.0,
-                    )
-                self.stats['place'] += 1
-            newbook.pub_place = place
+            newbook.pub_place_id = self.get_place(placename)
 
         # - publisher
         publisher_name = data[self.fields['publisher']].strip("?. ")
@@ -235,81 +424,143 @@ class Command(BaseCommand):
         if publisher_name and len(publisher_name) < 4:
             publisher_name = None
         if publisher_name:
-            try:
-                publisher = Publisher.objects.get(name=publisher_name)
-            except Publisher.DoesNotExist:
-                publisher = Publisher.objects.create(name=publisher_name)
-                self.stats['publisher'] += 1
-            newbook.publisher = publisher
-
-        newbook.save()
+            newbook.publisher_id = self.get_publisher(publisher_name)
 
         # TODO: do we need to handle multiple creators here?
+        creators = []
+        author = None
         for creator_type, csv_field in self.creators.items():
             # name could be empty (e.g. for translator, editor)
-            name = data[csv_field]
-            # Get rid of any last stray periods, if they exist
-            name = name.strip('?. []')
-            # Get various versions of 'Not sure' and remove name if they exist
-            if re.search(r'[Vv]arious|[A|a]nonymous|[N|n]one [G|g]iven', name):
-                name = None
-            # Use four characters as a dumb filter to toss stray 'np'/'sn'
-            if name and len(name) <= 4:
-                name = None
+            name = self.creator_name(data[csv_field])
             if name:
-                try:
-                    person = Person.objects.get(authorized_name=name)
-                except Person.DoesNotExist:
-                    viafid = self.viaf_lookup(name)
-                    person = Person.objects.create(authorized_name=name,
-                                viaf_id=viafid)
-                    self.stats['person'] += 1
-                newbook.add_creator(person, creator_type)
-
-        # catalogue as a current NYSL book
-        Catalogue.objects.create(institution=self.nysl, book=newbook,
-            is_current=True,
-            call_number=data[self.fields['nysl_call_number']],
-            notes=data[self.fields['nysl_notes']])
-
+                creators.append((self.get_person(name),
+                                 self.creator_type_ids[creator_type]))
+                if creator_type == 'Author':
+                    author = name
+
+        # slug is normally generated on save, which bulk create skips
+        newbook.slug = newbook.generate_slug(author=author or '')
+        if newbook.slug in self.slugs:
+            raise CommandError('duplicate book %s' % newbook.slug)
+
+        return {
+            'book': newbook,
+            'creators': creators,
+            # catalogue as a current NYSL book
+            'catalogue': {
+                'call_number': data[self.fields['nysl_call_number']],
+                'notes': data[self.fields['nysl_notes']]
+            }
+        }
+
+    def save_books(self, books):
+        '''Save a list of books prepared by :meth:`book_data` and their
+        creators and catalogue entries, in a single transaction.  Returns
+        a list of the new book ids.'''
+        with transaction.atomic():
+            Book.objects.bulk_create([entry['book'] for entry in books])
+            # bulk create doesn't set ids (except on postgresql),
+            # so look them up by slug
+            slugs = [entry['book'].slug for entry in books]
+            book_ids = dict(Book.objects.filter(slug__in=slugs)
+                            .values_list('slug', 'pk'))
+            Creator.objects.bulk_create([
+                Creator(book_id=book_ids[entry['book'].slug],
+                        person_id=person_id, creator_type_id=creator_type_id)
+                for entry in books
+                for person_id, creator_type_id in entry['creators']])
+            Catalogue.objects.bulk_create([
+                Catalogue(book_id=book_ids[entry['book'].slug],
+                          institution=self.nysl, is_current=True,
+                          **entry['catalogue'])
+                for entry in books])
+        self.slugs.update(slugs)
+        self.stats['book'] += len(books)
+        return list(book_ids.values())
+
+    def import_error(self, row, err):
+        '''Report an error importing a row from the spreadsheet'''
+        self.stderr.write('Error on import for %s: %s' %
+                          (row['Short Title'][:30], err))
+        self.stats['err'] += 1
+
+    def create_books(self, rows):
+        '''Create books and their related records for a batch of rows
+        from the spreadsheet; errors are reported for each row.  Returns
+        a list of the new book ids.'''
+        books = []
+        slugs = set()
+        for row in rows:
+            try:
+                entry = self.book_data(row)
+                # check for duplicates within the batch
+                if entry['book'].slug in slugs:
+                    raise CommandError('duplicate book %s' % entry['book'].slug)
+                slugs.add(entry['book'].slug)
+                books.append((row, entry))
+            except Exception as err:
+                self.import_error(row, err)
+        if not books:
+            return []
+
+        try:
+            return self.save_books([entry for row, entry in books])
+        except Exception as err:
+            if len(books) == 1:
+                self.import_error(books[0][0], err)
+                return []
+
+        # the batch could not be saved (e.g. a value too long for its
+        # database field); save rows one at a time to skip and report
+        # only the rows with errors
+        book_ids = []
+        for row, entry in books:
+            try:
+                book_ids.extend(self.save_books([entry]))
+            except Exception as err:
+                self.import_error(row, err)
+        return book_ids
+
+    def import_books(self, rows, batch_size=None):
+        '''Create books from spreadsheet rows, in batches, then index
+        them all at once.'''
+        batch_size = batch_size or self.batch_size
+        self.load_lookups()
+        book_ids = []
+        rows = iter(rows)
+        # any changes queued for indexing are held until the end
+        with IndexQueue.deferred():
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                book_ids.extend(self.create_books(batch))
+            if book_ids:
+                # bulk create skips the save method, which would
+                # otherwise update publication year statistics
+                Book.clear_pub_year_stats()
+                self.index_books(book_ids)
+        return book_ids
+
+    def index_books(self, book_ids):
+        '''Index newly imported books in Solr'''
+        try:
+            Indexable.index_items(Book.objects.filter(pk__in=book_ids),
+                                  params=dict(IndexQueue.index_params))
+        except Exception as err:
+            # imported data is kept; it can be indexed later
+            self.stderr.write('Error indexing imported books (use the '
+                              'index command to index them): %s' % err)
 
-        self.stats['book'] += 1
+    def create_book(self, data):
+        '''Create a new book and all related models from a row of data
+        in the spreadsheet.'''
+        if not hasattr(self, 'slugs'):
+            self.load_lookups()
+        self.create_people([data])
+        self.save_books([self.book_data(data)])
 
     def build_sammelband(self):
-        '''Create sammelband flag for books with same/similar NYSL catalog numbers'''
-        # All the catalogues just created
-        catalogue_set = Catalogue.objects.all()
-        # Call number list, not yet made unique
-        call_nos = []
-        self.stdout.write('Now checking for bound volumes:')
-        for catalogue in catalogue_set:
-                # Remove letters that obscure sammelbands
-                call_search = (catalogue.call_number).strip('abcdefgh')
-                match_count = 0
-                for entry in catalogue_set:
-                    search_re = re.compile(r'%s$' % call_search)
-                    if re.match(search_re,
-                                (entry.call_number).strip('abcdefgh')):
-                        match_count += 1
-                # If match happened more than once, assume sammelband
-                if match_count > 1:
-                    call_nos.append(catalogue.call_number)
-                    catalogue.is_sammelband = True
-                    catalogue.save()
-        # A sorted unique vol list
-        sorted_vols = sorted(list(set(call_nos)))
-        # Get a list of books that are associated with a sammelband entry
-        cat_list = []
-        for number in sorted_vols:
-            q = Catalogue.objects.filter(call_number=number)
-            cat_list = chain(cat_list, q)
-
-        self.stdout.write('    Number of call numbers that seem to have '
-                          'multiple bound titles: %s' % len(sorted_vols))
-        self.stdout.write('The following titles are marked as sammelband:')
-        # Good old fashioned for-loop with iterator to build a list for the team
-        i = 1
-        for cat in cat_list:
-            self.stdout.write('    %s. Short Title: %s - NYSL Call Number: %s'
-                              % (i, cat.book.short_title, cat.call_number))
-            i += 1
+        '''Create sammelband flag for books with same/similar NYSL catalog
+        numbers; see the **detect_sammelbands** command.'''
+        call_command('detect_sammelbands', stdout=self.stdout)
@@ -1,15 +1,20 @@
+from collections import defaultdict
 import logging
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Count, Prefetch, Q, prefetch_related_objects
 from django.contrib.contenttypes.fields import GenericRelation
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
-from djiffy.models import Manifest
+from djiffy.models import Canvas, Manifest
 from unidecode import unidecode
 
+from winthrop.common import request_cache
 from winthrop.common.models import Named, Notable, DateRange
-from winthrop.common.solr import Indexable
+from winthrop.common.solr import Indexable, IndexQueue
 from winthrop.places.models import Place
 from winthrop.people.models import Person
 from winthrop.footnotes.models import Footnote
@@ -60,9 +65,20 @@ class OwningInstitution(Named, Notable, BookCount):
     contact_info = models.TextField()
     place = models.ForeignKey(Place)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._initial_short_name = self.short_name
+
     def __str__(self):
         return self.short_name or self.name
 
+    @property
+    def name_changed(self):
+        '''Determine if the name or short name of an institution has
+        changed on current instance, since either may be displayed'''
+        return super().name_changed or \
+            self.short_name != self._initial_short_name
+
 
 class Book(Notable, Indexable):
     '''An individual book or volume'''
@@ -111,13 +127,108 @@ class Book(Notable, Indexable):
     # (actual models that need this still TBD)
     footnotes = GenericRelation(Footnote)
 
+    #: last modification time, updated on save and when related
+    #: data included in the index changes
+    updated = models.DateTimeField(auto_now=True)
+
     class Meta:
         ordering = ['title']
 
+    #: cache key for publication year statistics
+    PUB_YEAR_STATS_CACHE_KEY = 'book_pub_year_stats'
+    #: timeout for cached publication year statistics, in seconds.
+    #: Statistics are cleared by signal handlers when they change; the
+    #: timeout is only a backstop for changes that don't send signals
+    #: and don't clear them explicitly (e.g. queryset updates).
+    pub_year_stats_timeout = 60 * 60 * 24
+
+    #: fields to keep initial values for, so that signal handlers
+    #: can detect changes on save; see :meth:`field_changed`
+    tracked_fields = ('pub_year', 'slug', 'digital_edition_id')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._set_initial()
+
+    def _set_initial(self):
+        # values as loaded or last saved; use instance dict so that
+        # deferred fields aren't loaded
+        self._initial = dict((field, self.__dict__.get(field))
+                             for field in self.tracked_fields)
+
+    def field_changed(self, field):
+        '''Check if a tracked field has changed since the book was loaded
+        or last saved'''
+        return getattr(self, field) != self._initial[field]
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = self.generate_slug()
         super(Book, self).save(*args, **kwargs)
+        # post save signal handlers have run; reset tracked values
+        self._set_initial()
+
+    @classmethod
+    def pub_year_stats(cls):
+        '''Publication year statistics for all books: minimum and maximum
+        year and the number of books for each decade, e.g.::
+
+            {'min': 1559, 'max': 1798, 'decades': {1550: 2, 1560: 14, ...}}
+
+        Statistics are calculated with a single query and kept in the
+        cache until a book is added, removed, or its publication year is
+        changed (see :meth:`handle_pub_year_save` and
+        :meth:`handle_pub_year_delete`).  Bulk changes that don't send
+        signals (e.g. queryset updates or bulk create) should call
+        :meth:`clear_pub_year_stats`.  Within a request, statistics are
+        read from the cache only once (see
+        :mod:`~winthrop.common.request_cache`).'''
+        return request_cache.memoize(cls.PUB_YEAR_STATS_CACHE_KEY,
+                                     cls._cached_pub_year_stats)
+
+    @classmethod
+    def _cached_pub_year_stats(cls):
+        stats = cache.get(cls.PUB_YEAR_STATS_CACHE_KEY)
+        if stats is None:
+            year_counts = cls.objects.exclude(pub_year=None) \
+                .values_list('pub_year').annotate(total=Count('pk')).order_by()
+            decades = defaultdict(int)
+            for year, total in year_counts:
+                decades[year - year % 10] += total
+            years = [year for year, total in year_counts]
+            stats = {
+                'min': min(years) if years else None,
+                'max': max(years) if years else None,
+                'decades': dict(decades),
+            }
+            cache.set(cls.PUB_YEAR_STATS_CACHE_KEY, stats,
+                      cls.pub_year_stats_timeout)
+        return stats
+
+    @classmethod
+    def clear_pub_year_stats(cls):
+        '''Clear cached publication year statistics, so they will be
+        recalculated the next time they are needed'''
+        cache.delete(cls.PUB_YEAR_STATS_CACHE_KEY)
+        request_cache.forget(cls.PUB_YEAR_STATS_CACHE_KEY)
+
+    @staticmethod
+    def handle_pub_year_save(sender, instance, created=False, raw=False, **kwargs):
+        '''post_save signal handler; clears publication year statistics
+        when a book with a publication year is added or a year changes'''
+        if raw:
+            return
+        if instance.field_changed('pub_year') or \
+          (created and instance.pub_year is not None):
+            Book.clear_pub_year_stats()
+
+    @staticmethod
+    def handle_pub_year_delete(sender, instance, **kwargs):
+        '''post_delete signal handler; clears publication year statistics
+        when a book with a publication year is removed (including queryset
+        and admin bulk deletes)'''
+        if instance.pub_year is not None:
+            Book.clear_pub_year_stats()
 
     def __str__(self):
         return '%s (%s)' % (self.short_title, self.pub_year)
@@ -194,19 +305,19 @@ class Book(Notable, Indexable):
         '''Contributor queryset filtered by creator type Editor'''
         return self.contributor_by_type('Editor')
 
-    def generate_slug(self):
+    def generate_slug(self, author=None):
         '''Generate a slug based on first author, title, and year.
 
+        :param author: name of the first author, to use instead of
+            looking it up (e.g. for a book that is not yet saved)
         :rtype str: String in the format ``lastname-title-of-work-year``
         '''
         # get the first author, if there is one
-        author = self.authors().first()
-        if author:
-            # use the last name of the first author
-            author = author.authorized_name.split(',')[0]
-        else:
-            # otherwise, set it to an empty string
-            author = ''
+        if author is None:
+            author = self.authors().first()
+            author = author.authorized_name if author else ''
+        # use the last name of the first author
+        author = author.split(',')[0]
         # truncate the title to first several words of the title
         title = ' '.join(self.short_title.split()[:5])
         # use copyright year if available, with fallback to work year if
@@ -218,57 +329,124 @@ class Book(Notable, Indexable):
         '''URL so view this object on the public website'''
         return reverse('books:detail', kwargs={'slug': self.slug})
 
+    @classmethod
+    def mark_changed(cls, book_ids, fields=None):
+        '''Update the modification time for the specified books, e.g.
+        when related data included in the index has changed, and queue
+        them for reindexing.  If a list of index fields is specified,
+        only those fields are updated; see :meth:`index_field_values`.'''
+        book_ids = list(book_ids)
+        if book_ids:
+            cls.objects.filter(pk__in=book_ids).update(updated=timezone.now())
+            if fields:
+                IndexQueue.add_partial(cls, book_ids, fields)
+            else:
+                IndexQueue.add_items(cls, book_ids)
+
+    @classmethod
+    def mark_edition_changed(cls, manifest_id):
+        '''Mark the books for a digital edition as changed, e.g. when
+        its thumbnail may have changed; see :meth:`mark_changed`'''
+        book_ids = list(cls.objects.filter(digital_edition=manifest_id) \
+                                   .values_list('id', flat=True))
+        logger.debug('canvas change, queueing %d book(s) for reindexing',
+                     len(book_ids))
+        cls.mark_changed(book_ids)
+
+    @classmethod
+    def related_index_fields(cls, instance):
+        '''Index fields that include the name of a related person,
+        subject or language, for partial updates when it is renamed or
+        deleted.  Returns None for other related objects.'''
+        if isinstance(instance, Person):
+            return cls.person_index_fields
+        if isinstance(instance, Subject):
+            return ['subject']
+        if isinstance(instance, Language):
+            return ['language']
+
     def handle_person_save(sender, instance, **kwargs):
-        '''signal handler for person save; reindex to get current author name'''
+        '''signal handler for person save; reindex to get current author
+        and annotator names, and mark books with other interactions with
+        this person as changed'''
         if instance.authorized_name_changed:
             # only index if authorized name has changed
-            logger.debug('person save, reindexing %d book(s)', instance.book_set.count())
-            Indexable.index_items(instance.book_set.all(), params={'commitWithin': 3000})
+            book_ids = set(instance.book_set.values_list('id', flat=True))
+            book_ids.update(Book.objects.filter(
+                Q(digital_edition__canvases__annotation__author=instance) |
+                Q(personbook__person=instance)).values_list('id', flat=True))
+            logger.debug('person save, queueing %d book(s) for reindexing',
+                         len(book_ids))
+            Book.mark_changed(book_ids, fields=Book.person_index_fields)
 
     def handle_related_change(sender, instance, **kwargs):
         '''Signal handler for any m2m relateds that have an explicit through
         model and therefore do not consistently fire the expected m2m
         signals.'''
         # same behavior for save or delete
-        logger.debug('%s change, reindexing %s',
+        logger.debug('%s change, queueing %s for reindexing',
                      instance.__class__.__name__,
-                     instance.book)
-        instance.book.index(params={'commitWithin': 3000})
+                     instance.book_id)
+        Book.mark_changed([instance.book_id])
 
     def handle_named_save(sender, instance, **kwargs):
-        '''Signal handler for name changes to m2ms on
-        :class:`winthrop.books.models.Book` that are subclasses of
-        :class:`winthrop.common.models.Named`.'''
+        '''Signal handler for name changes to m2ms and other related
+        models on :class:`winthrop.books.models.Book` that are subclasses
+        of :class:`winthrop.common.models.Named`.'''
         if instance.name_changed:
+            book_ids = list(instance.book_set.values_list('id', flat=True))
             logger.debug(
-                '%s (%s) name changed, reindexing %d books',
+                '%s (%s) name changed, queueing %d books for reindexing',
                 instance,
                 instance.__class__.__name__,
-                instance.book_set.count()
+                len(book_ids)
             )
-            Indexable.index_items(instance.book_set.all(),
-                                  params={'commitWithin': 3000})
+            Book.mark_changed(book_ids,
+                              fields=Book.related_index_fields(instance))
 
     def handle_related_delete(sender, instance, **kwargs):
         '''Signal handler for deletions on m2m models on
         :class:`winthrop.books.models.Book`'''
         # Unlike handle_named_save, these will work for any m2m model
         # deletion.
-        # get a list of ids for collected works before clearing them
-        book_ids = instance.book_set.values_list('id', flat=True)
+        # get a list of ids for associated books before the relations
+        # are removed; books are reindexed when the queue is flushed,
+        # after the delete (and the cascade to through models) completes
+        book_ids = list(instance.book_set.values_list('id', flat=True))
 
         logger.debug(
-            '%s delete, reindexing %d book(s)',
+            '%s delete, queueing %d book(s) for reindexing',
             instance.__class__.__name__,
             len(book_ids),
         )
-        # find the items based on the list of ids to reindex
-        books = Book.objects.filter(id__in=list(book_ids))
-
-        # NOTE: this sends pre/post clear signal, but it's not obvious
-        # how to take advantage of that
-        instance.book_set.clear()
-        Indexable.index_items(books, params={'commitWithin': 3000})
+        Book.mark_changed(book_ids, fields=Book.related_index_fields(instance))
+
+    def handle_annotation_change(sender, instance, **kwargs):
+        '''Signal handler for annotation save or delete; reindex the book
+        for the annotated canvas to update annotator names.'''
+        if instance.canvas_id:
+            book_ids = list(Book.objects.filter(
+                digital_edition__canvases=instance.canvas_id) \
+                .values_list('id', flat=True))
+            logger.debug('annotation change, queueing %d book(s) for reindexing',
+                         len(book_ids))
+            Book.mark_changed(book_ids, fields=['annotator'])
+
+    def handle_canvas_save(sender, instance, created=False, raw=False, **kwargs):
+        '''Signal handler for canvas save; reindex the book for the
+        canvas's digital edition to update the thumbnail.'''
+        # a new canvas only changes the thumbnail if it is flagged as one
+        # (e.g. not for every page when importing a digital edition);
+        # an existing canvas may have been flagged or unflagged
+        if raw or (created and not instance.thumbnail):
+            return
+        Book.mark_edition_changed(instance.manifest_id)
+
+    def handle_canvas_delete(sender, instance, **kwargs):
+        '''Signal handler for canvas delete; reindex the book for the
+        canvas's digital edition if the canvas was a thumbnail.'''
+        if instance.thumbnail:
+            Book.mark_edition_changed(instance.manifest_id)
 
     #: index dependencies, to update when related items are changed
     index_depends_on = {
@@ -297,6 +475,36 @@ class Book(Notable, Indexable):
             'post_save': handle_related_change,
             'post_delete': handle_related_change,
         },
+        # publisher and place names; books are deleted with them
+        'books.Publisher': {
+            'post_save': handle_named_save,
+        },
+        'places.Place': {
+            'post_save': handle_named_save,
+        },
+        # thumbnail
+        'djiffy.Canvas': {
+            'post_save': handle_canvas_save,
+            'post_delete': handle_canvas_delete,
+        },
+        # not indexed, but displayed on the book detail page
+        'catalogue_set': {
+            'post_save': handle_related_change,
+            'post_delete': handle_related_change,
+        },
+        # institution names; catalogue entries are deleted with them
+        'owning_institutions': {
+            'post_save': handle_named_save,
+        },
+        'personbook_set': {
+            'post_save': handle_related_change,
+            'post_delete': handle_related_change,
+        },
+        # annotator names
+        'annotation.Annotation': {
+            'post_save': handle_annotation_change,
+            'post_delete': handle_annotation_change,
+        },
     }
 
     def index_id(self):
@@ -322,8 +530,139 @@ class Book(Notable, Indexable):
         # content type as a string, for use in solr indexing
         return str(cls._meta)
 
+    def contributor_names(self):
+        '''Contributor names grouped by creator type name, in creation
+        order, for use in index data.  Uses creators bulk-loaded by
+        :meth:`prep_index_chunk` when available.'''
+        contributors = defaultdict(list)
+        # object must be saved in order to query related items
+        if not self.pk:
+            return contributors
+
+        if hasattr(self, 'prefetched_creators'):
+            creators = self.prefetched_creators
+        else:
+            creators = self.creator_set.select_related('person', 'creator_type') \
+                                       .order_by('pk')
+        for creator in creators:
+            contributors[creator.creator_type.name].append(str(creator.person))
+        return contributors
+
+    @classmethod
+    def prep_index_chunk(cls, chunk):
+        '''Bulk-load the related data used by :meth:`index_data` for a
+        list of books, so that indexing a chunk takes a fixed number of
+        queries regardless of the number of books in it.'''
+        prefetch_related_objects(
+            chunk, 'publisher', 'pub_place', 'digital_edition',
+            'languages', 'subjects',
+            # order by creator pk to match contributor_by_type
+            Prefetch('creator_set',
+                     queryset=Creator.objects.select_related('person', 'creator_type')
+                                             .order_by('pk'),
+                     to_attr='prefetched_creators')
+        )
+
+        # first canvas flagged as thumbnail for each digital edition
+        thumbnails = {}
+        manifest_ids = set(book.digital_edition_id for book in chunk
+                           if book.digital_edition_id)
+        if manifest_ids:
+            for canvas in Canvas.objects.filter(manifest__in=manifest_ids,
+                                                thumbnail=True) \
+                                        .order_by('manifest', 'order'):
+                thumbnails.setdefault(canvas.manifest_id, canvas)
+
+        # unique annotator names for each book, with the same join
+        # used by annotators()
+        annotators = defaultdict(set)
+        annotator_names = Person.objects \
+            .filter(annotation__canvas__manifest__book__in=chunk) \
+            .values_list('annotation__canvas__manifest__book', 'authorized_name')
+        for book_id, name in annotator_names:
+            annotators[book_id].add(name)
+
+        for book in chunk:
+            book._index_prefetch = {
+                'thumbnail': thumbnails.get(book.digital_edition_id),
+                'annotator': sorted(annotators[book.pk]),
+            }
+        return chunk
+
+    #: index fields that include person names
+    person_index_fields = ['author', 'author_sort', 'editor', 'translator',
+                           'annotator']
+    #: index fields that can be updated without reindexing the whole book
+    partial_index_fields = person_index_fields + ['subject', 'language']
+
+    @classmethod
+    def index_field_values(cls, pks, fields):
+        '''Current values for the specified name fields for a list of
+        book ids, keyed on index id.  Uses one query for each kind of
+        related data regardless of the number of books, with the same
+        ordering as :meth:`index_data`.'''
+        fields = set(fields)
+        values = dict((pk, {}) for pk in pks)
+
+        if fields & {'author', 'author_sort', 'editor', 'translator'}:
+            contributors = dict((pk, defaultdict(list)) for pk in pks)
+            for book_id, creator_type, name in Creator.objects \
+                    .filter(book__in=pks).order_by('pk') \
+                    .values_list('book', 'creator_type__name',
+                                 'person__authorized_name'):
+                contributors[book_id][creator_type].append(name)
+            for pk, names in contributors.items():
+                authors = names['Author']
+                contributor_values = {
+                    'author': authors,
+                    'author_sort': authors[0] if authors else None,
+                    'editor': names['Editor'],
+                    'translator': names['Translator'],
+                }
+                values[pk].update((field, value) for field, value
+                                  in contributor_values.items() if field in fields)
+
+        if 'annotator' in fields:
+            annotators = dict((pk, set()) for pk in pks)
+            for book_id, name in Person.objects \
+                    .filter(annotation__canvas__manifest__book__in=pks) \
+                    .values_list('annotation__canvas__manifest__book',
+                                 'authorized_name'):
+                annotators[book_id].add(name)
+            for pk, names in annotators.items():
+                values[pk]['annotator'] = sorted(names)
+
+        for field, model in (('subject', Subject), ('language', Language)):
+            if field in fields:
+                names = dict((pk, []) for pk in pks)
+                for book_id, name in model.objects.filter(book__in=pks) \
+                                          .values_list('book', 'name'):
+                    names[book_id].append(name)
+                for pk, name_list in names.items():
+                    values[pk][field] = name_list
+
+        # only include books that currently exist
+        existing = cls.objects.filter(pk__in=pks).values_list('pk', flat=True)
+        return dict((cls(pk=pk).index_id(), values[pk]) for pk in existing)
+
     def index_data(self):
         '''data for indexing in Solr'''
+        # related data bulk-loaded by prep_index_chunk, if any
+        prefetched = getattr(self, '_index_prefetch', {})
+
+        contributors = self.contributor_names()
+        authors = contributors['Author']
+
+        if 'thumbnail' in prefetched:
+            thumbnail = prefetched['thumbnail']
+        else:
+            thumbnail = self.digital_edition.thumbnail if self.digital_edition else None
+
+        if 'annotator' in prefetched:
+            annotators = prefetched['annotator']
+        else:
+            # unique list of annotators, since we don't need repeats
+            annotators = sorted(set(str(annotator) for annotator in self.annotators()))
 
         return {
             # use content type in format of app.model_name for type
@@ -333,15 +672,14 @@ class Book(Notable, Indexable):
             'slug': self.slug,
             'title': self.title,
             'short_title': self.short_title,
-            'author': [str(author) for author in self.authors()],
+            'author': authors,
             # first author only, for sorting
-            'author_sort': str(self.authors().first()) if self.authors().exists() else None,
-            'editor': [str(editor) for editor in self.editors()],
-            'translator': [str(translator) for translator in self.translators()],
+            'author_sort': authors[0] if authors else None,
+            'editor': contributors['Editor'],
+            'translator': contributors['Translator'],
             'language': [str(language) for language in self.languages.all()],
             'subject': [str(subject) for subject in self.subjects.all()],
-            # use set() to get unique list of annotators, since we don't need repeats
-            'annotator': list(set(str(annotator) for annotator in self.annotators())),
+            'annotator': annotators,
             'pub_year': self.pub_year,
             'publisher': self.publisher.name if self.publisher else '',
             'pub_place': self.pub_place.name if self.pub_place else '',
@@ -350,8 +688,8 @@ class Book(Notable, Indexable):
             # NOTE: this indicates whether the book is annotated, does not
             # necessarily mean there are annotations documented in our system
             'is_annotated': self.is_annotated,
-            'thumbnail': self.thumbnail,
-            'thumbnail_label': self.thumbnail_label
+            'thumbnail': thumbnail.iiif_image_id if thumbnail else None,
+            'thumbnail_label': thumbnail.label if thumbnail else None
         }
 
 
@@ -367,12 +705,58 @@ class Catalogue(Notable, DateRange):
     is_sammelband = models.BooleanField(default=False)
     bound_order = models.PositiveIntegerField(null=True, blank=True)
 
+    #: letters stripped from call numbers to find volumes bound together,
+    #: e.g. Win 60a and Win 60b
+    call_number_suffixes = 'abcdefgh'
+
     def __str__(self):
         dates = ''
         if self.dates:
             dates = ' (%s)' % self.dates
         return '%s / %s%s' % (self.book, self.institution, dates)
 
+    @classmethod
+    def sammelband_key(cls, call_number):
+        '''Call number with volume letters removed, shared by all the
+        books in a sammelband'''
+        return call_number.strip(cls.call_number_suffixes)
+
+    @classmethod
+    def detect_sammelbands(cls, catalogues=None, dry_run=False):
+        '''Find catalogue entries that share a call number (ignoring
+        volume letters; see :meth:`sammelband_key`) with another entry,
+        and flag them as sammelbands.  Entries without a call number are
+        ignored.  Returns the matching entries, with their books, ordered
+        by call number.
+
+        :param catalogues: optional queryset to check; defaults to all
+        :param dry_run: find entries without updating them
+        '''
+        if catalogues is None:
+            catalogues = cls.objects.all()
+        groups = defaultdict(list)
+        for catalogue in catalogues.select_related('book') \
+                                   .order_by('call_number', 'pk'):
+            key = cls.sammelband_key(catalogue.call_number)
+            if key:
+                groups[key].append(catalogue)
+        sammelbands = sorted(
+            (catalogue for group in groups.values() if len(group) > 1
+             for catalogue in group),
+            key=lambda catalogue: (catalogue.call_number, catalogue.pk))
+
+        if not dry_run:
+            # only update entries that aren't already flagged
+            pks = [catalogue.pk for catalogue in sammelbands
+                   if not catalogue.is_sammelband]
+            # update in chunks, to stay under database query parameter limits
+            for i in range(0, len(pks), 500):
+                cls.objects.filter(pk__in=pks[i:i + 500]) \
+                   .update(is_sammelband=True)
+            for catalogue in sammelbands:
+                catalogue.is_sammelband = True
+        return sammelbands
+
 
 class BookSubject(Notable):
     '''Through-model for book-subject relationship, to allow designating
@@ -1,15 +1,22 @@
 import csv
 from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import StringIO
+import json
+import threading
 from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
 import os
 
 from django.core.management import call_command
+from django.db import DatabaseError
 from django.test import TestCase
 from djiffy.models import Manifest
 
-from winthrop.books.models import Book, OwningInstitution
+from winthrop.books.models import Book, Catalogue, OwningInstitution
 from winthrop.books.management.commands import import_nysl, import_digitaleds
+from winthrop.people.models import Person
+from winthrop.people.viaf import ViafAPI
 
 
 FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -24,6 +31,7 @@ class TestImportNysl(TestCase):
     def setUp(self):
         self.cmd = import_nysl.Command()
         self.cmd.stdout = StringIO()
+        self.cmd.stderr = StringIO()
         # setup normally done in handle()
         self.cmd.stats = defaultdict(int)
         self.cmd.nysl = OwningInstitution.objects.get(short_name='NYSL')
@@ -43,11 +51,19 @@ class TestImportNysl(TestCase):
         self.cmd.viaf_lookup = dummy_viaf
         self.cmd.geonames_lookup = dummy_geonames
 
-    def test_run(self, mocksetbirthdeath):
+    @patch('winthrop.books.management.commands.import_nysl.Indexable.index_items')
+    @patch('winthrop.books.management.commands.import_nysl.GeoNamesAPI.resolve_many')
+    def test_run(self, mock_resolve_many, mock_index_items, mocksetbirthdeath):
             out = StringIO()
             # pass the modified self.cmd object
-            call_command(self.cmd, self.test_csv, stdout=out)
+            call_command(self.cmd, self.test_csv, stdout=out, batch_size=3)
             output = out.getvalue()
+            # places are all looked up at once
+            mock_resolve_many.assert_called_once_with(
+                {'Emden', 'Frankfurt', 'Douai'}, max_rows=1, max_workers=4)
+            # all new books indexed at once
+            mock_index_items.assert_called_once()
+            assert set(mock_index_items.call_args[0][0]) == set(Book.objects.all())
             assert 'Imported content' in output
             assert '4 books' in output # Duplicated book to test expected behavior
             assert '3 places' in output
@@ -140,6 +156,174 @@ class TestImportNysl(TestCase):
         assert book.catalogue_set.first().is_sammelband == True
 
 
+    @patch('winthrop.books.management.commands.import_nysl.Indexable.index_items')
+    def test_import_books(self, mock_index_items, mocksetbirthdeath):
+        rows = list(self.cmd.read_rows(self.test_csv))
+        self.cmd.create_people(rows)
+        book_ids = self.cmd.import_books(rows, batch_size=2)
+        assert len(book_ids) == 4
+        assert self.cmd.stats['book'] == 4
+        book = Book.objects.get(pk=book_ids[0])
+        # slug includes author, as when saved normally
+        assert book.slug == book.generate_slug()
+        assert book.creator_set.count() == 1
+        assert book.catalogue_set.get().call_number == rows[0]['NYSL CALL NUMBER']
+        mock_index_items.assert_called_once()
+
+        # import again: duplicate books are reported as errors for each row,
+        # with a fixed number of queries for lookups and no books saved
+        self.cmd.stats.clear()
+        with self.assertNumQueries(5):
+            assert self.cmd.import_books(rows) == []
+        assert self.cmd.stats['err'] == 4
+        errors = self.cmd.stderr.getvalue()
+        assert errors.count('Error on import') == 4
+        assert 'duplicate book' in errors
+
+        # duplicates within a batch
+        self.cmd.stats.clear()
+        self.cmd.stderr = StringIO()
+        Book.objects.all().delete()
+        self.cmd.import_books([rows[0], rows[0]])
+        assert self.cmd.stats['book'] == 1
+        assert self.cmd.stats['err'] == 1
+
+        # database errors saving a batch: other rows are saved
+        self.cmd.stats.clear()
+        self.cmd.stderr = StringIO()
+        Book.objects.all().delete()
+        bad_slug = self.cmd.book_data(rows[1])['book'].slug
+        save_books = self.cmd.save_books
+
+        def failing_save(books):
+            if any(entry['book'].slug == bad_slug for entry in books):
+                raise DatabaseError('Data too long for column')
+            return save_books(books)
+
+        with patch.object(self.cmd, 'save_books', side_effect=failing_save):
+            book_ids = self.cmd.import_books(rows, batch_size=3)
+        assert len(book_ids) == 3
+        assert self.cmd.stats['book'] == 3
+        assert self.cmd.stats['err'] == 1
+        assert 'Data too long' in self.cmd.stderr.getvalue()
+        assert not Book.objects.filter(slug=bad_slug).exists()
+
+    def test_create_people(self, mocksetbirthdeath):
+        with open(self.test_csv) as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        Person.objects.create(authorized_name='Abelin, Johann Philipp')
+        with patch.object(self.cmd, 'viaf_lookup') as mock_viaf_lookup:
+            mock_viaf_lookup.return_value = 'http://viaf.org/viaf/1'
+            self.cmd.create_people(rows)
+            # only new people are looked up and created
+            names = [call[0][0] for call in mock_viaf_lookup.call_args_list]
+            assert 'Abelin, Johann Philipp' not in names
+            assert len(names) == len(set(names)) == 2
+            assert self.cmd.stats['person'] == 2
+            person = Person.objects.get(authorized_name='Łaski, Jan')
+            assert person.viaf_id == 'http://viaf.org/viaf/1'
+            # people already created
+            mock_viaf_lookup.reset_mock()
+            self.cmd.create_people(rows)
+            mock_viaf_lookup.assert_not_called()
+
+        # lookup results are cached
+        Person.objects.filter(viaf_id='http://viaf.org/viaf/1').delete()
+        with patch.object(self.cmd, 'viaf_lookup') as mock_viaf_lookup:
+            self.cmd.create_people(rows)
+            mock_viaf_lookup.assert_not_called()
+        assert Person.objects.get(authorized_name='Łaski, Jan').viaf_id == \
+            'http://viaf.org/viaf/1'
+
+        # failed lookups are reported and not cached
+        Person.objects.filter(viaf_id='http://viaf.org/viaf/1').delete()
+        with patch.object(self.cmd, 'viaf_years') as mock_viaf_years:
+            mock_viaf_years.side_effect = ValueError('no rdf')
+            with patch('winthrop.books.management.commands.import_nysl.LookupCache.get_many',
+                       return_value={}):
+                self.cmd.create_people(rows)
+        assert 'VIAF lookup failed' in self.cmd.stderr.getvalue()
+        assert self.cmd.stats['viaf_err'] == 1
+        person = Person.objects.get(authorized_name='Łaski, Jan')
+        assert person.birth is None
+
+
+class ViafStubHandler(BaseHTTPRequestHandler):
+    '''Minimal VIAF API for testing: suggest returns a personal name
+    match for any name containing "Jan", and every VIAF URI has the same
+    birth and death dates.'''
+
+    rdf = '''<?xml version="1.0"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+    xmlns:schema="http://schema.org/">
+  <rdf:Description rdf:about="%s">
+    <schema:birthDate>1499</schema:birthDate>
+    <schema:deathDate>1560-01-08</schema:deathDate>
+  </rdf:Description>
+</rdf:RDF>'''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(self.path)
+        if url.path.endswith('/AutoSuggest'):
+            query = parse_qs(url.query)['query'][0]
+            result = None
+            if 'Jan' in query:
+                result = [{'nametype': 'personal', 'viafid': '6788'}]
+            content_type = 'application/json'
+            body = json.dumps({'query': query, 'result': result})
+        else:
+            content_type = 'application/rdf+xml'
+            body = self.rdf % ('http://%s:%s%s' % (
+                self.server.server_address + (self.path, )))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImportNyslViaf(TestCase):
+
+    test_csv = os.path.join(FIXTURE_DIR, 'test_nysl_data.csv')
+
+    def setUp(self):
+        server = HTTPServer(('127.0.0.1', 0), ViafStubHandler)
+        server.requests = []
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+
+        base_url = 'http://127.0.0.1:%d/viaf' % server.server_address[1]
+        for attr in ['api_base', 'uri_base']:
+            api_patch = patch.object(ViafAPI, attr, base_url)
+            api_patch.start()
+            self.addCleanup(api_patch.stop)
+
+    def test_resolve_people(self):
+        names = ['Łaski, Jan', 'Abelin, Johann Philipp', 'Jan Amos Comenius']
+        cmd = import_nysl.Command()
+        cmd.stats = defaultdict(int)
+        people = cmd.resolve_people(names, workers=2)
+        uri = '%s/6788' % ViafAPI.uri_base
+        assert people['Łaski, Jan'] == {'viaf_id': uri, 'birth': 1499,
+                                       'death': 1560}
+        assert people['Jan Amos Comenius'] == people['Łaski, Jan']
+        assert people['Abelin, Johann Philipp'] == \
+            {'viaf_id': None, 'birth': None, 'death': None}
+        # one suggest request per name, one rdf request per uri
+        assert len(self.server.requests) == 4
+
+        # running again makes no requests
+        self.server.requests.clear()
+        assert import_nysl.Command().resolve_people(names) == people
+        assert not self.server.requests
+
+
 class TestWinthropManifestImporter(TestCase):
     fixtures = ['sample_book_data.json']
 
@@ -200,3 +384,26 @@ class TestImportDigitalEds(TestCase):
         cmd.handle(path=['one', 'NYSL', 'two'])
         assert mockimporter.return_value.import_paths \
             .called_with(['one', cmd.manifest_uris['NYSL'], 'two'])
+
+
+class TestDetectSammelbands(TestCase):
+
+    def test_command(self):
+        inst = OwningInstitution.objects.get(short_name='NYSL')
+        for i, call_number in enumerate(['Win 60a', 'Win 60b', 'Win 61']):
+            book = Book.objects.create(title='Book %d' % i, short_title='Book %d' % i)
+            Catalogue.objects.create(institution=inst, book=book,
+                                     is_current=True, call_number=call_number)
+
+        out = StringIO()
+        call_command('detect_sammelbands', dry_run=True, stdout=out)
+        output = out.getvalue()
+        assert 'multiple bound titles: 1' in output
+        assert 'would be marked as sammelband' in output
+        assert '1. Short Title: Book 0 - NYSL Call Number: Win 60a' in output
+        assert '2. Short Title: Book 1 - NYSL Call Number: Win 60b' in output
+        assert 'Win 61' not in output
+        assert not Catalogue.objects.filter(is_sammelband=True).exists()
+
+        call_command('detect_sammelbands', stdout=out)
+        assert Catalogue.objects.filter(is_sammelband=True).count() == 2
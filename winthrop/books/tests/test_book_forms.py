@@ -1,6 +1,7 @@
 from django import forms
 from django.test import TestCase
 
+from winthrop.books.models import Book
 from winthrop.books.forms import RadioSelectWithDisabled, SearchForm, \
     RangeWidget, RangeField
 
@@ -48,6 +49,26 @@ class TestSearchForm(TestCase):
         # label only, no widget options to set as disabled
         assert searchform.fields['sort'].widget.choices[-1][1] == 'Relevance'
 
+    def test_pub_date_minmax(self):
+        Book.objects.create(title='Early', short_title='Early', pub_year=1560)
+        Book.objects.create(title='Late', short_title='Late', pub_year=1720)
+        Book.clear_pub_year_stats()
+        # statistics loaded once when the form is initialized
+        with self.assertNumQueries(1):
+            searchform = SearchForm({})
+            assert searchform.pub_date_minmax() == (1560, 1720)
+            assert searchform.pub_date_minmax() == (1560, 1720)
+        # placeholders set from current values
+        widgets = searchform.fields['pub_year'].widget.widgets
+        assert widgets[0].attrs['placeholder'] == 1560
+        assert widgets[1].attrs['placeholder'] == 1720
+
+        # stats are updated when books change; no db query to build the form
+        Book.objects.create(title='Later', short_title='Later', pub_year=1750)
+        Book.pub_year_stats()
+        with self.assertNumQueries(0):
+            assert SearchForm({}).pub_date_minmax() == (1560, 1750)
+
     def test_get_solr_sort_field(self):
         form = SearchForm()
         assert form.get_solr_sort_field('relevance') == \
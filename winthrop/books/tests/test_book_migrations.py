@@ -49,6 +49,13 @@ class TestMigrations(TransactionTestCase):
     def setUpBeforeMigration(self, apps):
         pass
 
+    def tearDown(self):
+        # migrate forward to the current schema, so that tests run
+        # afterwards have all current fields
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
 
 # NOTE: TransactionTestCase must be run after all other test cases,
 # because it truncates the database, removing fixture objects expected
@@ -2,7 +2,8 @@ import json
 from unittest.mock import patch, Mock
 import os
 
-from django.db.models.query import QuerySet
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.safestring import mark_safe
 from django.utils.text import slugify
 from django.test import TestCase
@@ -15,7 +16,8 @@ from winthrop.annotation.models import Annotation
 from winthrop.books.models import OwningInstitution, Book, Publisher, Catalogue, \
     Creator, CreatorType, Subject, BookSubject, Language, BookLanguage, \
     PersonBook, PersonBookRelationshipType
-from winthrop.common.solr import Indexable
+from winthrop.common import request_cache
+from winthrop.common.solr import Indexable, IndexQueue
 from winthrop.places.models import Place
 from winthrop.people.models import Person
 
@@ -36,6 +38,15 @@ class TestOwningInstitution(TestCase):
         inst.short_name = short_name
         assert str(inst) == short_name
 
+    def test_name_changed(self):
+        inst = OwningInstitution.objects.first()
+        assert not inst.name_changed
+        inst.short_name = 'Library'
+        assert inst.name_changed
+        inst = OwningInstitution.objects.first()
+        inst.name = 'Another Library'
+        assert inst.name_changed
+
     def test_book_count(self):
         # test abstract book count mix-in via owning institution model
         # tests that html for admin form is rendered correctly
@@ -214,41 +225,48 @@ class TestBook(TestCase):
         de_christelicke.digital_edition = Manifest.objects.first()
         assert de_christelicke.is_digitized()
 
-    @patch.object(Indexable, 'index_items')
-    def test_handle_person_save(self, mock_index_items):
-
+    def test_handle_person_save(self):
+        IndexQueue.clear()
         author = Person.objects.all().first()
 
         # only reindex on name change
         Book.handle_person_save(Mock(), author)
-        # index not called because collection name has not changed
-        mock_index_items.assert_not_called()
+        # nothing queued because name has not changed
+        assert not IndexQueue.pending_partial()
 
         # modify name to test indexing
         author.authorized_name = 'Another'
         book = Book.objects.filter(contributors=author).first()
         Book.handle_person_save(Mock(), author)
-        # call must be inspected piecemeal because queryset equals comparison fails
-        args, kwargs = mock_index_items.call_args
-        assert isinstance(args[0], QuerySet)
-        assert book in args[0]
-        assert kwargs['params'] == {'commitWithin': 3000}
-
-    @patch.object(Indexable, 'index_items')
-    def test_handle_related_delete(self, mock_index_items):
+        Person.objects.filter(pk=author.pk).update(authorized_name='Another')
+        # only name fields are updated
+        assert IndexQueue.pending_partial()[(Book, book.pk)] == \
+            set(Book.person_index_fields)
+        assert not IndexQueue.pending()
+
+        # flushing the queue sends atomic updates for the books in one batch
+        with patch.object(Indexable, 'index_items') as mock_index_items:
+            IndexQueue.flush()
+            args, kwargs = mock_index_items.call_args
+            doc = [doc for doc in args[0] if doc['id'] == book.index_id()][0]
+            assert doc['author'] == {'set': book.index_data()['author']}
+            assert 'Another' in doc['author']['set']
+            assert doc['text'] == {'set': None}
+            assert kwargs['params'] == {'commitWithin': 3000}
+        assert not IndexQueue.pending_partial()
+
+    def test_handle_related_delete(self):
+        IndexQueue.clear()
         author = Person.objects.all().first()
         book = Book.objects.filter(contributors=author).first()
 
         Book.handle_related_delete(Mock(), author)
-
-        assert author.book_set.count() == 0
-        args, kwargs = mock_index_items.call_args
-        assert isinstance(args[0], QuerySet)
-        assert book in args[0]
-        assert kwargs['params'] == {'commitWithin': 3000}
+        assert IndexQueue.pending_partial()[(Book, book.pk)] == \
+            set(Book.person_index_fields)
 
         # - create a book with a subject attached - this time to test delete
         # on a different related type
+        IndexQueue.clear()
         subject = Subject.objects.all().first()
         book = Book.objects.first()
         BookSubject.objects.create(
@@ -257,14 +275,11 @@ class TestBook(TestCase):
             is_primary=True,
         )
         Book.handle_related_delete(Mock(), subject)
-        assert subject.book_set.count() == 0
-        args, kwargs = mock_index_items.call_args
-        assert isinstance(args[0], QuerySet)
-        assert book in args[0]
-        assert kwargs['params'] == {'commitWithin': 3000}
-
-    @patch.object(Indexable, 'index_items')
-    def test_handle_named_save(self, mock_index_items):
+        assert IndexQueue.pending_partial() == {(Book, book.pk): {'subject'}}
+        IndexQueue.clear()
+
+    def test_handle_named_save(self):
+        IndexQueue.clear()
         # - create a book with a subject attached
         subject = Subject.objects.all().first()
         book = Book.objects.first()
@@ -273,20 +288,17 @@ class TestBook(TestCase):
             book=book,
             is_primary=True,
         )
-        # no change in name, not called
+        # no change in name, not queued
         Book.handle_named_save(Mock(), subject)
-        assert not mock_index_items.called
+        assert not IndexQueue.pending_partial()
 
-        # change in name, should be called
+        # change in name, should be queued
         subject.name = 'Test'
         Book.handle_named_save(Mock(), subject)
-        args, kwargs = mock_index_items.call_args
-        assert isinstance(args[0], QuerySet)
-        assert book in args[0]
-        assert kwargs['params'] == {'commitWithin': 3000}
+        assert IndexQueue.pending_partial()[(Book, book.pk)] == {'subject'}
 
         # test once more with another named subclass
-        mock_index_items.reset_mock()
+        IndexQueue.clear()
         language = Language.objects.all().first()
         book = Book.objects.first()
         BookLanguage.objects.create(
@@ -294,17 +306,182 @@ class TestBook(TestCase):
             book=book,
             is_primary=True,
         )
-        # no change in name, not called
+        # no change in name, not queued
         Book.handle_named_save(Mock(), language)
-        assert not mock_index_items.called
+        assert not IndexQueue.pending_partial()
 
-        # change in name, should be called
+        # change in name, should be queued
         language.name = 'Test'
         Book.handle_named_save(Mock(), language)
-        args, kwargs = mock_index_items.call_args
-        assert isinstance(args[0], QuerySet)
-        assert book in args[0]
-        assert kwargs['params'] == {'commitWithin': 3000}
+        assert IndexQueue.pending_partial()[(Book, book.pk)] == {'language'}
+        IndexQueue.clear()
+
+        # publisher, place and institution names are displayed but not
+        # updated separately; books are queued for a full reindex
+        institution = OwningInstitution.objects.first()
+        Catalogue.objects.create(institution=institution, book=book,
+                                 is_current=True)
+        IndexQueue.clear()
+        book.publisher = Publisher.objects.create(name='Pub Lee')
+        book.pub_place = Place.objects.first()
+        book.save()
+        for related in (book.publisher, book.pub_place, institution):
+            IndexQueue.clear()
+            Book.handle_named_save(Mock(), related)
+            assert not IndexQueue.pending()
+            related.name = 'Test %s' % related.__class__.__name__
+            Book.handle_named_save(Mock(), related)
+            assert (Book, book.pk) in IndexQueue.pending()
+        # modification time updated
+        assert Book.objects.get(pk=book.pk).updated > book.updated
+        IndexQueue.clear()
+
+    def test_handle_related_change(self):
+        IndexQueue.clear()
+        book = Book.objects.first()
+        subject = Subject.objects.first()
+        booksubject = BookSubject.objects.create(subject=subject, book=book,
+                                                 is_primary=True)
+        Book.handle_related_change(Mock(), booksubject)
+        # repeated changes to the same book are only queued once
+        Book.handle_related_change(Mock(), booksubject)
+        assert IndexQueue.pending() == [(Book, book.pk)]
+        IndexQueue.clear()
+
+    def test_handle_annotation_change(self):
+        IndexQueue.clear()
+        book = Book.objects.first()
+        book.digital_edition = Manifest.objects.first()
+        book.save()
+        IndexQueue.clear()
+        canvas = book.digital_edition.canvases.first()
+        annotation = Annotation(canvas=canvas, uri=canvas.uri)
+        Book.handle_annotation_change(Mock(), annotation)
+        assert IndexQueue.pending_partial() == {(Book, book.pk): {'annotator'}}
+        # modification time updated
+        assert Book.objects.get(pk=book.pk).updated > book.updated
+
+        # no canvas, nothing to reindex
+        IndexQueue.clear()
+        Book.handle_annotation_change(Mock(), Annotation())
+        assert not IndexQueue.pending_partial()
+
+    def test_handle_canvas_save(self):
+        book = Book.objects.first()
+        book.digital_edition = Manifest.objects.first()
+        book.save()
+        IndexQueue.clear()
+        canvas = book.digital_edition.canvases.first()
+        # new pages that aren't thumbnails don't change the book
+        Book.handle_canvas_save(Mock(), canvas, created=True)
+        assert not IndexQueue.pending()
+        # changed pages may have been flagged or unflagged as thumbnail
+        Book.handle_canvas_save(Mock(), canvas)
+        assert IndexQueue.pending() == [(Book, book.pk)]
+        # modification time updated
+        assert Book.objects.get(pk=book.pk).updated > book.updated
+
+        IndexQueue.clear()
+        canvas.thumbnail = False
+        Book.handle_canvas_delete(Mock(), canvas)
+        assert not IndexQueue.pending()
+        canvas.thumbnail = True
+        Book.handle_canvas_delete(Mock(), canvas)
+        assert IndexQueue.pending() == [(Book, book.pk)]
+        IndexQueue.clear()
+
+    def test_pub_year_stats(self):
+        Book.clear_pub_year_stats()
+        years = list(Book.objects.exclude(pub_year=None)
+                     .values_list('pub_year', flat=True))
+        with self.assertNumQueries(1):
+            stats = Book.pub_year_stats()
+        assert stats['min'] == min(years)
+        assert stats['max'] == max(years)
+        # number of books per decade
+        assert sum(stats['decades'].values()) == len(years)
+        for decade, total in stats['decades'].items():
+            assert total == len([year for year in years
+                                 if decade <= year < decade + 10])
+        # cached; no additional queries
+        with self.assertNumQueries(0):
+            assert Book.pub_year_stats() == stats
+
+        # changes that don't affect publication year don't clear stats
+        book = Book.objects.first()
+        book.title = 'A new title'
+        book.save()
+        with self.assertNumQueries(0):
+            Book.pub_year_stats()
+
+        # new earliest publication year
+        book.pub_year = stats['min'] - 1
+        book.save()
+        assert Book.pub_year_stats()['min'] == stats['min'] - 1
+
+        # new book with a new latest year
+        new_book = Book.objects.create(title='Later', short_title='Later',
+                                       pub_year=stats['max'] + 1)
+        assert Book.pub_year_stats()['max'] == stats['max'] + 1
+        decade = (stats['max'] + 1) // 10 * 10
+        assert Book.pub_year_stats()['decades'][decade] == \
+            stats['decades'].get(decade, 0) + 1
+        new_book.delete()
+        assert Book.pub_year_stats()['max'] == stats['max']
+
+        # queryset deletes also update statistics
+        Book.objects.create(title='Later', short_title='Later',
+                            pub_year=stats['max'] + 1)
+        assert Book.pub_year_stats()['max'] == stats['max'] + 1
+        Book.objects.filter(short_title='Later').delete()
+        assert Book.pub_year_stats()['max'] == stats['max']
+
+    def test_pub_year_stats_timeout(self):
+        with patch('winthrop.books.models.cache') as mockcache:
+            mockcache.get.return_value = None
+            Book.pub_year_stats()
+            # cached with a backstop timeout
+            args = mockcache.set.call_args[0]
+            assert args[0] == Book.PUB_YEAR_STATS_CACHE_KEY
+            assert args[2] == Book.pub_year_stats_timeout
+
+    def test_pub_year_stats_request(self):
+        Book.pub_year_stats()
+        with patch('winthrop.books.models.cache') as mockcache:
+            mockcache.get.return_value = {'min': 1, 'max': 2, 'decades': {}}
+            with request_cache.scope():
+                Book.pub_year_stats()
+                Book.pub_year_stats()
+                # read from the cache once per request
+                assert mockcache.get.call_count == 1
+                # read again once cleared
+                Book.clear_pub_year_stats()
+                Book.pub_year_stats()
+                assert mockcache.get.call_count == 2
+
+    def test_index_field_values(self):
+        books = list(Book.objects.all())
+        Book.prep_index_chunk(books)
+        values = Book.index_field_values([book.pk for book in books],
+                                         Book.partial_index_fields)
+        # values match full index data for every book
+        for book in books:
+            index_data = book.index_data()
+            for field, value in values[book.index_id()].items():
+                assert value == index_data[field]
+            assert set(values[book.index_id()]) == set(Book.partial_index_fields)
+
+        # only requested fields are included
+        values = Book.index_field_values([books[0].pk], ['subject'])
+        assert values == {books[0].index_id(): {
+            'subject': [str(subj) for subj in books[0].subjects.all()]}}
+        # books that no longer exist are skipped
+        assert Book.index_field_values([-1], ['subject']) == {}
+
+        # fixed number of queries regardless of number of books
+        with self.assertNumQueries(5):
+            Book.index_field_values([book.pk for book in books],
+                                    Book.partial_index_fields)
 
     def test_index_id(self):
         book = Book.objects.all().first()
@@ -432,6 +609,46 @@ class TestBook(TestCase):
         assert str(alchemy) in index_data['subject']
         assert str(historia) in index_data['subject']
 
+    def test_prep_index_chunk(self):
+        # add annotations, thumbnail, languages, and subjects so all
+        # bulk-loaded data is exercised
+        book = Book.objects.first()
+        book.digital_edition = Manifest.objects.first()
+        book.save()
+        canvas = book.digital_edition.canvases.first()
+        canvas.thumbnail = True
+        canvas.save()
+        for person in Person.objects.all()[:2]:
+            Annotation.objects.create(author=person, canvas=canvas,
+                                      uri=canvas.uri)
+        book.add_editor(Person.objects.last())
+        BookLanguage.objects.create(
+            book=book, language=Language.objects.get(name='Latin'),
+            is_primary=True)
+        BookSubject.objects.create(
+            book=book, subject=Subject.objects.get(name='Alchemy'),
+            is_primary=True)
+
+        # bulk-loaded index data should be identical to per-object data
+        expected = {b.pk: b.index_data() for b in Book.objects.all()}
+        chunk = Book.prep_index_chunk(list(Book.objects.all()))
+        for prepped_book in chunk:
+            assert prepped_book.index_data() == expected[prepped_book.pk]
+
+        # number of queries should not depend on the number of books
+        books = list(Book.objects.all())
+        with CaptureQueriesContext(connection) as one_book_queries:
+            for prepped_book in Book.prep_index_chunk(books[:1]):
+                prepped_book.index_data()
+        with CaptureQueriesContext(connection) as all_book_queries:
+            for prepped_book in Book.prep_index_chunk(books):
+                prepped_book.index_data()
+        assert len(books) > 1
+        # (thumbnail lookup is skipped when no book has a digital edition)
+        assert len(all_book_queries) <= len(one_book_queries) + 1
+        # one query per related table, at most
+        assert len(all_book_queries) <= 8
+
     def test_generate_slug(self):
         # model method
         book = Book.objects.all().first()
@@ -457,6 +674,11 @@ class TestBook(TestCase):
         book.short_title = book.title
         assert book.generate_slug() == slugify(' '.join(book.short_title.split()[:5]))
 
+        # author can be specified, e.g. for unsaved books
+        unsaved = Book(short_title='Opera spiritualia', pub_year=1636)
+        assert unsaved.generate_slug(author='Drexel, Jeremias') == \
+            'drexel-opera-spiritualia-1636'
+
     def test_save(self):
         # save should generate slug if not set
         book = Book.objects.all().first()
@@ -493,6 +715,34 @@ class TestCatalogue(TestCase):
         cat.start_year = 1891
         assert '%s / %s (1891-)' % (bk, inst) == str(cat)
 
+    def test_detect_sammelbands(self):
+        inst = OwningInstitution.objects.get(short_name='NYSL')
+        call_numbers = ['Win 60a', 'Win 60b', 'Win 60', 'Win 61', 'Win 610',
+                        'Win 62a', 'Win 62c', '', '']
+        for i, call_number in enumerate(call_numbers):
+            book = Book.objects.create(title='Book %d' % i, short_title='Book %d' % i)
+            Catalogue.objects.create(institution=inst, book=book,
+                                     is_current=True, call_number=call_number)
+
+        assert Catalogue.sammelband_key('Win 60b') == 'Win 60'
+        # dry run: found but not updated; book loaded in the same query
+        with self.assertNumQueries(1):
+            sammelbands = Catalogue.detect_sammelbands(dry_run=True)
+            assert [cat.call_number for cat in sammelbands] == \
+                ['Win 60', 'Win 60a', 'Win 60b', 'Win 62a', 'Win 62c']
+            assert sammelbands[0].book.short_title == 'Book 2'
+        assert not Catalogue.objects.filter(is_sammelband=True).exists()
+
+        with self.assertNumQueries(2):
+            sammelbands = Catalogue.detect_sammelbands()
+        assert all(cat.is_sammelband for cat in sammelbands)
+        assert set(Catalogue.objects.filter(is_sammelband=True)) == set(sammelbands)
+
+        # limited to a queryset
+        sammelbands = Catalogue.detect_sammelbands(
+            Catalogue.objects.filter(call_number__startswith='Win 62'))
+        assert len(sammelbands) == 2
+
 ## tests for through models
 
 class TestBookSubject(TestCase):
@@ -1,22 +1,26 @@
+import csv
 from datetime import datetime
+import io
 import json
 import re
 from time import sleep
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from django.contrib.auth import get_user_model
 from django.http import JsonResponse
 from django.db.models import Q
 from django.template.defaultfilters import escape
-from django.test import TestCase
+from django.core.validators import ValidationError
+from django.test import RequestFactory, TestCase
 from django.urls import reverse
 import pytest
 from SolrClient.exceptions import SolrError
 
 from winthrop.annotation.models import Annotation
 from winthrop.books.forms import SearchForm
-from winthrop.books.models import Book
-from winthrop.common.solr import Indexable, PagedSolrQuery
+from winthrop.books.models import Book, Publisher
+from winthrop.books.views import BookExportView, BookListView
+from winthrop.common.solr import Indexable, IndexQueue, PagedSolrQuery
 from winthrop.common.views import LastModifiedMixin
 from winthrop.people.models import Person
 
@@ -263,6 +267,104 @@ class TestBookViews(TestCase):
         self.assertContains(response, '\"current\": %d' % \
             response.context['page_obj'].number)
 
+    @patch('winthrop.books.views.PagedSolrQuery')
+    def test_book_list_single_query(self, mockpsq):
+        view = BookListView()
+        view.request = RequestFactory().get(reverse('books:list'),
+                                            {'query': 'mercurii'})
+        view.kwargs = {}
+
+        # query options are only generated once per request
+        with patch.object(SearchForm, 'pub_date_minmax',
+                          return_value=(1500, 1700)) as mock_minmax:
+            opts = view.solr_query_opts()
+            minmax_calls = mock_minmax.call_count
+            assert view.solr_query_opts() == opts
+            assert mock_minmax.call_count == minmax_calls
+        assert opts['stats.field'] == '{!max=true}last_modified'
+
+        psq = view.get_queryset()
+        mockpsq.assert_called_with(opts)
+
+        # last modified comes from the stats returned with the results
+        view.object_list = psq
+        psq.get_stats.return_value = \
+            {'last_modified': {'max': '2018-07-23T00:00:00Z'}}
+        assert view.last_modified() == datetime(2018, 7, 23)
+        psq.get_stats.return_value = {'last_modified': {'max': None}}
+        assert view.last_modified() is None
+        psq.get_stats.side_effect = SolrError
+        assert view.last_modified() is None
+
+        # invalid form: error is cached, no solr query
+        view = BookListView()
+        view.request = RequestFactory().get(reverse('books:list'),
+                                            {'pub_year_0': '1500', 'pub_year_1': '1400'})
+        view.kwargs = {}
+        mockpsq.reset_mock()
+        view.object_list = view.get_queryset()
+        mockpsq.assert_not_called()
+        with pytest.raises(ValidationError):
+            view.solr_query_opts()
+        assert view.last_modified() is None
+
+    @patch('winthrop.books.views.PagedSolrQuery')
+    def test_book_export(self, mockpsq):
+        docs = [
+            {'id': 'book:1', 'title': 'Apocalypsis', 'author': ['Foord', 'Junius'],
+             'pub_year': 1597, 'is_annotated': True},
+            {'id': 'book:2', 'title': 'Psalms, with "notes"', 'subject': ['Bible']},
+        ]
+        mockpsq.return_value.iterate.return_value = iter(docs)
+        export_url = reverse('books:export')
+
+        # default format is newline-delimited json
+        response = self.client.get(export_url, {'query': 'psalms'})
+        assert response.status_code == 200
+        assert response.streaming
+        assert response['Content-Type'] == 'application/x-ndjson'
+        assert 'winthrop-books.ndjson' in response['Content-Disposition']
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        assert [json.loads(line) for line in lines] == docs
+        # same search options as the book list, with stored fields only
+        solr_opts = mockpsq.call_args[0][0]
+        assert solr_opts['q'] == 'text:(psalms)'
+        assert solr_opts['fl'] == ','.join(BookExportView.export_fields)
+        mockpsq.return_value.iterate.assert_called_with(
+            BookExportView.export_chunk_size)
+
+        # csv
+        mockpsq.return_value.iterate.return_value = iter(docs)
+        response = self.client.get(export_url, {'format': 'csv'})
+        assert response['Content-Type'] == 'text/csv; charset=utf-8'
+        content = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(io.StringIO(content)))
+        assert rows[0] == BookExportView.export_fields
+        row = dict(zip(rows[0], rows[1]))
+        assert row['author'] == 'Foord; Junius'
+        assert row['pub_year'] == '1597'
+        assert dict(zip(rows[0], rows[2]))['title'] == 'Psalms, with "notes"'
+
+        # no results
+        mockpsq.return_value.iterate.return_value = iter([])
+        response = self.client.get(export_url, {'format': 'csv'})
+        content = b''.join(response.streaming_content).decode()
+        assert content.strip() == ','.join(BookExportView.export_fields)
+
+        # bad format or invalid search
+        assert self.client.get(export_url, {'format': 'xml'}).status_code == 400
+        response = self.client.get(export_url,
+                                   {'pub_year_0': '1500', 'pub_year_1': '1400'})
+        assert response.status_code == 400
+
+        # query syntax error
+        def query_error(*args):
+            raise SolrError('Cannot parse query')
+            yield
+        mockpsq.return_value.iterate.side_effect = query_error
+        response = self.client.get(export_url, {'query': '"incomplete'})
+        assert response.status_code == 400
+
     @pytest.mark.usefixtures("solr")
     def test_book_detail(self):
         # find an annotated book with an author
@@ -314,35 +416,11 @@ class TestBookViews(TestCase):
         response = self.client.get(book.get_absolute_url())
         self.assertNotContains(response, "annotated")
 
-        # last modified header not set because not available from Solr
-        assert not response.has_header('last-modified')
-
-        # index to test last-modified logic
-        book.index(params={'commitWithin': 500})
-        sleep(2)
-
-         # no query or filters, should find all books
-        response = self.client.get(book.get_absolute_url())
-        assert response.status_code == 200
-        # last modified header should be set on response
+        # last modified header set from book modification time
         assert response.has_header('last-modified')
-
-        # no easy way to get last modification time from Solr...
-        index_modified = PagedSolrQuery({
-            'q': 'id:"%s"' % book.index_id(),
-            })[0]['last_modified']
-        index_modified_dt = LastModifiedMixin.solr_timestamp_to_datetime(index_modified)
-        modified = index_modified_dt.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        modified = book.updated.strftime('%a, %d %b %Y %H:%M:%S GMT')
         assert response['Last-Modified'] == modified
 
-        # solr error on getting last modified shouldn't break the page
-        with patch('winthrop.books.views.PagedSolrQuery') as mockpagedsolrq:
-            mockpagedsolrq.side_effect = SolrError
-            response = self.client.get(book.get_absolute_url())
-            # should return ok but with no last modified header
-            assert response.status_code == 200
-            assert not response.has_header('last-modified')
-
         # test book with translator
         book = Book.objects.filter(creator__creator_type__name='Translator').first()
         response = self.client.get(book.get_absolute_url())
@@ -372,6 +450,34 @@ class TestBookViews(TestCase):
         response = self.client.get(reverse('books:detail', args=['foo']))
         assert response.status_code == 404
 
+    def test_book_detail_cached(self):
+        book = Book.objects.first()
+        response = self.client.get(book.get_absolute_url())
+        self.assertContains(response, escape(book.title))
+
+        # update without changing modification time; cached page is used
+        Book.objects.filter(pk=book.pk).update(title='An updated title')
+        response = self.client.get(book.get_absolute_url())
+        self.assertNotContains(response, 'An updated title')
+
+        # marking the book as changed invalidates the cached page
+        Book.mark_changed([book.pk])
+        response = self.client.get(book.get_absolute_url())
+        self.assertContains(response, 'An updated title')
+
+        # so do changes to related data displayed on the page
+        publisher = Publisher.objects.create(name='Pub Lee')
+        book.publisher = publisher
+        book.save()
+        self.assertContains(self.client.get(book.get_absolute_url()), 'Pub Lee')
+        publisher.name = 'Publishing House'
+        publisher.save()
+        # indexing signal handlers are disconnected for tests
+        Book.handle_named_save(Mock(), publisher)
+        response = self.client.get(book.get_absolute_url())
+        self.assertContains(response, 'Publishing House')
+        IndexQueue.clear()
+
     @pytest.mark.usefixtures('solr')
     def test_book_facet_json(self):
 
@@ -440,16 +546,16 @@ class TestBookViews(TestCase):
         # simulate a solr error, both 500 and bad search
         with patch('winthrop.books.views.PagedSolrQuery') as mockpsq:
             # mock out the last_modified header for BookListView
-            mockpsq.return_value.__getitem__.return_value = \
-                {'last_modified': '2018-07-23T00:00:00Z'}
-            mockpsq.return_value.get_facets.side_effect = SolrError
+            mockpsq.return_value.get_stats.return_value = \
+                {'last_modified': {'max': '2018-07-23T00:00:00Z'}}
+            mockpsq.return_value.cached_facets.side_effect = SolrError
             mockpsq.return_value.count.return_value = 0
             response = self.client.get(url)
             # no error message asserting parsing issues
             assert response.status_code == 500
             assert response.json()['error'] == 'Something went wrong.'
             # mock out a parsing error
-            mockpsq.return_value.get_facets.side_effect = \
+            mockpsq.return_value.cached_facets.side_effect = \
                 SolrError('Cannot parse')
             response = self.client.get(url)
             assert response.status_code == 400
@@ -7,6 +7,7 @@ from winthrop.books import views
 urlpatterns = [
     url(r'^$', views.BookListView.as_view(), name='list'),
     url(r'^facets/$', views.BookFacetJSONView.as_view(), name='facets'),
+    url(r'^export/$', views.BookExportView.as_view(), name='export'),
     url(r'^(?P<slug>[-\w]+)/$', views.BookDetailView.as_view(), name='detail'),
     url(r'^(?P<slug>[-\w]+)/pages/$', views.BookPageView.as_view(), name='pages'),
     url(r'^autocomplete/publisher/$', staff_member_required(views.PublisherAutocomplete.as_view()),
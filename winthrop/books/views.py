@@ -1,27 +1,46 @@
+import csv
+import io
+import itertools
+import json
+
 from dal import autocomplete
 from django.core.validators import ValidationError
-from django.db.models import Q, Count
-from django.http import JsonResponse, Http404
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse, Http404, HttpResponseBadRequest, \
+    StreamingHttpResponse
 from django.views.generic import ListView, DetailView
 from django.shortcuts import get_object_or_404
 from djiffy.models import Canvas
 from SolrClient.exceptions import SolrError
 
+from winthrop.annotation.models import CanvasAnnotationCount
 from winthrop.books.models import Book, Publisher, Language, Subject
 from winthrop.books.forms import SearchForm
-from winthrop.common.solr import PagedSolrQuery
-from winthrop.common.views import LastModifiedListMixin, LastModifiedMixin, \
-    VaryOnHeadersMixin
+from winthrop.common.solr import PagedSolrQuery, SolrPaginator, \
+    index_generation, index_settled
+from winthrop.common.views import CachedResponseMixin, LastModifiedListMixin, \
+    LastModifiedMixin, VaryOnHeadersMixin
 
 
 
-class BookListView(ListView, LastModifiedListMixin, VaryOnHeadersMixin):
+class BookListView(CachedResponseMixin, ListView, LastModifiedListMixin,
+                   VaryOnHeadersMixin):
     model = Book
     template_name = 'books/book_list.html'
     paginate_by = 50
+    paginator_class = SolrPaginator
     form_class = SearchForm
     form = None
     vary_headers = ['X-Requested-With']
+    #: cached solr query options (or validation error) for the current request
+    _solr_opts = None
+
+    def cache_version(self):
+        '''Cache search results until the index changes, but not while
+        recent changes may not yet be visible in Solr'''
+        if index_settled():
+            return index_generation()
 
     def get_template_names(self):
         # when queried via ajax, return partial html for just the results section
@@ -31,6 +50,21 @@ class BookListView(ListView, LastModifiedListMixin, VaryOnHeadersMixin):
         return self.template_name
 
     def solr_query_opts(self):
+        '''Solr query options for the current request, based on the
+        search form.  Options are generated once per request, so that form
+        validation and the publication date range lookup are not repeated.
+        Raises :class:`~django.core.validators.ValidationError` if the
+        form is not valid.'''
+        if self._solr_opts is None:
+            try:
+                self._solr_opts = self.build_solr_query_opts()
+            except ValidationError as err:
+                self._solr_opts = err
+        if isinstance(self._solr_opts, ValidationError):
+            raise self._solr_opts
+        return self._solr_opts.copy()
+
+    def build_solr_query_opts(self):
         # NOTE: solr query logic used by both the view and to generate
         # last-modified value for header/conditional display
 
@@ -154,7 +188,11 @@ class BookListView(ListView, LastModifiedListMixin, VaryOnHeadersMixin):
             'hl': True,
             'hl.fl': 'text',
             'hl.snippets': 3,
-            'hl.method': 'unified'
+            'hl.method': 'unified',
+            # most recent modification time for last-modified header,
+            # returned with the search results
+            'stats': True,
+            'stats.field': '{!max=true}last_modified',
         }
         solr_opts.update(range_opts)
         return solr_opts
@@ -177,7 +215,10 @@ class BookListView(ListView, LastModifiedListMixin, VaryOnHeadersMixin):
 
             # populate form field choices based on facets
             # (may not actually be displayed except as a fallback and for testing)
-            self.form.set_choices_from_facets(self.object_list.get_facets())
+            # (uses facets from the current response, and shares them with
+            # the facet json view via the facet cache)
+            self.form.set_choices_from_facets(
+                self.object_list.cached_facets()['facets'])
 
             # temporarily include highlights to test search index customization
             # retrieve inside try/except in case of syntax errro
@@ -199,28 +240,21 @@ class BookListView(ListView, LastModifiedListMixin, VaryOnHeadersMixin):
         return context
 
     def last_modified(self):
-        '''override last modified logic to work with Solr'''
-        try:
-            query_opts = self.solr_query_opts()
-        except ValidationError:
+        '''last modification time for the current search results,
+        from the stats returned with the search query'''
+        # not set if the form is not valid
+        if not hasattr(self.object_list, 'get_stats'):
             return
 
-        # override sort to return most recent modification date,
-        # only return last modified value and nothing else
-        query_opts.update({
-            'sort': 'last_modified desc',
-            'fl': 'last_modified'
-        })
-
         # if a syntax or other solr error happens, no date to return
         try:
-            psq = PagedSolrQuery(query_opts)
+            last_modified = self.object_list.get_stats() \
+                .get('last_modified', {}).get('max')
+        except SolrError:
+            return
+        if last_modified:
             # Solr stores date in isoformat; convert to datetime
-            return self.solr_timestamp_to_datetime(psq[0]['last_modified'])
-            # skip extra call to Solr to check count and just grab the first
-            # item if it exists
-        except (IndexError, SolrError):
-            pass
+            return self.solr_timestamp_to_datetime(last_modified)
 
 
 class BookFacetJSONView(BookListView):
@@ -230,15 +264,12 @@ class BookFacetJSONView(BookListView):
         # skip normal context handling and only return count and facets
 
         try:
-            return {
-                'total': self.object_list.count(),
-                'facets': self.object_list.get_facets(),
-                'range_facets': self.object_list.get_facets_ranges()
-            }
+            # facets for the same search are cached until the index changes
+            return self.object_list.cached_facets()
         except (SolrError, AttributeError) as err:
             # NOTE: AttributeError will occur if form is not valid,
             # because an empty Book django queryset is returned instead of a
-            # a PagedSolrQuery, so get_facets method etc is not available
+            # a PagedSolrQuery, so cached_facets method etc is not available
 
             error_msg = 'Something went wrong.'
             self.error_code = 500
@@ -256,23 +287,102 @@ class BookFacetJSONView(BookListView):
         return response
 
 
-class BookDetailView(DetailView, LastModifiedMixin):
-    model = Book
+class BookExportView(BookListView):
+    '''Export all results for a book search, using the same search
+    parameters as :class:`BookListView`, as newline-delimited JSON (the
+    default) or CSV.  Results are retrieved from Solr in chunks with
+    cursor deep paging and streamed, so memory use does not depend on
+    the number of results.  Exported fields come from stored Solr fields
+    only, without any database queries.'''
+
+    #: stored solr fields included in the export, in order
+    export_fields = ['id', 'slug', 'title', 'short_title', 'author', 'editor',
+                     'translator', 'pub_year', 'publisher', 'pub_place',
+                     'language', 'subject', 'annotator', 'is_annotated']
+    #: export formats and content types
+    export_formats = {
+        'ndjson': 'application/x-ndjson',
+        'csv': 'text/csv; charset=utf-8',
+    }
+    #: number of results to retrieve from Solr per request
+    export_chunk_size = 500
+    #: separator for multivalued fields in CSV output
+    csv_separator = '; '
+
+    def cache_version(self):
+        # streamed responses are never cached
+        return None
 
     def last_modified(self):
-        '''book model doesn't track update; get last index modification from Solr instead'''
+        # no single response for the full result set
+        return None
 
-        # if there is a solr error, skip last-modified behavior and display page
+    def get(self, request, *args, **kwargs):
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in self.export_formats:
+            return HttpResponseBadRequest('Unsupported export format')
         try:
-            psq = PagedSolrQuery({
-                'q': 'id:"%s"' % self.object.index_id(),
-                'fl': 'last_modified'
-            })
-            if psq.count():
-                # Solr stores date in isoformat; convert to datetime
-                return self.solr_timestamp_to_datetime(psq[0]['last_modified'])
-        except SolrError:
-            pass
+            solr_opts = self.solr_query_opts()
+        except ValidationError:
+            return HttpResponseBadRequest('Search form is not valid')
+        solr_opts['fl'] = ','.join(self.export_fields)
+
+        docs = PagedSolrQuery(solr_opts).iterate(self.export_chunk_size)
+        # retrieve the first chunk before streaming, so that query errors
+        # can be reported
+        try:
+            docs = itertools.chain([next(docs)], docs)
+        except StopIteration:
+            docs = iter([])
+        except SolrError as solr_err:
+            if 'Cannot parse' in str(solr_err):
+                return HttpResponseBadRequest(
+                    'Unable to parse search query; please revise and try again.')
+            raise
+
+        if export_format == 'csv':
+            content = self.csv_rows(docs)
+        else:
+            content = ('%s\n' % json.dumps(doc) for doc in docs)
+        response = StreamingHttpResponse(
+            content, content_type=self.export_formats[export_format])
+        response['Content-Disposition'] = \
+            'attachment; filename="winthrop-books.%s"' % export_format
+        return response
+
+    def csv_rows(self, docs):
+        '''Generate CSV output for a header row and one row per result'''
+        # write each row to a buffer and yield it, rather than
+        # accumulating the whole file
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        rows = itertools.chain([self.export_fields], (
+            [self.csv_separator.join(str(val) for val in doc[field])
+             if isinstance(doc.get(field), list) else doc.get(field, '')
+             for field in self.export_fields]
+            for doc in docs))
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+
+class BookDetailView(CachedResponseMixin, DetailView, LastModifiedMixin):
+    model = Book
+
+    def cache_version(self):
+        '''Cache the rendered page until the book or any of its
+        related data is modified'''
+        updated = Book.objects.filter(slug=self.kwargs.get('slug')) \
+                              .values_list('updated', flat=True).first()
+        if updated:
+            return updated.timestamp()
+
+    def last_modified(self):
+        '''last modification time for the book, including changes to
+        related data that is included in the index'''
+        return self.object.updated
 
 class BookPageView(ListView):
     model = Canvas
@@ -281,22 +391,28 @@ class BookPageView(ListView):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        # filter canvas based on book slug, and annotate with annotation counts
-        # so template can display indicators for text and graphic annotations
+        # filter canvas based on book slug, and include precomputed
+        # annotation counts so template can display indicators for
+        # text and graphic annotations
         return qs.filter(manifest__book__slug=self.kwargs['slug']) \
-                 .annotate(textual_annotation=Count('annotation', filter=Q(annotation__text='')),
-                           graphical_annotation=Count('annotation', filter=Q(annotation__text__ne=''))) \
-                 .values('iiif_image_id', 'label', 'textual_annotation', 'graphical_annotation')
+                 .values('iiif_image_id', 'label',
+                         textual_annotation=Coalesce(
+                             'annotation_count__textual_annotation', 0),
+                         graphical_annotation=Coalesce(
+                             'annotation_count__graphical_annotation', 0))
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # add book to context for title display and link to main book page
         # 404 if book does not exist or does not have a digital editon
         book = get_object_or_404(Book, slug=self.kwargs['slug'])
-        if not book.digital_edition:
+        if not book.digital_edition_id:
             raise Http404
 
-        context['book'] = book
+        context.update({
+            'book': book,
+            'annotation_totals': CanvasAnnotationCount.totals(book.digital_edition_id)
+        })
         return context
 
 
@@ -7,4 +7,6 @@ class CommonConfig(AppConfig):
     def ready(self):
         # import and connect signal handlers for Solr indexing
         from winthrop.common.signals import IndexableSignalHandler
+        # register system checks
+        from winthrop.common import checks
 
@@ -0,0 +1,406 @@
+'''
+Utilities for benchmark and performance regression tests: a synthetic
+data generator that scales to production-sized data, a local stub Solr
+server, and a context manager to measure database queries, Solr requests
+and wall time against a budget.
+
+Benchmark tests are marked with ``pytest.mark.benchmark``; data size is
+controlled by the **WINTHROP_BENCHMARK_SCALE** environment variable,
+where 1.0 generates 10,000 books, 5,000 people and 100,000 annotations.
+'''
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import random
+import socketserver
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.text import slugify
+from djiffy.models import Canvas, Manifest
+
+from winthrop.annotation.models import Annotation, CanvasAnnotationCount
+from winthrop.annotation.vocabulary import VocabularyRegistry
+from winthrop.books.models import Book, BookLanguage, BookSubject, \
+    Catalogue, Creator, CreatorType, Language, OwningInstitution, \
+    PersonBook, PersonBookRelationshipType, Publisher, Subject
+from winthrop.people.autocomplete import PersonNameIndex
+from winthrop.people.models import Person
+from winthrop.places.models import Place
+
+
+logger = logging.getLogger(__name__)
+
+
+#: number of items generated for each type of content at scale 1.0
+FULL_SCALE = {
+    'books': 10000,
+    'people': 5000,
+    'annotations': 100000,
+}
+
+
+def benchmark_scale():
+    '''Scale for generated benchmark data, from the
+    **WINTHROP_BENCHMARK_SCALE** environment variable; defaults to 0.01.'''
+    return float(os.environ.get('WINTHROP_BENCHMARK_SCALE', 0.01))
+
+
+class SyntheticData(object):
+    '''Generate synthetic books, people, digital editions and annotations
+    for benchmarking.  Data is generated with bulk inserts and a fixed
+    random seed, so that generated content is the same every time.
+
+    :param books: number of books
+    :param people: number of people
+    :param annotations: number of annotations
+    '''
+
+    #: fraction of books with a digital edition
+    digitized_ratio = 0.2
+    #: number of canvases in each digital edition
+    canvases_per_edition = 20
+    #: number of publishers, places, subjects and languages to use
+    vocabulary_size = 25
+    #: batch size for bulk inserts
+    batch_size = 500
+
+    def __init__(self, books=100, people=50, annotations=1000, seed=0):
+        self.num_books = books
+        self.num_people = people
+        self.num_annotations = annotations
+        self.random = random.Random(seed)
+
+    @classmethod
+    def at_scale(cls, scale=None, **kwargs):
+        '''Initialize with counts based on the given scale, or
+        :meth:`benchmark_scale` if not specified.'''
+        if scale is None:
+            scale = benchmark_scale()
+        counts = dict((key, max(1, int(count * scale)))
+                      for key, count in FULL_SCALE.items())
+        counts.update(kwargs)
+        return cls(**counts)
+
+    def generate(self):
+        '''Generate and save all data; returns a dictionary of counts'''
+        start = time.time()
+        self.vocabulary()
+        self.people()
+        self.books()
+        self.digital_editions()
+        self.annotations()
+        logger.info('Generated %d books, %d people, %d annotations in %.2fs',
+                    self.num_books, self.num_people, self.num_annotations,
+                    time.time() - start)
+        return {
+            'books': self.num_books,
+            'people': self.num_people,
+            'annotations': self.num_annotations,
+        }
+
+    def vocabulary(self):
+        '''Places, publishers, subjects, languages, and an owning
+        institution'''
+        size = self.vocabulary_size
+        Place.objects.bulk_create([
+            Place(name='Place %d' % i, latitude=i, longitude=-i,
+                  geonames_id='http://sws.geonames.org/%d/' % i)
+            for i in range(size)])
+        Publisher.objects.bulk_create([
+            Publisher(name='Publisher %d' % i) for i in range(size)])
+        Subject.objects.bulk_create([
+            Subject(name='Subject %d' % i) for i in range(size)])
+        Language.objects.bulk_create([
+            Language(name='Language %d' % i) for i in range(size)])
+        # bulk create doesn't send signals to update annotation vocabularies
+        VocabularyRegistry.invalidate('subjects', 'languages')
+        self.places = list(Place.objects.all())
+        self.publishers = list(Publisher.objects.all())
+        self.subjects = list(Subject.objects.all())
+        self.languages = list(Language.objects.all())
+        self.institution = OwningInstitution.objects.create(
+            name='Benchmark Library', short_name='Benchmark',
+            contact_info='', place=self.places[0])
+
+    def people(self):
+        Person.objects.bulk_create([
+            Person(authorized_name='Person %d, Synthetic' % i,
+                   sort_name='Person %d' % i)
+            for i in range(self.num_people)], batch_size=self.batch_size)
+        PersonNameIndex.invalidate()
+        self.person_ids = list(Person.objects.values_list('pk', flat=True))
+
+    def books(self):
+        rand = self.random
+        Book.objects.bulk_create([
+            Book(title='Synthetic book %d' % i, short_title='Book %d' % i,
+                 slug=slugify('synthetic book %d' % i),
+                 pub_year=rand.randint(1500, 1750),
+                 publisher=rand.choice(self.publishers),
+                 pub_place=rand.choice(self.places),
+                 is_annotated=rand.random() < 0.5)
+            for i in range(self.num_books)], batch_size=self.batch_size)
+        self.book_ids = list(Book.objects.values_list('pk', flat=True))
+        # bulk inserts bypass save; publication years have changed
+        Book.clear_pub_year_stats()
+
+        author = CreatorType.objects.get_or_create(name='Author')[0]
+        owner = PersonBookRelationshipType.objects.get_or_create(
+            name='Owner')[0]
+        Creator.objects.bulk_create([
+            Creator(book_id=book_id, person_id=rand.choice(self.person_ids),
+                    creator_type=author)
+            for book_id in self.book_ids], batch_size=self.batch_size)
+        BookSubject.objects.bulk_create([
+            BookSubject(book_id=book_id, subject=rand.choice(self.subjects),
+                        is_primary=True)
+            for book_id in self.book_ids], batch_size=self.batch_size)
+        BookLanguage.objects.bulk_create([
+            BookLanguage(book_id=book_id, language=rand.choice(self.languages),
+                         is_primary=True)
+            for book_id in self.book_ids], batch_size=self.batch_size)
+        Catalogue.objects.bulk_create([
+            Catalogue(book_id=book_id, institution=self.institution,
+                      call_number='BM %d' % book_id, is_current=True)
+            for book_id in self.book_ids], batch_size=self.batch_size)
+        PersonBook.objects.bulk_create([
+            PersonBook(book_id=book_id, person_id=rand.choice(self.person_ids),
+                       relationship_type=owner)
+            for book_id in self.book_ids[::10]], batch_size=self.batch_size)
+        # annotators are people with an interaction with a book
+        VocabularyRegistry.invalidate('annotators')
+
+    def digital_editions(self):
+        num_editions = max(1, int(self.num_books * self.digitized_ratio))
+        Manifest.objects.bulk_create([
+            Manifest(label='Digital edition %d' % i, short_id='bm%d' % i,
+                     uri='https://iiif.example.com/bm%d/manifest' % i)
+            for i in range(num_editions)], batch_size=self.batch_size)
+        manifests = list(Manifest.objects.all())
+        canvases = []
+        for manifest in manifests:
+            for i in range(self.canvases_per_edition):
+                canvases.append(Canvas(
+                    manifest=manifest, label='p. %d' % i, order=i,
+                    short_id='%s-%d' % (manifest.short_id, i),
+                    uri='%s/canvas/%d' % (manifest.uri, i),
+                    iiif_image_id='https://iiif.example.com/%s-%d' %
+                                  (manifest.short_id, i),
+                    thumbnail=(i == 0)))
+        Canvas.objects.bulk_create(canvases, batch_size=self.batch_size)
+
+        # associate digital editions with the first books
+        for book_id, manifest in zip(self.book_ids, manifests):
+            Book.objects.filter(pk=book_id).update(digital_edition=manifest)
+        self.canvases = list(Canvas.objects.values_list('pk', 'uri'))
+
+    def annotations(self):
+        rand = self.random
+        annotations = []
+        for i in range(self.num_annotations):
+            canvas_id, uri = rand.choice(self.canvases)
+            annotations.append(Annotation(
+                canvas_id=canvas_id, uri=uri,
+                author_id=rand.choice(self.person_ids),
+                # mix of textual and graphical annotations
+                text='' if i % 3 else 'annotation text %d' % i,
+                quote='quoted text %d' % i))
+            if len(annotations) >= self.batch_size:
+                Annotation.objects.bulk_create(annotations)
+                annotations = []
+        Annotation.objects.bulk_create(annotations)
+        # bulk create doesn't send signals to update annotation counts
+        CanvasAnnotationCount.rebuild()
+
+
+class _ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SolrStubServer(object):
+    '''Minimal local stand-in for Solr, for benchmarking without Solr
+    response time.  Documents sent to the update handler are kept in
+    memory and returned in order from the select handler, with empty
+    facets and highlighting, so that timing reflects the application
+    rather than Solr.  Use as a context manager, and configure
+    **SOLR_CONNECTIONS** with :attr:`config`.'''
+
+    collection = 'benchmark'
+
+    def __init__(self):
+        self.docs = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = _ThreadedHTTPServer(('127.0.0.1', 0),
+                                          self._handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/solr/' % self.server.server_address
+
+    @property
+    def config(self):
+        '''Solr connection configuration for the stub server'''
+        return {'URL': self.url, 'COLLECTION': self.collection}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def select(self, params):
+        '''Response for a search request'''
+        start = int(params.get('start', [0])[0])
+        rows = int(params.get('rows', [10])[0])
+        # cursor marks are simply the offset of the next result
+        cursor = params.get('cursorMark', [None])[0]
+        if cursor is not None:
+            start = 0 if cursor == '*' else int(cursor)
+        with self.lock:
+            docs = list(self.docs.values())
+        response = {
+            'responseHeader': {'status': 0, 'QTime': 0},
+            'response': {'numFound': len(docs), 'start': start,
+                         'docs': docs[start:start + rows]},
+        }
+        if cursor is not None:
+            response['nextCursorMark'] = str(min(start + rows, len(docs)))
+        if params.get('facet', [''])[0] == 'true':
+            facet_fields = {}
+            for field in params.get('facet.field', []):
+                # use output key for local params, e.g. {!ex=a key=b}c
+                if field.startswith('{!') and 'key=' in field:
+                    field = field.split('key=')[1].split('}')[0].split()[0]
+                facet_fields[field] = []
+            response['facet_counts'] = {
+                'facet_queries': {},
+                'facet_fields': facet_fields,
+                'facet_ranges': dict(
+                    (field, {'counts': [], 'gap': 1, 'start': 0, 'end': 0})
+                    for field in params.get('facet.range', [])),
+            }
+        if 'stats.field' in params:
+            modified = [doc.get('last_modified') for doc in docs
+                        if doc.get('last_modified')]
+            response['stats'] = {'stats_fields': {
+                'last_modified': {'max': max(modified) if modified else None}
+            }}
+        if 'hl' in params:
+            response['highlighting'] = {}
+        return response
+
+    def update(self, params, body):
+        '''Response for an update request'''
+        data = json.loads(body.decode('utf-8')) if body else None
+        with self.lock:
+            if isinstance(data, list):
+                for doc in data:
+                    self.docs[doc['id']] = doc
+            elif isinstance(data, dict) and 'delete' in data:
+                delete = data['delete']
+                if 'id' in delete:
+                    self.docs.pop(delete['id'], None)
+                elif delete.get('query') == '*:*':
+                    self.docs.clear()
+        return {'responseHeader': {'status': 0, 'QTime': 0}}
+
+    def _handler_class(self):
+        stub = self
+
+        class SolrStubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                length = int(self.headers.get('content-length') or 0)
+                body = self.rfile.read(length) if length else b''
+                with stub.lock:
+                    stub.requests.append(url.path)
+                if url.path.endswith('/select'):
+                    data = stub.select(params)
+                elif url.path.endswith('/update'):
+                    data = stub.update(params, body)
+                else:
+                    self.send_error(404)
+                    return
+                content = json.dumps(data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = handle_request
+
+            def log_message(self, *args):
+                # don't log every request to stderr
+                pass
+
+        return SolrStubHandler
+
+
+class BudgetExceeded(AssertionError):
+    '''Raised when a measured operation exceeds its budget'''
+
+
+#: measurements recorded in the current process, by name
+results = {}
+
+
+@contextmanager
+def measure(name, max_queries=None, max_solr_requests=None, max_seconds=None,
+            solr_stub=None):
+    '''Context manager to record database queries, Solr requests and
+    wall time for a block of code, and raise :class:`BudgetExceeded` if
+    any budget is exceeded.  Time budgets are only enforced when the
+    **WINTHROP_BENCHMARK_ENFORCE_TIME** environment variable is set, since
+    timing varies widely across machines.  Measurements are logged and
+    stored in :data:`results`.'''
+    solr_start = len(solr_stub.requests) if solr_stub else 0
+    with CaptureQueriesContext(connection) as queries:
+        start = time.time()
+        yield
+        elapsed = time.time() - start
+
+    measurement = {
+        'queries': len(queries),
+        'seconds': elapsed,
+    }
+    if solr_stub:
+        measurement['solr_requests'] = len(solr_stub.requests) - solr_start
+    results[name] = measurement
+    logger.info('%s: %d queries, %.3fs', name, measurement['queries'],
+                elapsed)
+
+    errors = []
+    if max_queries is not None and measurement['queries'] > max_queries:
+        errors.append('%d queries (budget %d)' %
+                      (measurement['queries'], max_queries))
+    if max_solr_requests is not None and \
+      measurement.get('solr_requests', 0) > max_solr_requests:
+        errors.append('%d Solr requests (budget %d)' %
+                      (measurement['solr_requests'], max_solr_requests))
+    if max_seconds is not None and elapsed > max_seconds and \
+      os.environ.get('WINTHROP_BENCHMARK_ENFORCE_TIME'):
+        errors.append('%.3fs (budget %.3fs)' % (elapsed, max_seconds))
+    if errors:
+        raise BudgetExceeded('%s exceeded budget: %s' % (name, '; '.join(errors)))
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+
+#: cache backends that are not shared between processes
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def cache_is_shared(alias='default'):
+    '''Check whether the configured cache is shared between processes,
+    so that values and invalidations set in one process (e.g. a
+    manage command or another web worker) are visible to the others.'''
+    backend = settings.CACHES.get(alias, {}).get('BACKEND', '')
+    return backend not in PROCESS_LOCAL_CACHES
+
+
+@register()
+def check_shared_cache(app_configs, **kwargs):
+    '''Warn when the default cache is process-local; cached pages,
+    facets and lookups would not be invalidated across processes.'''
+    if cache_is_shared():
+        return []
+    return [Warning(
+        'The default cache is not shared between processes',
+        hint='Configure a shared cache backend (database, memcached) in '
+             'CACHES so that index and lookup cache invalidation is '
+             'visible to every process.',
+        id='winthrop.W001',
+    )]
@@ -0,0 +1,124 @@
+'''
+Persistent on-disk cache for the results of external API lookups
+(e.g. VIAF and GeoNames), so that repeated imports don't need to
+make the same network requests again.  Values are stored as JSON in
+a SQLite database, configured with **LOOKUP_CACHE_PATH** in django
+settings.
+'''
+import json
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+class LookupCache(object):
+    '''Key/value store for lookup results, persisted in SQLite.  Keys
+    are grouped by namespace (e.g. ``viaf_suggest``), and values can be
+    anything that can be serialized as JSON, including None (e.g. to
+    remember that a lookup found nothing).  Safe to use from multiple
+    threads.
+
+    :param namespace: namespace for keys in this cache
+    :param path: path to the SQLite database; defaults to
+        **LOOKUP_CACHE_PATH**
+    :param timeout: default number of seconds before values expire;
+        None to keep values indefinitely
+    :param max_entries: maximum number of values to keep in this
+        namespace; when exceeded, expired values are removed first, then
+        the values that were cached least recently.  None for no limit.
+    '''
+
+    #: marker for cache misses, since None is a valid value
+    missing = object()
+
+    def __init__(self, namespace, path=None, timeout=None, max_entries=None):
+        self.namespace = namespace
+        self.path = path or settings.LOOKUP_CACHE_PATH
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS lookup_cache ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, '
+                'expires REAL, PRIMARY KEY (namespace, key))')
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, key, default=None):
+        '''Get a cached value, or `default` if not cached or expired'''
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        '''Get cached values for a list of keys; returns a dict with
+        only the keys that are cached.'''
+        keys = list(keys)
+        values = {}
+        now = time.time()
+        with self._lock:
+            # stay under the SQLite limit on query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute(
+                    'SELECT key, value, expires FROM lookup_cache '
+                    'WHERE namespace = ? AND key IN (%s)' %
+                    ', '.join('?' * len(chunk)), [self.namespace] + chunk)
+                for key, value, expires in rows:
+                    if expires is None or expires > now:
+                        values[key] = json.loads(value)
+        return values
+
+    def set(self, key, value, timeout=missing):
+        '''Cache a value; `timeout` overrides the default timeout.'''
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout=missing):
+        '''Cache a dict of values, in a single transaction.'''
+        if timeout is self.missing:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO lookup_cache VALUES (?, ?, ?, ?)',
+                [(self.namespace, key, json.dumps(value), expires)
+                 for key, value in data.items()])
+            if self.max_entries is not None:
+                self._cull()
+
+    def _cull(self):
+        '''Remove values over :attr:`max_entries`; expects to be called
+        with the lock held, inside a transaction.'''
+        count = self._db.execute(
+            'SELECT COUNT(*) FROM lookup_cache WHERE namespace = ?',
+            [self.namespace]).fetchone()[0]
+        if count <= self.max_entries:
+            return
+        count -= self._db.execute(
+            'DELETE FROM lookup_cache WHERE namespace = ? AND expires <= ?',
+            [self.namespace, time.time()]).rowcount
+        if count > self.max_entries:
+            # replaced values get a new rowid, so rowid order is the
+            # order in which values were cached
+            self._db.execute(
+                'DELETE FROM lookup_cache WHERE rowid IN (SELECT rowid '
+                'FROM lookup_cache WHERE namespace = ? ORDER BY rowid LIMIT ?)',
+                [self.namespace, count - self.max_entries])
+
+    def delete(self, key):
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM lookup_cache WHERE namespace = ? AND key = ?',
+                [self.namespace, key])
+
+    def __contains__(self, key):
+        return self.get(key, self.missing) is not self.missing
@@ -13,25 +13,73 @@ Example usage::
     python manage.py index
     # index specific items
     python manage.py index htid1 htid2 htid3
-    # index works only (skip pages)
-    python manage.py index -i works
-    python manage.py index --works
-    # index pages only (skip works)
-    python manage.py index -i pages
-    python manage.py index ---pages
+    # index books only (skip annotations)
+    python manage.py index -i books
+    # index annotations only (skip books)
+    python manage.py index -i annotations
     # suppress progressbar
     python manage.py index --no-progress
+    # index in parallel using four worker processes
+    python manage.py index --workers 4
+    # index only items changed since a date or time
+    python manage.py index --since 2018-07-01
+    python manage.py index --since "2018-07-01 12:30"
+    # index only items changed since the last indexing run
+    python manage.py index --incremental
+
+With ``--workers``, the primary keys of each indexable model are split
+into ranges that are indexed by separate worker processes, each with its
+own database connection, so that database reads and Solr updates for
+different ranges run concurrently.  Errors are reported for each range
+that fails; the index is committed once at the end.
+
+With ``--since`` or ``--incremental``, only items with an ``updated``
+time on or after the specified time (or, for ``--incremental``, the
+start of the last successful full or incremental run for the selected
+content) are reindexed; models without an ``updated`` field are
+reindexed in full.  Run times are recorded in the database.  If there
+is no record of a previous run (e.g. the index was cleared), a warning
+is displayed and everything is indexed.  Solr documents that no longer
+correspond to any item in the database are removed.
 
 '''
 
+from multiprocessing import Pool
+
+from datetime import datetime
 
+from django.apps import apps
+from django.db import connections, models
+from django.core.exceptions import FieldDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 import progressbar
 # from urllib3.exceptions import HTTPError
 #from SolrClient.exceptions import ConnectionError
 #from requests.exceptions import RequestException
 
-from winthrop.common.solr import get_solr_connection, Indexable
+from winthrop.common.models import IndexRun
+from winthrop.common.solr import get_solr_connection, reset_solr_connections, \
+    index_changed, index_cleared, Indexable, PagedSolrQuery
+
+
+def index_pk_range(task):
+    '''Index items for a single model with primary keys in an inclusive
+    range.  Run in a worker process when indexing in parallel; takes a
+    tuple of model label, first pk, last pk, number of items in the range,
+    and Solr params.  Returns a tuple of model label, first pk, last pk,
+    number of items indexed, and error message (None on success).'''
+    model_label, first_pk, last_pk, total, params = task
+    model = apps.get_model(model_label)
+    items = model.objects.filter(pk__gte=first_pk, pk__lte=last_pk) \
+                         .order_by('pk')
+    try:
+        count = Indexable.index_items(items, params=params)
+    except Exception as err:
+        return (model_label, first_pk, last_pk, 0, str(err))
+    return (model_label, first_pk, last_pk, count, None)
+
 
 class Command(BaseCommand):
     '''Reindex digitized items into Solr that have already been imported'''
@@ -49,37 +97,88 @@ class Command(BaseCommand):
     #: solr params for index call; currently set to commit within 3 seconds
     solr_index_opts = {"commitWithin": 3000}
 
+    #: number of ids to retrieve from Solr at once when checking for orphans
+    solr_id_chunk_size = 1000
+
     def add_arguments(self, parser):
-        # todo: generate based on Indexable subclasses?
-        # parser.add_argument(
-        #     '-i', '--index', choices=['all', 'works', 'pages'], default='all',
-        #     help='Index only works or pages (by default indexes all)')
-        # parser.add_argument(
-        #     '-w', '--works', dest='index', const='works', action='store_const',
-        #     help='Index works only')
-        # parser.add_argument(
-        #     '-p', '--pages', dest='index', const='pages', action='store_const',
-        #     help='Index pages only')
+        parser.add_argument(
+            '-i', '--index', default='all',
+            choices=['all'] + [self.indexable_name(model)
+                               for model in Indexable.__subclasses__()],
+            help='Index only one kind of content (by default indexes all)')
         parser.add_argument(
             '--no-progress', action='store_true',
             help='Do not display progress bar to track the status of the reindex.')
         parser.add_argument(
             '-c', '--clear', action='store_true',
             help='Remove items from Solr before indexing.')
+        parser.add_argument(
+            '-w', '--workers', type=int, default=1,
+            help='Number of worker processes to index in parallel (default: 1)')
+        parser.add_argument(
+            '--since', type=self.parse_since,
+            help='Only index items changed since the specified date or time, '
+                 'and remove items no longer in the database')
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only index items changed since the last indexing run, '
+                 'and remove items no longer in the database')
+
+    @staticmethod
+    def parse_since(value):
+        '''Parse a date or date and time for the since option; times
+        without a timezone use the current timezone.'''
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is None:
+                raise ValueError('Invalid date: %s' % value)
+            since = datetime(date.year, date.month, date.day)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    @staticmethod
+    def indexable_name(model):
+        '''Name used to select an indexable model with the index option,
+        e.g. `books`'''
+        if hasattr(model, '_meta'):
+            return str(model._meta.verbose_name_plural)
+        return model.__name__.lower()
+
+    def indexables(self):
+        '''Indexable models selected by the index option'''
+        selected = self.options.get('index') or 'all'
+        return [model for model in Indexable.__subclasses__()
+                if selected == 'all' or self.indexable_name(model) == selected]
 
     def handle(self, *args, **kwargs):
         self.solr, self.solr_collection = get_solr_connection()
         self.verbosity = kwargs.get('verbosity', self.v_normal)
         self.options = kwargs
+        # changes made while indexing are picked up by the next run
+        started = timezone.now()
 
         if self.options.get('clear', False):
             self.clear_index()
 
+        since = self.options.get('since')
+        incremental = since is not None
+        if self.options.get('incremental'):
+            incremental = True
+            since = self.last_indexed()
+            if since is None:
+                self.stderr.write('No record of a previous indexing run; '
+                                  'indexing everything')
+
         total_to_index = 0
-        for model in Indexable.__subclasses__():
+        for model in self.indexables():
             # total works to be indexed;
             # currently assuming all indexables are django models
-            total_to_index += model.objects.count()
+            if since is not None and self.tracks_updates(model):
+                total_to_index += self.items_to_index(model, since).count()
+            else:
+                total_to_index += model.objects.count()
 
         # initialize progressbar if requested and indexing more than 5 items
         progbar = None
@@ -87,14 +186,37 @@ class Command(BaseCommand):
             progbar = progressbar.ProgressBar(redirect_stdout=True,
                                               max_value=total_to_index)
 
-        for model in Indexable.__subclasses__():
-            # index in chunks and update progress bar
-            self.index(model.objects.all(), progbar=progbar)
+        errors = []
+        workers = self.options.get('workers') or 1
+        for model in self.indexables():
+            # index in chunks and update progress bar;
+            # pk ranges can only be split for django models
+            if workers > 1 and since is None and isinstance(model, type) and \
+              issubclass(model, models.Model):
+                errors.extend(self.index_parallel(model, workers, progbar=progbar))
+            else:
+                self.index(self.items_to_index(model, since), progbar=progbar)
 
         if progbar:
             progbar.finish()
 
+        if incremental:
+            removed = self.remove_orphans()
+            if removed and self.verbosity >= self.v_normal:
+                self.stdout.write('Removed %d item(s) no longer in the database'
+                                  % removed)
+
+        # commit once, even if some ranges failed
         self.solr.commit(self.solr_collection)
+        index_changed()
+
+        if errors:
+            raise CommandError('Failed to index %d range(s)' % len(errors))
+
+        # record successful runs that cover all changes, as the starting
+        # point for the next incremental run
+        if since is None or self.options.get('incremental'):
+            self.record_last_run(started)
 
     def index(self, index_data, progbar=None):
         '''index an iterable into the configured solr instance
@@ -116,8 +238,127 @@ class Command(BaseCommand):
             # connection errors
             raise CommandError(err)
 
+    @staticmethod
+    def tracks_updates(model):
+        '''Check if an indexable model has an `updated` time field'''
+        try:
+            model._meta.get_field('updated')
+            return True
+        except (AttributeError, FieldDoesNotExist):
+            return False
+
+    @classmethod
+    def items_to_index(cls, model, since=None):
+        '''Items to be indexed for an indexable model; if a since time is
+        specified and the model tracks an `updated` time, only items
+        updated on or after that time.'''
+        if since is not None and cls.tracks_updates(model):
+            return model.objects.filter(updated__gte=since)
+        return model.objects.all()
+
+    def last_indexed(self):
+        '''Start time of the last successful full or incremental indexing
+        run for all of the selected content, as an aware datetime; None
+        if there is no record of one for any of it.  Unlike the last
+        modified time in Solr, this isn't moved forward by live index
+        updates, so changes whose live update failed are still included.'''
+        names = [self.indexable_name(model) for model in self.indexables()]
+        last_runs = IndexRun.objects.filter(content__in=names) \
+                                    .values_list('started', flat=True)
+        if len(last_runs) == len(names):
+            return min(last_runs)
+
+    def record_last_run(self, started):
+        '''Record the start time of a successful indexing run for the
+        selected content'''
+        for model in self.indexables():
+            IndexRun.objects.update_or_create(
+                content=self.indexable_name(model),
+                defaults={'started': started})
+
+    def clear_last_run(self):
+        '''Remove the record of previous indexing runs for the selected
+        content, so that the next incremental run indexes everything'''
+        IndexRun.objects.filter(content__in=[
+            self.indexable_name(model) for model in self.indexables()]).delete()
+
+    def solr_ids(self):
+        '''Generator of all ids currently in the Solr index, using
+        cursor paging rather than increasing start offsets'''
+        query = PagedSolrQuery({'q': '*:*', 'fl': 'id'})
+        for doc in query.iterate(chunk_size=self.solr_id_chunk_size):
+            yield doc['id']
+
+    def remove_orphans(self):
+        '''Remove any items from the Solr index that no longer correspond
+        to an item in the database.  Returns the number of items removed.'''
+        db_ids = set()
+        for model in Indexable.__subclasses__():
+            # currently only possible for django models
+            if not (isinstance(model, type) and issubclass(model, models.Model)):
+                continue
+            db_ids.update(model(pk=pk).index_id() for pk in
+                          model.objects.values_list('pk', flat=True))
+
+        orphans = [solr_id for solr_id in self.solr_ids()
+                   if solr_id not in db_ids]
+        # removed in batches
+        return Indexable.remove_index_ids(orphans, params=self.solr_index_opts)
+
+    @staticmethod
+    def pk_ranges(model, size):
+        '''Split the primary keys for a model into inclusive ranges of at
+        most `size` items.  Returns a list of tuples of first pk, last pk,
+        and number of items in the range.'''
+        pks = list(model.objects.order_by('pk').values_list('pk', flat=True))
+        return [(pks[i], pks[min(i + size, len(pks)) - 1],
+                 len(pks[i:i + size]))
+                for i in range(0, len(pks), size)]
+
+    def index_parallel(self, model, workers, progbar=None):
+        '''Index all items for a model using a pool of worker processes,
+        one pk range at a time.  Updates the progress bar as ranges are
+        completed and returns a list of error messages for any ranges
+        that could not be indexed.'''
+        # use several ranges per worker so progress is reported
+        # regularly and slow ranges don't hold up the other workers;
+        # but no smaller than a single indexing chunk
+        total = model.objects.count()
+        size = max(Indexable.index_chunk_size, -(-total // (workers * 4)))
+        tasks = [(model._meta.label, first_pk, last_pk, count, self.solr_index_opts)
+                 for first_pk, last_pk, count in self.pk_ranges(model, size)]
+
+        # close database and solr connections before starting worker
+        # processes, so that each worker opens its own connections
+        connections.close_all()
+        reset_solr_connections()
+
+        errors = []
+        # progress bar is shared across models; start from current value
+        count = progbar.value if progbar else 0
+        with Pool(workers) as pool:
+            for label, first_pk, last_pk, indexed, error in \
+              pool.imap_unordered(index_pk_range, tasks):
+                if error:
+                    msg = 'Error indexing %s %s-%s: %s' % \
+                        (label, first_pk, last_pk, error)
+                    self.stderr.write(msg)
+                    errors.append(msg)
+                count += indexed
+                if progbar:
+                    progbar.update(count)
+        return errors
+
     def clear_index(self):
         # NOTE might be nice to report how many items were deleted,
         # but would require before/after queries
-        self.solr.delete_doc_by_query(self.solr_collection, '*:*',
+        query = '*:*'
+        if (self.options.get('index') or 'all') != 'all':
+            # only remove the kind of content being indexed
+            query = 'content_type:(%s)' % ' OR '.join(
+                '"%s"' % model._meta for model in self.indexables())
+        self.solr.delete_doc_by_query(self.solr_collection, query,
                                       params={'commitWithin': 1000})
+        index_cleared({'commitWithin': 1000})
+        # incremental runs can't start from before the index was cleared
+        self.clear_last_run()
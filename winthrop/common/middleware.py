@@ -0,0 +1,30 @@
+from winthrop.common import request_cache
+from winthrop.common.solr import IndexQueue
+
+
+class RequestCacheMiddleware(object):
+    '''Middleware to memoize values read from the shared cache (e.g.
+    index and lookup versions) for the duration of each request, so
+    that they are read at most once per request.  See
+    :mod:`winthrop.common.request_cache`.'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with request_cache.scope():
+            return self.get_response(request)
+
+
+class IndexQueueMiddleware(object):
+    '''Middleware to defer Solr index updates until the end of the
+    request, so that all of the objects changed while handling a request
+    (e.g., an admin save with inlines) are indexed in a single batch.
+    See :class:`~winthrop.common.solr.IndexQueue`.'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with IndexQueue.deferred():
+            return self.get_response(request)
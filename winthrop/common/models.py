@@ -83,3 +83,19 @@ class DateRange(models.Model):
         if self.start_year and self.end_year and \
                 not self.end_year >= self.start_year:
             raise ValidationError('End year must be after start year')
+
+
+class IndexRun(models.Model):
+    '''Start time of the last successful full or incremental Solr
+    indexing run for one kind of indexable content, used as the starting
+    point for the next incremental run; see the **index** manage
+    command.  Kept in the database rather than the cache, so that it
+    isn't lost when cache entries are culled.'''
+
+    #: name of the indexed content, e.g. `books`
+    content = models.CharField(max_length=255, unique=True)
+    #: start time of the indexing run
+    started = models.DateTimeField()
+
+    def __str__(self):
+        return '%s indexed %s' % (self.content, self.started)
@@ -0,0 +1,57 @@
+'''
+Per-request memo for values read from the shared django cache, such as
+the version numbers of in-process indexes and lookups.  With a shared
+cache backend (e.g. the database cache) every read is a round trip, so
+values that are checked repeatedly while handling a request are read
+at most once per request.  Requests are scoped by
+:class:`~winthrop.common.middleware.RequestCacheMiddleware`; code that
+runs outside a request (e.g. manage commands) can use :func:`scope` to
+group related work, and otherwise reads from the cache every time.
+'''
+from contextlib import contextmanager
+import threading
+
+
+_local = threading.local()
+
+
+@contextmanager
+def scope():
+    '''Memoize values for the duration of a block.  Nested scopes share
+    the values of the outermost scope.'''
+    if getattr(_local, 'values', None) is not None:
+        yield
+        return
+    _local.values = {}
+    try:
+        yield
+    finally:
+        _local.values = None
+
+
+def memoize(key, load):
+    '''Get the value for `key` in the current scope, calling `load` to
+    get it if it hasn't been loaded yet.  Outside of a scope, `load` is
+    called every time.'''
+    values = getattr(_local, 'values', None)
+    if values is None:
+        return load()
+    if key not in values:
+        values[key] = load()
+    return values[key]
+
+
+def remember(key, value):
+    '''Set the value for `key` in the current scope, e.g. after changing
+    it in the shared cache; does nothing outside of a scope.'''
+    values = getattr(_local, 'values', None)
+    if values is not None:
+        values[key] = value
+
+
+def forget(key):
+    '''Remove any value for `key` from the current scope, so that it is
+    loaded again on next use.'''
+    values = getattr(_local, 'values', None)
+    if values is not None:
+        values.pop(key, None)
@@ -2,7 +2,7 @@ import logging
 
 from django.db import models
 
-from winthrop.common.solr import Indexable
+from winthrop.common.solr import Indexable, IndexQueue
 
 
 logger = logging.getLogger(__name__)
@@ -10,28 +10,32 @@ logger = logging.getLogger(__name__)
 
 class IndexableSignalHandler:
 
-    index_within = 3
+    index_within = IndexQueue.index_within
 
-    index_params = {'commitWithin': index_within * 1000}
+    index_params = IndexQueue.index_params
 
     connected = False
 
+    # NOTE: handlers add changed objects to the index queue rather than
+    # updating Solr directly; the queue is flushed in a single batch
+    # when the current transaction (or request) completes
+
     def handle_save(sender, instance, **kwargs):
         if isinstance(instance, Indexable):
-            logger.debug('Indexing %r', instance)
-            instance.index(params=IndexableSignalHandler.index_params)
+            logger.debug('Queueing %r for indexing', instance)
+            IndexQueue.add(instance)
 
     def handle_delete(sender, instance, **kwargs):
-        logger.debug('Deleting %r from index', instance)
         if isinstance(instance, Indexable):
-            instance.remove_from_index(params=IndexableSignalHandler.index_params)
+            logger.debug('Queueing %r for removal from index', instance)
+            IndexQueue.add(instance)
 
     def handle_relation_change(sender, instance, action, **kwargs):
         # handle add, remove, and clear for indexable instances
         if action in ['post_add', 'post_remove', 'post_clear']:
             if isinstance(instance, Indexable):
-                logger.debug('Indexing %r (m2m change)', instance)
-                instance.index(params=IndexableSignalHandler.index_params)
+                logger.debug('Queueing %r for indexing (m2m change)', instance)
+                IndexQueue.add(instance)
 
     def connect():
         '''bind indexing signal handlers to save and delete signals for
@@ -50,12 +54,13 @@ class IndexableSignalHandler:
             models.signals.m2m_changed.connect(IndexableSignalHandler.handle_relation_change,
                                                sender=m2m_rel)
 
-        for model, options in Indexable.related.items():
-            for model_signal in ['pre_save', 'post_save', 'pre_delete', 'post_delete']:
-                if model_signal in options:
-                    signal = getattr(models.signals, model_signal)
-                    logger.debug('Registering %s signal handler for %s', model_signal, model)
-                    signal.connect(options[model_signal], sender=model)
+        for model, options_list in Indexable.related.items():
+            for options in options_list:
+                for model_signal in ['pre_save', 'post_save', 'pre_delete', 'post_delete']:
+                    if model_signal in options:
+                        signal = getattr(models.signals, model_signal)
+                        logger.debug('Registering %s signal handler for %s', model_signal, model)
+                        signal.connect(options[model_signal], sender=model)
 
 
     def disconnect():
@@ -70,12 +75,13 @@ class IndexableSignalHandler:
             models.signals.m2m_changed.disconnect(IndexableSignalHandler.handle_relation_change,
                                                   sender=m2m_rel)
 
-        for model, options in Indexable.related.items():
-            for model_signal in ['pre_save', 'post_save', 'pre_delete', 'post_delete']:
-                if model_signal in options:
-                    signal = getattr(models.signals, model_signal)
-                    logger.debug('Disconnecting %s signal handler for %s', model_signal, model)
-                    signal.disconnect(options[model_signal], sender=model)
+        for model, options_list in Indexable.related.items():
+            for options in options_list:
+                for model_signal in ['pre_save', 'post_save', 'pre_delete', 'post_delete']:
+                    if model_signal in options:
+                        signal = getattr(models.signals, model_signal)
+                        logger.debug('Disconnecting %s signal handler for %s', model_signal, model)
+                        signal.disconnect(options[model_signal], sender=model)
 
 
 IndexableSignalHandler.connect()
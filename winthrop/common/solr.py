@@ -1,14 +1,27 @@
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+import hashlib
 import itertools
 import json
 import logging
+import queue
+import threading
+import time
 
-from cached_property import cached_property
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connection, transaction
 from django.db.models.fields.related_descriptors import ManyToManyDescriptor, \
     ReverseManyToOneDescriptor
 from django.db.models.query import QuerySet
 import requests
+from requests.adapters import HTTPAdapter
 from SolrClient import SolrClient
+from urllib3.util.retry import Retry
+
+from winthrop.common.checks import cache_is_shared
 
 
 logger = logging.getLogger(__name__)
@@ -17,16 +30,202 @@ logger = logging.getLogger(__name__)
 ### NOTE: solr code copied & adapted from PPA, hope to generalize ###
 
 
+class SolrSession(requests.Session):
+    '''A :class:`requests.Session` for Solr connections, with a pool of
+    keep-alive HTTP connections, optional retries with backoff, and a
+    default timeout for every request.'''
+
+    #: default number of connections to keep open per Solr host
+    pool_size = 10
+    #: default timeout in seconds; a single value or (connect, read) tuple
+    timeout = 30
+    #: default number of times to retry a failed request
+    retries = 0
+    #: default backoff factor between retries, in seconds
+    backoff_factor = 0.2
+    #: status codes that should be retried
+    retry_status = (502, 503, 504)
+
+    def __init__(self, pool_size=None, timeout=None, retries=None,
+                 backoff_factor=None):
+        super().__init__()
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff_factor is not None:
+            self.backoff_factor = backoff_factor
+
+        retry_opts = {
+            'total': self.retries,
+            'backoff_factor': self.backoff_factor,
+            'status_forcelist': self.retry_status,
+            'raise_on_status': False,
+        }
+        # queries and updates by id are safe to repeat, so allow retries
+        # for any request method (option name depends on urllib3 version)
+        try:
+            retry = Retry(allowed_methods=None, **retry_opts)
+        except TypeError:
+            retry = Retry(method_whitelist=None, **retry_opts)
+
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, *args, **kwargs):
+        # SolrClient doesn't pass a timeout, so set the default here
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+    def connection_stats(self):
+        '''Number of HTTP connections opened and requests sent for all
+        the connection pools currently in use by this session'''
+        stats = {'connections': 0, 'requests': 0}
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    stats['connections'] += pool.num_connections
+                    stats['requests'] += pool.num_requests
+        return stats
+
+
+#: Solr clients shared by all threads in the current process, by configuration
+_solr_clients = {}
+_solr_clients_lock = threading.Lock()
+
+
 def get_solr_connection():
-    '''Initialize a Solr connection using project settings'''
+    '''Get a Solr connection using project settings.  Returns a
+    :class:`SolrClient` and the configured collection name.
+
+    Clients are shared across the current process (one per configuration),
+    so that keep-alive HTTP connections are reused rather than opened for
+    every request.  In addition to **URL** and **COLLECTION**, the
+    **SOLR_CONNECTIONS** configuration may specify **POOL_SIZE**,
+    **TIMEOUT**, **RETRIES**, and **BACKOFF_FACTOR**; see
+    :class:`SolrSession` for defaults.'''
     # TODO: error handling on config not present?
     solr_config = settings.SOLR_CONNECTIONS['default']
-    solr = SolrClient(solr_config['URL'])
     # NOTE: may want to extend SolrClient to set a default collection
     solr_collection = solr_config['COLLECTION']
+
+    key = json.dumps(solr_config, sort_keys=True)
+    solr = _solr_clients.get(key)
+    if solr is None:
+        with _solr_clients_lock:
+            solr = _solr_clients.get(key)
+            if solr is None:
+                solr = SolrClient(solr_config['URL'])
+                # replace the default transport session with a pooled one
+                solr.transport.session = SolrSession(
+                    pool_size=solr_config.get('POOL_SIZE'),
+                    timeout=solr_config.get('TIMEOUT'),
+                    retries=solr_config.get('RETRIES'),
+                    backoff_factor=solr_config.get('BACKOFF_FACTOR'))
+                _solr_clients[key] = solr
     return solr, solr_collection
 
 
+def reset_solr_connections():
+    '''Close and discard all shared Solr clients, e.g. before starting
+    worker processes, so that HTTP connections are not shared across
+    processes.'''
+    with _solr_clients_lock:
+        for solr in _solr_clients.values():
+            solr.transport.session.close()
+        _solr_clients.clear()
+
+
+def solr_connection_stats():
+    '''Connection metrics for the shared Solr clients in the current
+    process: number of connections opened, number of requests sent,
+    and number of requests that reused an existing connection.'''
+    stats = {'connections': 0, 'requests': 0}
+    for solr in list(_solr_clients.values()):
+        for stat, value in solr.transport.session.connection_stats().items():
+            stats[stat] += value
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+#: cache key for the index generation counter
+INDEX_GENERATION_KEY = 'solr_index_generation'
+#: cache key for the time when the most recent index changes are visible
+INDEX_SETTLED_KEY = 'solr_index_settled'
+
+
+def index_generation():
+    '''Current index generation; incremented by :func:`index_changed`
+    whenever content is indexed or removed, so that cached query data
+    can be keyed on it.'''
+    generation = cache.get(INDEX_GENERATION_KEY)
+    if generation is None:
+        # start from the current time rather than zero, so that a
+        # counter lost from the cache doesn't reuse old generations
+        cache.add(INDEX_GENERATION_KEY, int(time.time()), None)
+        generation = cache.get(INDEX_GENERATION_KEY)
+    return generation
+
+
+def index_changed(params=None):
+    '''Record a change to the index: increment the index generation and
+    note when the change will be visible in search results, based on the
+    `commitWithin` value in Solr params (if any).'''
+    try:
+        cache.incr(INDEX_GENERATION_KEY)
+    except ValueError:
+        # not yet set (or no longer in the cache); start a new generation
+        cache.set(INDEX_GENERATION_KEY, int(time.time()), None)
+    commit_within = (params or {}).get('commitWithin') or 0
+    cache.set(INDEX_SETTLED_KEY, time.time() + commit_within / 1000, None)
+
+
+#: cache key for the current set of cached indexed documents
+INDEXED_DOCS_EPOCH_KEY = 'solr_indexed_docs_epoch'
+
+
+def indexed_docs_epoch():
+    '''Current epoch for cached fingerprints of indexed documents (see
+    :meth:`Indexable.indexed_doc_key`); changed by
+    :func:`discard_indexed_docs`.'''
+    epoch = cache.get(INDEXED_DOCS_EPOCH_KEY)
+    if epoch is None:
+        cache.add(INDEXED_DOCS_EPOCH_KEY, int(time.time()), None)
+        epoch = cache.get(INDEXED_DOCS_EPOCH_KEY)
+    return epoch
+
+
+def discard_indexed_docs():
+    '''Stop using cached fingerprints of previously indexed documents as
+    the basis for partial updates, e.g. because documents were reindexed
+    in bulk without recording them.'''
+    try:
+        cache.incr(INDEXED_DOCS_EPOCH_KEY)
+    except ValueError:
+        cache.set(INDEXED_DOCS_EPOCH_KEY, int(time.time()), None)
+
+
+def index_cleared(params=None):
+    '''Record that all content has been removed from the index, so that
+    cached fingerprints of previously indexed documents are no longer
+    used as the basis for partial updates.'''
+    discard_indexed_docs()
+    index_changed(params)
+
+
+def index_settled():
+    '''Check that recent index changes are visible in search results;
+    query data should not be cached for the current generation until
+    they are.'''
+    return time.time() >= (cache.get(INDEX_SETTLED_KEY) or 0)
+
+
 class SolrSchema(object):
     '''Solr Schema object.  Includes project schema configuration and
     methods to update configured Solr instance.'''
@@ -123,6 +322,18 @@ class SolrSchema(object):
         {'name': 'pub_place', 'type': 'text_en', 'required': False},
         {'name': 'original_pub_info', 'type': 'text_en', 'required': False},
         {'name': 'notes', 'type': 'text_en', 'required': False},
+        # annotation fields
+        {'name': 'annotation_text', 'type': 'text_en', 'required': False},
+        {'name': 'quote', 'type': 'text_en', 'required': False},
+        {'name': 'text_translation', 'type': 'text_en', 'required': False},
+        {'name': 'anchor_translation', 'type': 'text_en', 'required': False},
+        {'name': 'tag', 'type': 'text_en', 'required': False,
+         'multiValued': True},
+        {'name': 'anchor_language', 'type': 'text_en', 'required': False,
+         'multiValued': True},
+        {'name': 'canvas_label', 'type': 'string', 'required': False},
+        {'name': 'book_id', 'type': 'int', 'required': False},
+        {'name': 'book_slug', 'type': 'string', 'required': False},
 
         # stored = true while testing spelling variation support
         {'name': 'text', 'type': 'text_en', 'required': False, 'stored': True,
@@ -147,13 +358,19 @@ class SolrSchema(object):
         {'name': 'subject_exact', 'type': 'string', 'required': False,
          'multiValued': True},
         {'name': 'annotator_exact', 'type': 'string', 'required': False,
-         'multiValued': True}
+         'multiValued': True},
+        {'name': 'tag_exact', 'type': 'string', 'required': False,
+         'multiValued': True},
+        {'name': 'anchor_language_exact', 'type': 'string', 'required': False,
+         'multiValued': True},
 
     ]
     #: fields to be copied into general purpose text field for searching
     text_fields = ['title', 'short_title', 'author', 'pub_year', 'editor',
                    'translator', 'subject', 'publisher', 'pub_place',
-                   'original_pub_info', 'notes', 'annotator']
+                   'original_pub_info', 'notes', 'annotator',
+                   'annotation_text', 'quote', 'text_translation',
+                   'anchor_translation', 'tag']
     #: copy fields, e.g. for facets
     copy_fields = [
         # ('title', 'title_exact'),
@@ -163,8 +380,15 @@ class SolrSchema(object):
         ('language', 'language_exact'),
         ('subject', 'subject_exact'),
         ('annotator', 'annotator_exact'),
+        ('tag', 'tag_exact'),
+        ('anchor_language', 'anchor_language_exact'),
     ]
 
+    @classmethod
+    def copy_field_destinations(cls):
+        '''Names of fields that are populated by Solr copy fields'''
+        return ['text'] + [dest for src, dest in cls.copy_fields]
+
     def __init__(self):
         self.solr, self.solr_collection = get_solr_connection()
         logger.info('Using %s core.', self.solr_collection)
@@ -262,22 +486,174 @@ class CoreAdmin(object):
 
 class PagedSolrQuery(object):
     '''A Solr query object that wraps a :mod:`SolrClient` query in a way
-    that allows search results to be paginated by django paginator.'''
+    that allows search results to be paginated by django paginator.
+
+    Query objects are not modified by slicing; :meth:`set_limits` returns
+    a new query.  Solr responses are cached per instance by result window
+    (start, rows), so that a slice, the total count, facets, highlighting,
+    and stats can all be served from the same Solr request; facets and
+    highlighting always correspond to the most recently retrieved slice.
+    Use :class:`SolrPaginator` to retrieve each page of results with a
+    single request.'''
 
     query_opts = {}
-    _result = None
 
     def __init__(self, query_opts=None):
         self.solr, self.solr_collection = get_solr_connection()
 
-        self.query_opts = query_opts or {}
+        self.query_opts = dict(query_opts or {})
         # possibly should default to 'q': '*:*' ...
 
+        #: cached solr responses, keyed by result window (start, rows)
+        self._result_cache = OrderedDict()
+        #: parsed json responses, keyed by result window
+        self._raw_response_cache = {}
+        #: result window for the response currently in use
+        self._window = None
+
+    def _clone(self, **opts):
+        '''Return a copy of this query with updated query options and
+        no cached results.'''
+        query_opts = self.query_opts.copy()
+        query_opts.update(opts)
+        return self.__class__(query_opts)
+
+    @property
+    def _default_window(self):
+        return (self.query_opts.get('start'), self.query_opts.get('rows'))
+
+    def _fetch(self, start, rows):
+        '''Get the solr response for a result window, querying solr
+        only if it is not already cached, and make it the current response.'''
+        window = (start, rows)
+        if window not in self._result_cache:
+            query_opts = self.query_opts
+            if window != self._default_window:
+                query_opts = dict(query_opts, start=start or 0, rows=rows)
+            self._result_cache[window] = self.solr.query(self.solr_collection,
+                                                         query_opts)
+        self._window = window
+        return self._result_cache[window]
+
+    def _find_window(self, start, stop):
+        '''Find a cached result window that includes results from start
+        up to (but not including) stop.'''
+        for window in self._result_cache:
+            window_start, window_rows = window
+            # solr default number of rows is not known
+            if window_rows is None:
+                continue
+            window_start = window_start or 0
+            if window_start <= start and stop <= window_start + window_rows:
+                return window
+
+    def prefetch(self, start, stop, cursor=False):
+        '''Retrieve a window of results, unless already cached, so that
+        slices within it and the total count are served without another
+        Solr request.  If `cursor` is True and the query is sorted, use
+        Solr cursors for sequential access (see :meth:`_fetch_cursor`).'''
+        window = self._find_window(start, stop)
+        if window is not None:
+            self._window = window
+        elif cursor and self.cursor_paging:
+            self._fetch_cursor(start, stop - start)
+        else:
+            self._fetch(start, stop - start)
+
+    #: timeout for cached cursor marks, in seconds; cursor marks are also
+    #: invalidated whenever the index changes
+    cursor_cache_timeout = 60 * 60
+
+    @property
+    def cursor_paging(self):
+        '''Whether results can be retrieved with cursor marks; requires
+        an explicit sort and no result grouping.'''
+        return bool(self.query_opts.get('sort')) and \
+            'group' not in self.query_opts
+
+    @staticmethod
+    def cursor_sort(sort):
+        '''Add the unique key to a sort as a tiebreak, as required for
+        Solr cursors.'''
+        sort_fields = [part.split()[0] for part in (sort or '').split(',')
+                       if part.strip()]
+        if 'id' in sort_fields:
+            return sort
+        return '%s, id asc' % sort if sort else 'id asc'
+
+    def cursor_cache_key(self, start):
+        '''Cache key for the cursor mark pointing to result number
+        `start`, based on the current index generation and the query
+        options that determine which results are found and their order.'''
+        opts = dict((opt, value) for opt, value in self.query_opts.items()
+                    if opt != 'rows' and
+                    not opt.startswith(self.iterate_exclude_opts))
+        digest = hashlib.md5(json.dumps(opts, sort_keys=True, default=str)
+                             .encode('utf-8')).hexdigest()
+        return 'solr_cursor:%s:%s:%d' % (index_generation(), digest, start)
+
+    def _fetch_cursor(self, start, rows):
+        '''Get the solr response for a result window using a cursor mark,
+        so that paging through results sequentially doesn't get slower as
+        the offset grows.  The cursor mark for the following window is
+        cached, so the next page (e.g. in a subsequent request) can
+        continue from it; windows with no cached cursor mark fall back to
+        an offset, with the same sort so that results are consistent.'''
+        cursor = '*' if start == 0 else cache.get(self.cursor_cache_key(start))
+        query_opts = dict(self.query_opts, rows=rows,
+                          sort=self.cursor_sort(self.query_opts['sort']))
+        if cursor is None:
+            query_opts['start'] = start
+        else:
+            # solr doesn't allow an offset with a cursor
+            query_opts.pop('start', None)
+            query_opts['cursorMark'] = cursor
+
+        window = (start, rows)
+        response = self.solr.query(self.solr_collection, query_opts)
+        self._result_cache[window] = response
+        self._window = window
+
+        next_cursor = response.data.get('nextCursorMark') if cursor else None
+        # don't cache cursors that may not include recent changes
+        if next_cursor and next_cursor != cursor and index_settled():
+            cache.set(self.cursor_cache_key(start + rows), next_cursor,
+                      self.cursor_cache_timeout)
+        return response
+
     @property
     def result(self):
-        if self._result is None:
-            self.get_results()
-        return self._result
+        '''Current Solr response; queries Solr with the configured
+        options if no response has been retrieved yet.'''
+        if self._window is None:
+            return self._fetch(*self._default_window)
+        return self._result_cache[self._window]
+
+    #: prefixes for query options that are not used when iterating
+    #: through all results
+    iterate_exclude_opts = ('start', 'facet', 'hl', 'stats', 'f.')
+
+    def iterate(self, chunk_size=500):
+        '''Generator over all results for this query, using Solr cursor
+        deep paging to retrieve `chunk_size` documents per request.
+        Results are not cached, so memory use is bounded by the chunk
+        size; facets, highlighting and stats are not requested.  The
+        unique key is added to the sort, since cursors require it.'''
+        query_opts = dict((opt, value) for opt, value in self.query_opts.items()
+                          if not opt.startswith(self.iterate_exclude_opts))
+        query_opts.update({'sort': self.cursor_sort(query_opts.get('sort')),
+                           'rows': chunk_size})
+
+        cursor = '*'
+        while True:
+            query_opts['cursorMark'] = cursor
+            response = self.solr.query(self.solr_collection, dict(query_opts))
+            yield from response.docs
+            next_cursor = response.data.get('nextCursorMark')
+            # the cursor doesn't change once all results are returned
+            if not response.docs or not next_cursor or next_cursor == cursor:
+                break
+            cursor = next_cursor
 
     def get_facets(self):
         '''Wrap SolrClient.SolrResponse.get_facets() to get query facets as a dict
@@ -289,35 +665,79 @@ class PagedSolrQuery(object):
         of dicts.'''
         return self.result.get_facets_ranges()
 
+    #: query options that determine facet results
+    facet_opts = ['q', 'fq', 'facet', 'facet.field', 'facet.limit',
+                  'facet.sort', 'facet.range']
+    #: timeout for cached facets, in seconds; facets are also invalidated
+    #: whenever the index changes
+    facet_cache_timeout = 60 * 60 * 24
+
+    def facet_cache_key(self):
+        '''Cache key for facet data, based on the current index generation
+        and the normalized query options that determine facets'''
+        opts = {}
+        for opt, value in self.query_opts.items():
+            # include per-field facet options, e.g. facet range start and end
+            if opt in self.facet_opts or \
+              (opt.startswith('f.') and '.facet.' in opt):
+                # order of filters and facet fields doesn't matter
+                if isinstance(value, (list, tuple)):
+                    value = sorted(str(val) for val in value)
+                opts[opt] = value
+        digest = hashlib.md5(json.dumps(opts, sort_keys=True, default=str)
+                             .encode('utf-8')).hexdigest()
+        return 'solr_facets:%s:%s' % (index_generation(), digest)
+
+    def cached_facets(self):
+        '''Facets, range facets, and total count for this query, shared
+        across requests via the django cache.  Cached values are used
+        until the index changes; uses the current response if there is
+        one, otherwise queries Solr.'''
+        cache_key = self.facet_cache_key()
+        data = cache.get(cache_key)
+        if data is None:
+            data = {
+                'total': self.count(),
+                'facets': self.get_facets(),
+                'range_facets': self.get_facets_ranges()
+            }
+            # don't cache results that may not include recent changes
+            if index_settled():
+                cache.set(cache_key, data, self.facet_cache_timeout)
+        return data
+
     def get_results(self):
         '''
         Return results of the Solr query.
 
         :return: docs as a list of dictionaries.
         '''
-        self._result = self.solr.query(self.solr_collection, self.query_opts)
-        return self._result.docs
+        return self._fetch(*self._default_window).docs
 
     def count(self):
         '''Total number of results in the query'''
-        if self._result is None:
-            query_opts = self.query_opts.copy()
-            query_opts['rows'] = 0
-            # FIXME: do we actually want to store the result with no rows?
-            self._result = self.solr.query(self.solr_collection, query_opts)
-
-        return self._result.get_num_found()
+        # total is the same for every window; use any cached response
+        if self._window is not None:
+            return self.result.get_num_found()
+        # if limits have been set, retrieve results and count together
+        if 'rows' in self.query_opts:
+            return self.result.get_num_found()
+        # otherwise, only get the count (facets are still included)
+        return self._fetch(self.query_opts.get('start'), 0).get_num_found()
 
     def get_json(self):
         '''Return query response as JSON data, to allow full access to anything
         included in Solr data.'''
         return self.result.get_json()
 
-    @cached_property
+    @property
     def raw_response(self):
         '''Return the raw Solr result to provide access to return sections
         not exposed by SolrClient'''
-        return json.loads(self.get_json())
+        result = self.result
+        if self._window not in self._raw_response_cache:
+            self._raw_response_cache[self._window] = json.loads(result.get_json())
+        return self._raw_response_cache[self._window]
 
     def get_expanded(self):
         '''get the expanded results from a collapsed query'''
@@ -327,14 +747,24 @@ class PagedSolrQuery(object):
         '''get highlighting results from the response'''
         return self.raw_response.get('highlighting', {})
 
+    def get_stats(self):
+        '''get stats component results from the response, by field'''
+        return self.raw_response.get('stats', {}).get('stats_fields', {})
+
     def set_limits(self, start, stop):
-        '''Return a subsection of the results, to support slicing.'''
+        '''Return a copy of this query limited to a subsection of the
+        results.'''
         if start is None:
             start = 0
-        self.query_opts.update({
-            'start': start,
-            'rows': stop - start
-        })
+        return self._clone(start=start, rows=stop - start)
+
+    def _get_slice(self, start, stop):
+        window = self._find_window(start, stop)
+        if window is None:
+            window = (start, stop - start)
+        docs = self._fetch(*window).docs
+        window_start = window[0] or 0
+        return docs[start - window_start:stop - window_start]
 
     def __getitem__(self, k):
         '''Return a single result or a slice of results'''
@@ -347,27 +777,36 @@ class PagedSolrQuery(object):
             "Negative indexing is not supported."
 
         if isinstance(k, slice):
-            # qs = self._chain() # do we need something like this?
-            if k.start is not None:
-                start = int(k.start)
-            else:
-                start = None
-            if k.stop is not None:
-                stop = int(k.stop)
-            else:
-                stop = None
-            self.set_limits(start, stop)
-            # qs.query.set_limits(start, stop)
-            # return list(qs)[::k.step] if k.step else qs
-            return list(self.get_results())[::k.step] if k.step else self.get_results()
+            start = int(k.start) if k.start is not None else 0
+            # open-ended slice: through the end of the results
+            stop = int(k.stop) if k.stop is not None else max(self.count(), start)
+            results = self._get_slice(start, stop)
+            return results[::k.step] if k.step else results
 
         # single item
-        # qs = self._chain()
-        self.set_limits(k, k + 1)
-        # qs.query.set_limits(k, k + 1)
-        # qs._fetch_all()
-        return self.get_results()[0]
-        # return qs._result_cache[0]
+        return self._get_slice(k, k + 1)[0]
+
+
+class SolrPaginator(Paginator):
+    '''Django paginator for :class:`PagedSolrQuery`; retrieves the
+    requested page of results before the total count, so that each page
+    (along with count, facets, and highlighting) costs a single Solr
+    request.  Sorted queries are paged with Solr cursors, so that
+    moving to the next page stays fast however deep the results go.'''
+
+    def page(self, number):
+        if isinstance(self.object_list, PagedSolrQuery):
+            try:
+                page_number = int(number)
+            except (TypeError, ValueError):
+                page_number = None
+            if page_number and page_number >= 1:
+                bottom = (page_number - 1) * self.per_page
+                # last page may include orphans
+                self.object_list.prefetch(bottom,
+                                          bottom + self.per_page + self.orphans,
+                                          cursor=True)
+        return super().page(number)
 
 
 class Indexable(object):
@@ -383,13 +822,22 @@ class Indexable(object):
             'attr_name': {      # string name of the attribute on this model
                 'save': handle_attr_save,  # signal handler for post_save on this model
                 'delete': handle_attr_delete,   # signal handler for pre_delete on this model
+            },
+            'app_label.ModelName': {    # related model without an attribute
+                'post_save': handle_model_save,
             }
         }
 
     If the attribute is a many-to-many field, indexing will be configured on
     the model when the based on relationship changes (a signal handler will
     listen for :class:`models.signals.m2m_changed` on the through model).
-    Signal handler methods for save and delete are optional.
+    Signal handler methods for save and delete are optional.  Models that
+    are only indirectly related (e.g., via another model) can be specified
+    by app label and model name.
+
+    Since more than one indexable model may depend on the same related
+    model, :attr:`related` is a dictionary of lists of options, keyed on
+    related model.
 
     '''
 
@@ -407,22 +855,180 @@ class Indexable(object):
         '''the value that is used as the Solr id for this object'''
         raise NotImplementedError
 
-    def index(self, params=None):
+    @classmethod
+    def prep_index_chunk(cls, chunk):
+        '''Optional hook to bulk-load related data needed by
+        :meth:`index_data` for a list of items of this class, so that
+        :meth:`index_items` can index a chunk with a fixed number of
+        queries rather than several queries per item.  By default, does
+        nothing.'''
+        return chunk
+
+    #: index fields that can be updated without regenerating the whole
+    #: document, using values from :meth:`index_field_values`
+    partial_index_fields = ()
+
+    @classmethod
+    def index_field_values(cls, pks, fields):
+        '''Current index values of the specified fields for a list of
+        primary keys, as a dictionary of field values keyed on index id.
+        Classes that support partial updates should implement this to
+        generate values for all the items with a fixed number of queries.'''
+        raise NotImplementedError
+
+    @staticmethod
+    def atomic_update_doc(index_id, values, operations=None):
+        '''Solr atomic update document to set the specified field values
+        on an indexed document, with optional additional update operations
+        by field (e.g. `{'author': {'add': ['name']}}`).  Since atomic
+        updates regenerate the document from stored values, copy field
+        destinations are cleared so that Solr repopulates them from the
+        updated source fields, and the last modified time is explicitly
+        updated.'''
+        doc = {'id': index_id, 'last_modified': {'set': 'NOW'}}
+        for field in SolrSchema.copy_field_destinations():
+            doc[field] = {'set': None}
+        for field, value in values.items():
+            doc[field] = {'set': value}
+        doc.update(operations or {})
+        return doc
+
+    @classmethod
+    def index_partial(cls, pks, fields, params=None):
+        '''Update only the specified fields in the index for a list of
+        primary keys, using Solr atomic updates.  Falls back to
+        reindexing the full documents via :meth:`index_items` if any of
+        the fields are not in :attr:`partial_index_fields`.  Returns a
+        count of the number of items updated.'''
+        if not set(fields).issubset(cls.partial_index_fields):
+            return cls.index_items(cls.objects.filter(pk__in=pks), params=params,
+                                   partial=True)
+
+        values = cls.index_field_values(pks, fields)
+        # cached fingerprints of the full documents are now out of date
+        epoch = indexed_docs_epoch()
+        cache.delete_many([cls.indexed_doc_key(index_id, epoch)
+                           for index_id in values])
+        return cls.index_items(
+            [cls.atomic_update_doc(index_id, doc_values)
+             for index_id, doc_values in values.items()],
+            params=params)
+
+    #: timeout for cached fingerprints of the last indexed version of
+    #: each document, used to send only changed fields, in seconds
+    indexed_doc_timeout = 60 * 60 * 24 * 7
+
+    @staticmethod
+    def indexed_doc_key(index_id, epoch=None):
+        '''Cache key for the fingerprint of the last indexed version of a
+        document.  Pass the current `epoch` when generating keys for a
+        batch of documents, to look it up only once.'''
+        return 'solr_doc:%s:%s' % (epoch or indexed_docs_epoch(),
+                                   hashlib.md5(index_id.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def index_fingerprint(doc):
+        '''Short digest of each field value in an index document, as a
+        dictionary keyed on field name; cached in place of the full
+        document, so that changed fields can be identified without
+        storing whole documents.'''
+        return dict(
+            (field, hashlib.md5(json.dumps(value, sort_keys=True, default=str)
+                                .encode('utf-8')).hexdigest()[:12])
+            for field, value in doc.items())
+
+    @staticmethod
+    def index_diff(old, new):
+        '''Solr atomic update operations to change indexed document
+        `old` into `new`, as a dictionary of field name and operation.
+        Changed fields always use `set`, including multivalued fields,
+        so the result doesn't depend on the exact values currently in
+        the index.'''
+        return dict((field, {'set': new.get(field)})
+                    for field in set(old) | set(new)
+                    if old.get(field) != new.get(field))
+
+    @classmethod
+    def changed_docs(cls, docs, partial=True):
+        '''Compare generated index documents with the fingerprint of the
+        last indexed version of each one and return the documents to send
+        to Solr: atomic updates for changed fields, or full documents
+        when there is no previous version or `partial` is False.
+        Unchanged documents are skipped.  Full documents are always sent
+        unless the cache is shared between processes, since another
+        process may have indexed a newer version.  See :meth:`send_docs`
+        for storing fingerprints.'''
+        if not (partial and cache_is_shared()) or not docs:
+            return list(docs)
+        epoch = indexed_docs_epoch()
+        keys = dict((doc['id'], cls.indexed_doc_key(doc['id'], epoch))
+                    for doc in docs)
+        previous = cache.get_many(list(keys.values()))
+        changed = []
+        for doc in docs:
+            fingerprint = previous.get(keys[doc['id']])
+            if fingerprint is None:
+                changed.append(doc)
+                continue
+            diff = cls.index_diff(fingerprint, cls.index_fingerprint(doc))
+            if diff:
+                changed.append(cls.atomic_update_doc(
+                    doc['id'], dict((field, doc.get(field)) for field in diff)))
+        return changed
+
+    @classmethod
+    def send_docs(cls, docs, indexed_docs=None, params=None, partial=True):
+        '''Send documents or atomic updates to Solr.  For partial updates,
+        once Solr accepts the update, fingerprints of `indexed_docs` (the
+        full generated documents) are stored as the basis for the next
+        partial update, if the cache is shared; nothing is stored for
+        bulk updates (see :meth:`index_items`).  If the update fails, any
+        stored fingerprints are discarded so that the next update sends
+        full documents.'''
+        keys = []
+        if partial and indexed_docs and cache_is_shared():
+            epoch = indexed_docs_epoch()
+            keys = [cls.indexed_doc_key(doc['id'], epoch) for doc in indexed_docs]
+        if docs:
+            solr, solr_collection = get_solr_connection()
+            try:
+                solr.index(solr_collection, docs, params=params)
+            except Exception:
+                # solr may or may not have applied some of the changes
+                cache.delete_many(keys)
+                raise
+        if keys:
+            cache.set_many(
+                dict(zip(keys, (cls.index_fingerprint(doc) for doc in indexed_docs))),
+                cls.indexed_doc_timeout)
+
+    def index(self, params=None, partial=True):
         '''Index the current object in Solr.  Allows passing in
-        parameter, e.g. to set a `commitWithin` value.
+        parameter, e.g. to set a `commitWithin` value.  Unless `partial`
+        is False, only fields that changed since the object was last
+        indexed are sent; see :meth:`changed_docs`.
         '''
-        solr, solr_collection = get_solr_connection()
-        solr.index(solr_collection, [self.index_data()], params=params)
+        indexed_docs = [self.index_data()]
+        docs = self.changed_docs(indexed_docs, partial=partial)
+        if not partial:
+            # any stored fingerprint no longer matches the index
+            cache.delete(self.indexed_doc_key(self.index_id()))
+        self.send_docs(docs, indexed_docs, params=params, partial=partial)
+        if docs:
+            index_changed(params)
 
     @classmethod
-    def index_items(cls, items, params=None, progbar=None):
+    def index_items(cls, items, params=None, progbar=None, partial=False):
         '''Indexable class method to index multiple items at once.  Takes a
         list, queryset, or generator of Indexable items or dictionaries.
         Items are indexed in chunks, based on :attr:`Indexable.index_chunk_size`.
         Takes an optional progressbar object to update when indexing items
-        in chunks. Returns a count of the number of items indexed.'''
-        solr, solr_collection = get_solr_connection()
-
+        in chunks. Returns a count of the number of items indexed.
+        If `partial` is True, only fields that changed since each item was
+        last indexed are sent; see :meth:`changed_docs`.  Otherwise, full
+        documents are sent without recording them, and fingerprints
+        stored by earlier partial updates are discarded, so bulk
+        reindexing doesn't write every document to the cache.'''
         # if this is a queryset, use iterator to get it in chunks
         if isinstance(items, QuerySet):
             items = items.iterator()
@@ -436,12 +1042,23 @@ class Indexable(object):
         # of items (adapted from index script)
         chunk = list(itertools.islice(items, cls.index_chunk_size))
         count = 0
+        discarded = partial
         while chunk:
-            # call index data method if present; otherwise assume item is dict
-            solr.index(solr_collection,
-                       [i.index_data() if hasattr(i, 'index_data') else i
-                        for i in chunk],
-                       params=params)
+            # give each indexable class in the chunk a chance to
+            # bulk-load related data before generating index data
+            for item_cls in set(type(i) for i in chunk if isinstance(i, Indexable)):
+                item_cls.prep_index_chunk([i for i in chunk if type(i) is item_cls])
+
+            # call index data method if present; otherwise assume item is
+            # a dict and index it as is
+            docs = [i for i in chunk if not hasattr(i, 'index_data')]
+            indexed_docs = [i.index_data() for i in chunk
+                            if hasattr(i, 'index_data')]
+            if indexed_docs and not discarded:
+                discard_indexed_docs()
+                discarded = True
+            docs.extend(cls.changed_docs(indexed_docs, partial=partial))
+            cls.send_docs(docs, indexed_docs, params=params, partial=partial)
             count += len(chunk)
             # update progress bar if one was passed in
             if progbar:
@@ -450,6 +1067,8 @@ class Indexable(object):
             # get the next chunk
             chunk = list(itertools.islice(items, cls.index_chunk_size))
 
+        if count:
+            index_changed(params)
         return count
 
     def remove_from_index(self, params=None):
@@ -459,6 +1078,33 @@ class Indexable(object):
         # NOTE: using quotes on id to handle ids that include colons or other
         # characters that have meaning in Solr/lucene queries
         solr.delete_doc_by_id(solr_collection, '"%s"' % self.index_id(), params=params)
+        cache.delete(self.indexed_doc_key(self.index_id()))
+        index_changed(params)
+
+    #: number of documents to remove from the index in a single request
+    remove_chunk_size = 500
+
+    @classmethod
+    def remove_index_ids(cls, index_ids, params=None):
+        '''Remove documents from Solr by index id, with one delete query
+        for every :attr:`remove_chunk_size` ids.  Returns the number of
+        ids removed.'''
+        index_ids = list(index_ids)
+        if not index_ids:
+            return 0
+        solr, solr_collection = get_solr_connection()
+        for i in range(0, len(index_ids), cls.remove_chunk_size):
+            # NOTE: quote ids to handle characters with meaning in
+            # solr queries; see remove_from_index
+            query = 'id:(%s)' % ' OR '.join(
+                '"%s"' % index_id
+                for index_id in index_ids[i:i + cls.remove_chunk_size])
+            solr.delete_doc_by_query(solr_collection, query, params=params)
+        epoch = indexed_docs_epoch()
+        cache.delete_many([cls.indexed_doc_key(index_id, epoch)
+                           for index_id in index_ids])
+        index_changed(params)
+        return len(index_ids)
 
     related = None
     m2m = None
@@ -479,14 +1125,18 @@ class Indexable(object):
                 continue
 
             for dep, opts in model.index_depends_on.items():
+                # if a dotted string, assume app label and model name
+                if isinstance(dep, str) and '.' in dep:
+                    related.setdefault(apps.get_model(dep), []).append(opts)
+
                 # if a string, assume attribute of model
-                if isinstance(dep, str):
+                elif isinstance(dep, str):
                     attr = getattr(model, dep)
 
                     # many to many relationship
                     if isinstance(attr, ManyToManyDescriptor):
                         # store related model and options with signal handlers
-                        related[attr.rel.model] = opts
+                        related.setdefault(attr.rel.model, []).append(opts)
                         # add through model to many to many list
                         # NOTE: add and remove m2m signals are only fired
                         # on django auto-created through models, although
@@ -496,6 +1146,184 @@ class Indexable(object):
 
                     # reverse relationship of a many to many
                     elif isinstance(attr, ReverseManyToOneDescriptor):
-                        related[attr.rel.related_model] = opts
+                        related.setdefault(attr.rel.related_model, []).append(opts)
         cls.related = related
         cls.m2m = m2m
+
+
+class IndexQueue(object):
+    '''Deferred, de-duplicating queue of pending Solr index updates.
+
+    Indexing signal handlers add changed objects to the queue instead of
+    updating Solr directly.  Pending `(model, pk)` pairs are collected per
+    thread and flushed in one batch via :meth:`Indexable.index_items` when
+    the current database transaction commits (or immediately, outside of
+    a transaction).  Within :meth:`deferred` (e.g., for the duration of a
+    request, see :class:`~winthrop.common.middleware.IndexQueueMiddleware`)
+    nothing is flushed until the outermost block exits, so that many
+    changes to the same object result in a single update.
+
+    When flushed, objects that still exist in the database are reindexed
+    and objects that no longer exist are removed from the index; this
+    requires that :meth:`Indexable.index_id` depends only on the primary
+    key.
+
+    If the **SOLR_INDEX_QUEUE** setting is ``'background'``, batches are
+    handed off to a background thread so that the current request does
+    not wait on Solr; the default (``'on_commit'``) processes them in the
+    current thread.
+    '''
+
+    #: number of seconds within which queued updates should be committed
+    index_within = 3
+    #: solr params for queued index updates
+    index_params = {'commitWithin': index_within * 1000}
+
+    _local = threading.local()
+    _background_queue = queue.Queue()
+    _background_thread = None
+
+    @classmethod
+    def _state(cls):
+        if not hasattr(cls._local, 'pending'):
+            cls._local.pending = OrderedDict()
+            cls._local.partial = OrderedDict()
+            cls._local.deferred = 0
+        return cls._local
+
+    @classmethod
+    def pending(cls):
+        '''List of `(model, pk)` pairs currently queued in this thread'''
+        return list(cls._state().pending.keys())
+
+    @classmethod
+    def add(cls, instance):
+        '''Queue an indexable object to be reindexed (or removed from
+        the index, if it has been deleted by the time the queue is
+        flushed).'''
+        cls.add_items(type(instance), [instance.pk])
+
+    @classmethod
+    def add_items(cls, model, pks):
+        '''Queue a list of primary keys for the specified indexable model'''
+        state = cls._state()
+        for pk in pks:
+            state.pending[(model, pk)] = True
+        # flush when the current transaction commits; runs immediately
+        # when not in a transaction, and is a no-op if already flushed
+        transaction.on_commit(cls.flush)
+
+    @classmethod
+    def pending_partial(cls):
+        '''Dictionary of field names to be updated, keyed on `(model, pk)`,
+        for partial updates currently queued in this thread'''
+        return dict(cls._state().partial)
+
+    @classmethod
+    def add_partial(cls, model, pks, fields):
+        '''Queue a partial update of the specified index fields for a
+        list of primary keys; see :meth:`Indexable.index_partial`.  Items
+        that are also queued for a full reindex are only reindexed.'''
+        state = cls._state()
+        for pk in pks:
+            state.partial.setdefault((model, pk), set()).update(fields)
+        transaction.on_commit(cls.flush)
+
+    @classmethod
+    def clear(cls):
+        '''Discard any pending items for the current thread'''
+        state = cls._state()
+        state.pending = OrderedDict()
+        state.partial = OrderedDict()
+
+    @classmethod
+    @contextmanager
+    def deferred(cls):
+        '''Context manager to hold queued items until the outermost
+        deferred block exits, then flush them.'''
+        state = cls._state()
+        state.deferred += 1
+        try:
+            yield
+        finally:
+            state.deferred -= 1
+            if not state.deferred:
+                cls.flush()
+
+    @classmethod
+    def flush(cls):
+        '''Index or remove all pending items for the current thread,
+        unless flushing is currently deferred.'''
+        state = cls._state()
+        if state.deferred or not (state.pending or state.partial):
+            return
+        pending = list(state.pending.keys())
+        partial = dict((key, fields) for key, fields in state.partial.items()
+                       if key not in state.pending)
+        state.pending = OrderedDict()
+        state.partial = OrderedDict()
+
+        if getattr(settings, 'SOLR_INDEX_QUEUE', 'on_commit') == 'background':
+            cls._start_background_thread()
+            cls._background_queue.put((pending, partial))
+        else:
+            cls.process(pending, partial)
+
+    @classmethod
+    def process(cls, pending, partial=None):
+        '''Index a list of `(model, pk)` pairs, one batch per model;
+        items that no longer exist in the database are removed from the
+        index.  Optional partial updates, as a dictionary of field names
+        keyed on `(model, pk)`, are applied in one batch for each model
+        and set of fields.'''
+        partial_pks = defaultdict(list)
+        for (model, pk), fields in (partial or {}).items():
+            partial_pks[(model, tuple(sorted(fields)))].append(pk)
+        for (model, fields), pks in partial_pks.items():
+            logger.debug('Updating %s for %d %s (queued)', ', '.join(fields),
+                         len(pks), model._meta.verbose_name_plural)
+            model.index_partial(pks, fields, params=cls.index_params)
+
+        pks_by_model = defaultdict(list)
+        for model, pk in pending:
+            pks_by_model[model].append(pk)
+
+        for model, pks in pks_by_model.items():
+            items = list(model.objects.filter(pk__in=pks))
+            logger.debug('Indexing %d %s (queued)', len(items),
+                         model._meta.verbose_name_plural)
+            if items:
+                Indexable.index_items(items, params=cls.index_params,
+                                      partial=True)
+            # remove items deleted since they were queued, in one
+            # request rather than one for each item
+            found = set(item.pk for item in items)
+            Indexable.remove_index_ids(
+                [model(pk=pk).index_id() for pk in pks if pk not in found],
+                params=cls.index_params)
+
+    @classmethod
+    def _start_background_thread(cls):
+        if cls._background_thread is None or not cls._background_thread.is_alive():
+            cls._background_thread = threading.Thread(
+                target=cls._process_background, name='index-queue', daemon=True)
+            cls._background_thread.start()
+
+    @classmethod
+    def _process_background(cls):
+        while True:
+            pending, partial = cls._background_queue.get()
+            try:
+                cls.process(pending, partial)
+            except Exception:
+                logger.exception('Error processing index queue')
+            finally:
+                # don't hold on to a database connection between batches
+                connection.close()
+                cls._background_queue.task_done()
+
+    @classmethod
+    def join(cls):
+        '''Block until all batches handed off to the background thread
+        have been processed.'''
+        cls._background_queue.join()
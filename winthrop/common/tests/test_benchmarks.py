@@ -0,0 +1,151 @@
+'''
+Performance regression tests: database query and Solr request budgets for
+indexing and the public and admin views, using synthetic data and a stub
+Solr server.  Benchmarks use the cache backend configured in settings
+(rather than the local memory cache used by other tests), so that query
+budgets include cache reads and writes with the database cache.  Set
+**WINTHROP_BENCHMARK_SCALE** to run with more data
+(1.0 is roughly production size); budgets do not depend on the scale.
+Run only benchmarks with ``pytest -m benchmark``, or skip them with
+``pytest -m "not benchmark"``.
+'''
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+import pytest
+
+from winthrop.annotation.models import Annotation
+from winthrop.books.models import Book
+from winthrop.common.benchmark import SolrStubServer, SyntheticData, measure
+from winthrop.common.solr import Indexable, reset_solr_connections
+import winthrop.settings
+
+
+#: per-row query budgets for admin changelists that currently run queries
+#: for each row displayed (e.g. for counts or related names); all other
+#: changelists should take a fixed number of queries
+ADMIN_ROW_BUDGETS = {
+    'annotation.Annotation': 3,
+    'books.Book': 3,
+    'books.Language': 1,
+    'books.Publisher': 1,
+    'books.Subject': 1,
+    'djiffy.Manifest': 2,
+    'footnotes.SourceType': 1,
+}
+
+
+@pytest.mark.benchmark
+class TestPerformanceBudgets(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.solr_stub = SolrStubServer().start()
+        cls.solr_settings = override_settings(
+            SOLR_CONNECTIONS={'default': cls.solr_stub.config},
+            CACHES=winthrop.settings.CACHES)
+        cls.solr_settings.enable()
+        reset_solr_connections()
+        # create the database cache table in the test database, if the
+        # configured cache uses one
+        call_command('createcachetable', verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.solr_settings.disable()
+        reset_solr_connections()
+        cls.solr_stub.stop()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.counts = SyntheticData.at_scale().generate()
+        Indexable.index_items(Book.objects.all())
+        cls.book = Book.objects.filter(digital_edition__isnull=False).first()
+        cls.annotation = Annotation.objects.filter(canvas__isnull=False).first()
+
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser(
+            'benchmark', 'benchmark@example.com', 'secret')
+
+    def test_index_data(self):
+        books = list(Book.objects.all()[:Book.index_chunk_size])
+        Book.prep_index_chunk(books)
+        with measure('Book.index_data', max_queries=0):
+            for book in books:
+                book.index_data()
+
+    def test_index_items(self):
+        chunks = -(-self.counts['books'] // Book.index_chunk_size)
+        # bulk-loading related data takes a fixed number of queries per
+        # chunk; index versions and generations are updated once per run
+        with measure('Indexable.index_items', max_queries=19 + 7 * chunks,
+                     max_solr_requests=chunks, solr_stub=self.solr_stub):
+            Indexable.index_items(Book.objects.all())
+
+    # NOTE: view budgets include cache reads and writes; the first request
+    # populates the response, facet and statistics caches, and later
+    # requests should only read the cache
+
+    def test_book_list(self):
+        with measure('BookListView', max_queries=36, max_solr_requests=1,
+                     solr_stub=self.solr_stub):
+            response = self.client.get(reverse('books:list'),
+                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        assert response.status_code == 200
+        with measure('BookListView (cached)', max_queries=3,
+                     max_solr_requests=0, solr_stub=self.solr_stub):
+            response = self.client.get(reverse('books:list'),
+                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        assert response.status_code == 200
+
+    def test_book_facets(self):
+        with measure('BookFacetJSONView', max_queries=29, max_solr_requests=1,
+                     solr_stub=self.solr_stub):
+            response = self.client.get(reverse('books:facets'))
+        assert response.status_code == 200
+        with measure('BookFacetJSONView (cached)', max_queries=3,
+                     max_solr_requests=0, solr_stub=self.solr_stub):
+            response = self.client.get(reverse('books:facets'))
+        assert response.status_code == 200
+
+    def test_book_detail(self):
+        with measure('BookDetailView', max_queries=26, max_seconds=1):
+            response = self.client.get(self.book.get_absolute_url())
+        assert response.status_code == 200
+        with measure('BookDetailView (cached)', max_queries=2, max_seconds=1):
+            response = self.client.get(self.book.get_absolute_url())
+        assert response.status_code == 200
+
+    def test_book_pages(self):
+        with measure('BookPageView', max_queries=3, max_seconds=1):
+            response = self.client.get(
+                reverse('books:pages', args=[self.book.slug]))
+        assert response.status_code == 200
+
+    def test_annotation_search(self):
+        self.client.force_login(self.admin)
+        # related data for annotation json is loaded in bulk, so the
+        # budget doesn't depend on the number of results
+        limit = 20
+        with measure('annotator_store search', max_queries=8, max_seconds=1):
+            response = self.client.get(
+                reverse('annotation-api:search'),
+                {'uri': self.annotation.uri, 'limit': limit})
+        assert response.status_code == 200
+
+    def test_admin_changelists(self):
+        self.client.force_login(self.admin)
+        for model, model_admin in admin.site._registry.items():
+            opts = model._meta
+            url = reverse('admin:%s_%s_changelist' % (opts.app_label, opts.model_name))
+            # budget based on the maximum number of rows on a page
+            rows = min(model._default_manager.count(), model_admin.list_per_page)
+            max_queries = 10 + ADMIN_ROW_BUDGETS.get(opts.label, 0) * rows
+            with measure('%s admin changelist' % opts.label,
+                         max_queries=max_queries, max_seconds=2):
+                response = self.client.get(url)
+            assert response.status_code == 200
@@ -0,0 +1,18 @@
+from django.test import override_settings
+
+from winthrop.common.checks import cache_is_shared, check_shared_cache
+
+
+def test_cache_is_shared():
+    with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'winthrop_cache'}}):
+        assert cache_is_shared()
+        assert check_shared_cache(None) == []
+
+    with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        assert not cache_is_shared()
+        warnings = check_shared_cache(None)
+        assert len(warnings) == 1
+        assert warnings[0].id == 'winthrop.W001'
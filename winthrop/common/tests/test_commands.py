@@ -1,14 +1,18 @@
+from datetime import datetime, timedelta
 from io import StringIO
 from unittest.mock import patch, Mock
 
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test import TestCase, override_settings
+from django.utils import timezone
 import pytest
 
 from winthrop.books.models import Book
 from winthrop.common.management.commands import index
-from winthrop.common.solr import get_solr_connection, Indexable
+from winthrop.common.models import IndexRun
+from winthrop.common.solr import get_solr_connection, indexed_docs_epoch, \
+    Indexable
 
 
 class TestSolrSchemaCommand(TestCase):
@@ -100,11 +104,213 @@ class TestIndexCommand(TestCase):
         mocksolr.delete_doc_by_query.assert_called_with(
             test_coll, '*:*', params={'commitWithin': 1000})
 
+        # index and clear only one kind of content
+        mock_cmd_index_method.reset_mock()
+        call_command('index', '-i', 'books', '--clear', stdout=stdout)
+        mocksolr.delete_doc_by_query.assert_called_with(
+            test_coll, 'content_type:("books.book")', params={'commitWithin': 1000})
+        assert mock_cmd_index_method.call_count == 1
+        assert list(mock_cmd_index_method.call_args[0][0]) == list(books)
+
+    def test_pk_ranges(self):
+        book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+        ranges = index.Command.pk_ranges(Book, 1)
+        assert ranges == [(pk, pk, 1) for pk in book_ids]
+        # range larger than the number of items
+        assert index.Command.pk_ranges(Book, 100) == \
+            [(book_ids[0], book_ids[-1], len(book_ids))]
+
+    @patch('winthrop.common.management.commands.index.Indexable')
+    def test_index_pk_range(self, mockindexable):
+        book_ids = list(Book.objects.order_by('pk').values_list('pk', flat=True))
+        mockindexable.index_items.return_value = 1
+        params = {'commitWithin': 3000}
+        result = index.index_pk_range(('books.Book', book_ids[0], book_ids[0], 1, params))
+        assert result == ('books.Book', book_ids[0], book_ids[0], 1, None)
+        args, kwargs = mockindexable.index_items.call_args
+        assert list(args[0]) == [Book.objects.get(pk=book_ids[0])]
+        assert kwargs['params'] == params
+
+        # errors are returned instead of raised
+        mockindexable.index_items.side_effect = Exception('connection refused')
+        result = index.index_pk_range(('books.Book', book_ids[0], book_ids[-1], 2, params))
+        assert result == ('books.Book', book_ids[0], book_ids[-1], 0,
+                          'connection refused')
+
+    @patch('winthrop.common.management.commands.index.get_solr_connection')
+    @patch('winthrop.common.management.commands.index.Pool')
+    @patch('winthrop.common.management.commands.index.index_pk_range')
+    def test_call_command_workers(self, mock_index_range, mockpool, mock_get_solr):
+        mocksolr = Mock()
+        mock_get_solr.return_value = (mocksolr, 'test')
+        # run worker tasks in process, in order
+        mockpool.return_value.__enter__.return_value.imap_unordered = map
+        mock_index_range.side_effect = lambda task: \
+            (task[0], task[1], task[2], task[3], None)
+
+        stdout = StringIO()
+        call_command('index', '--workers', '2', '--no-progress', stdout=stdout)
+        mockpool.assert_called_with(2)
+        # all books included in the ranges passed to workers
+        tasks = [call[0][0] for call in mock_index_range.call_args_list]
+        assert sum(task[3] for task in tasks) == Book.objects.count()
+        assert all(task[0] == 'books.Book' for task in tasks)
+        # committed once
+        mocksolr.commit.assert_called_once_with('test')
+
+        # errors are reported and raised as a command error after commit
+        mocksolr.reset_mock()
+        mock_index_range.side_effect = lambda task: \
+            (task[0], task[1], task[2], 0, 'connection refused')
+        stderr = StringIO()
+        with pytest.raises(CommandError):
+            call_command('index', '--workers', '2', '--no-progress',
+                         stdout=stdout, stderr=stderr)
+        assert 'Error indexing books.Book' in stderr.getvalue()
+        assert 'connection refused' in stderr.getvalue()
+        mocksolr.commit.assert_called_once_with('test')
+
+    def test_parse_since(self):
+        since = index.Command.parse_since('2018-07-01')
+        assert since == timezone.make_aware(datetime(2018, 7, 1))
+        since = index.Command.parse_since('2018-07-01T12:30:00Z')
+        assert since == datetime(2018, 7, 1, 12, 30, tzinfo=timezone.utc)
+        with pytest.raises(ValueError):
+            index.Command.parse_since('yesterday')
+
+    def test_items_to_index(self):
+        book = Book.objects.first()
+        assert index.Command.items_to_index(Book).count() == Book.objects.count()
+        # only books updated since the specified time
+        since = timezone.now()
+        assert not index.Command.items_to_index(Book, since).exists()
+        book.save()
+        assert list(index.Command.items_to_index(Book, since)) == [book]
+
+    def test_last_indexed(self):
+        cmd = index.Command()
+        cmd.options = {'index': 'all'}
+        assert cmd.last_indexed() is None
+        started = timezone.now()
+        cmd.record_last_run(started)
+        assert cmd.last_indexed() == started
+        # stored in the database, not the evictable cache
+        assert IndexRun.objects.filter(content='books', started=started).exists()
+
+        # only some content indexed since
+        cmd.options = {'index': 'books'}
+        cmd.record_last_run(started + timedelta(days=1))
+        cmd.options = {'index': 'all'}
+        assert cmd.last_indexed() == started
+
+        # no record for some of the content
+        cmd.options = {'index': 'annotations'}
+        cmd.clear_last_run()
+        assert cmd.last_indexed() is None
+        cmd.options = {'index': 'all'}
+        assert cmd.last_indexed() is None
+
+    @patch('winthrop.common.solr.get_solr_connection')
+    def test_remove_orphans(self, mock_get_solr_connection):
+        cmd = index.Command()
+        cmd.solr = Mock()
+        cmd.solr_collection = 'test'
+        cmd.solr_id_chunk_size = 2
+        mock_get_solr_connection.return_value = (cmd.solr, cmd.solr_collection)
+        book_ids = [book.index_id() for book in Book.objects.all()[:3]]
+        solr_ids = book_ids + ['book:0', 'book:-1', 'book:-2']
+        # return ids in chunks, with a cursor for the next chunk
+        results = []
+        for i in range(0, len(solr_ids), 2):
+            results.append(Mock(
+                docs=[{'id': solr_id} for solr_id in solr_ids[i:i + 2]],
+                data={'nextCursorMark': 'cursor%d' % i}))
+        # cursor is unchanged once all results are returned
+        results.append(Mock(docs=[], data={'nextCursorMark': 'cursor4'}))
+        cmd.solr.query.side_effect = results
+
+        with patch.object(Indexable, 'remove_chunk_size', new=2):
+            assert cmd.remove_orphans() == 3
+        assert cmd.solr.query.call_count == 4
+        # ids are paged with a cursor rather than start offsets
+        for args, kwargs in cmd.solr.query.call_args_list:
+            assert 'start' not in args[1]
+            assert args[1]['fl'] == 'id'
+        assert cmd.solr.query.call_args_list[1][0][1]['cursorMark'] == 'cursor0'
+        # orphans removed in batches
+        cmd.solr.delete_doc_by_id.assert_not_called()
+        assert cmd.solr.delete_doc_by_query.call_count == 2
+        cmd.solr.delete_doc_by_query.assert_any_call(
+            'test', 'id:("book:0" OR "book:-1")', params=cmd.solr_index_opts)
+        cmd.solr.delete_doc_by_query.assert_any_call(
+            'test', 'id:("book:-2")', params=cmd.solr_index_opts)
+
+    @patch('winthrop.common.management.commands.index.get_solr_connection')
+    @patch.object(index.Command, 'remove_orphans')
+    @patch.object(index.Command, 'index')
+    def test_call_command_since(self, mock_cmd_index_method, mock_remove_orphans,
+                                mock_get_solr):
+        mocksolr = Mock()
+        mock_get_solr.return_value = (mocksolr, 'test')
+        mock_remove_orphans.return_value = 0
+        book = Book.objects.first()
+        Book.objects.filter(pk=book.pk).update(updated=timezone.now())
+        book.refresh_from_db()
+
+        stdout = StringIO()
+        call_command('index', '--since', '2100-01-01', '--no-progress', stdout=stdout)
+        args = mock_cmd_index_method.call_args_list[0][0]
+        assert not list(args[0])
+        mock_remove_orphans.assert_called_with()
+
+        # incremental uses start time of last successful run
+        mock_cmd_index_method.reset_mock()
+        with patch.object(index.Command, 'last_indexed') as mock_last_indexed:
+            mock_last_indexed.return_value = book.updated
+            call_command('index', '--incremental', '--no-progress', stdout=stdout)
+            args = mock_cmd_index_method.call_args_list[0][0]
+            assert book in list(args[0])
+            assert len(args[0]) < Book.objects.count()
+
+        # no record of a previous run; warns and indexes everything
+        cmd = index.Command()
+        cmd.options = {'index': 'all'}
+        cmd.clear_last_run()
+        mock_cmd_index_method.reset_mock()
+        stderr = StringIO()
+        call_command('index', '--incremental', '--no-progress', stdout=stdout,
+                     stderr=stderr)
+        assert 'No record of a previous indexing run' in stderr.getvalue()
+        args = mock_cmd_index_method.call_args_list[0][0]
+        assert len(args[0]) == Book.objects.count()
+
+        # orphans not removed on a full index
+        mock_remove_orphans.reset_mock()
+        cmd.clear_last_run()
+        before = timezone.now()
+        call_command('index', '--no-progress', stdout=stdout)
+        mock_remove_orphans.assert_not_called()
+        # successful run recorded for the next incremental run
+        assert before <= cmd.last_indexed() <= timezone.now()
+
+        # failed runs are not recorded
+        cmd.clear_last_run()
+        mock_cmd_index_method.side_effect = CommandError('connection refused')
+        with pytest.raises(CommandError):
+            call_command('index', '--no-progress', stdout=stdout)
+        assert cmd.last_indexed() is None
+
     def test_clear_index(self):
         cmd = index.Command()
         cmd.solr = Mock()
         cmd.solr_collection = 'test_coll'
 
+        epoch = indexed_docs_epoch()
+        cmd.record_last_run(timezone.now())
         cmd.clear_index()
         cmd.solr.delete_doc_by_query.assert_called_with(
             cmd.solr_collection, '*:*', params={'commitWithin': 1000})
+        # cached indexed documents are no longer used
+        assert indexed_docs_epoch() != epoch
+        # next incremental run indexes everything
+        assert cmd.last_indexed() is None
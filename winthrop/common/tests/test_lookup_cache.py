@@ -0,0 +1,63 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from winthrop.common.lookup_cache import LookupCache
+
+
+def test_lookup_cache():
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'lookups.sqlite3')
+        with LookupCache('test', path=path) as cache:
+            assert cache.get('foo') is None
+            assert cache.get('foo', 'default') == 'default'
+            assert 'foo' not in cache
+            cache.set('foo', {'bar': [1, 2]})
+            # None is cached as a value
+            cache.set_many({'baz': None, 'qux': 'quux'})
+            assert cache.get('foo') == {'bar': [1, 2]}
+            assert 'baz' in cache
+            assert cache.get_many(['foo', 'baz', 'missing']) == \
+                {'foo': {'bar': [1, 2]}, 'baz': None}
+            cache.delete('foo')
+            assert 'foo' not in cache
+
+        # values persist and are separated by namespace
+        with LookupCache('test', path=path) as cache:
+            assert cache.get('qux') == 'quux'
+        with LookupCache('other', path=path) as cache:
+            assert 'qux' not in cache
+
+        # values expire after the timeout
+        with LookupCache('test', path=path, timeout=10) as cache:
+            with patch('winthrop.common.lookup_cache.time') as mocktime:
+                mocktime.time.return_value = 1000
+                cache.set('foo', 'bar')
+                cache.set('forever', 'bar', timeout=None)
+                mocktime.time.return_value = 1009
+                assert cache.get('foo') == 'bar'
+                mocktime.time.return_value = 1011
+                assert 'foo' not in cache
+                assert cache.get('forever') == 'bar'
+
+
+def test_lookup_cache_max_entries():
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'lookups.sqlite3')
+        with LookupCache('test', path=path, max_entries=3) as cache:
+            # other namespaces don't count towards the limit
+            LookupCache('other', path=path).set_many({'a': 1, 'b': 2})
+            cache.set_many({'a': 1, 'b': 2, 'c': 3})
+            # replaced values count as recently cached
+            cache.set('a', 4)
+            cache.set('d', 5)
+            assert cache.get_many(['a', 'b', 'c', 'd']) == {'a': 4, 'c': 3, 'd': 5}
+            assert 'b' in LookupCache('other', path=path)
+
+            # expired values are removed first
+            with patch('winthrop.common.lookup_cache.time') as mocktime:
+                mocktime.time.return_value = 1000
+                cache.set('c', 6, timeout=1)
+                mocktime.time.return_value = 1002
+                cache.set('e', 7)
+            assert cache.get_many(['a', 'c', 'd', 'e']) == {'a': 4, 'd': 5, 'e': 7}
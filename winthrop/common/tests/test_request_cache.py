@@ -0,0 +1,44 @@
+from unittest.mock import Mock
+
+from winthrop.common import request_cache
+from winthrop.common.middleware import RequestCacheMiddleware
+
+
+def test_memoize():
+    load = Mock(return_value=1)
+    # loaded every time outside of a scope
+    assert request_cache.memoize('key', load) == 1
+    assert request_cache.memoize('key', load) == 1
+    assert load.call_count == 2
+    # remember and forget do nothing outside of a scope
+    request_cache.remember('key', 2)
+    request_cache.forget('key')
+
+    load.reset_mock()
+    with request_cache.scope():
+        assert request_cache.memoize('key', load) == 1
+        # nested scopes share values
+        with request_cache.scope():
+            assert request_cache.memoize('key', load) == 1
+        assert request_cache.memoize('key', load) == 1
+        assert load.call_count == 1
+        request_cache.remember('key', 2)
+        assert request_cache.memoize('key', load) == 2
+        request_cache.forget('key')
+        assert request_cache.memoize('key', load) == 1
+        assert load.call_count == 2
+    # values discarded at the end of the scope
+    request_cache.memoize('key', load)
+    assert load.call_count == 3
+
+
+def test_request_cache_middleware():
+    load = Mock(return_value=1)
+
+    def get_response(request):
+        request_cache.memoize('key', load)
+        request_cache.memoize('key', load)
+        return 'response'
+
+    assert RequestCacheMiddleware(get_response)(Mock()) == 'response'
+    assert load.call_count == 1
@@ -9,6 +9,7 @@ import pytest
 from winthrop.books.models import Book, Creator, CreatorType, Subject, BookSubject
 from winthrop.people.models import Person
 from winthrop.common.signals import IndexableSignalHandler
+from winthrop.common.solr import Indexable, IndexQueue
 
 
 def setUpModule():
@@ -23,6 +24,12 @@ def tearDownModule():
 @override_settings(SOLR_CONNECTIONS={'default': settings.SOLR_CONNECTIONS['test']})
 class TestIndexableSignalHandler(TestCase):
 
+    def setUp(self):
+        IndexQueue.clear()
+
+    def tearDown(self):
+        IndexQueue.clear()
+
     def test_connect(self):
         # check that signal handlers are connected as expected
         # - model save and delete
@@ -45,73 +52,90 @@ class TestIndexableSignalHandler(TestCase):
         assert ref(Book.handle_person_save) in post_save_handlers
         assert ref(Book.handle_named_save) in post_save_handlers
         assert ref(Book.handle_related_change) in post_save_handlers
+        assert ref(Book.handle_canvas_save) in post_save_handlers
 
         # - post delete
         assert ref(Book.handle_related_change) in post_del_handlers
+        assert ref(Book.handle_canvas_delete) in post_del_handlers
 
     @pytest.mark.django_db
     def test_handle_save(self):
-        with patch.object(Book, 'index') as mockindex:
-            Book.objects.create()
-            mockindex.assert_called_with(params=IndexableSignalHandler.index_params)
+        book = Book.objects.create()
+        assert IndexQueue.pending() == [(Book, book.pk)]
+        # saving again does not queue a second update
+        book.save()
+        assert IndexQueue.pending() == [(Book, book.pk)]
+
+        with patch.object(Indexable, 'index_items') as mock_index_items:
+            IndexQueue.flush()
+            args, kwargs = mock_index_items.call_args
+            assert args[0] == [book]
+            assert kwargs['params'] == IndexableSignalHandler.index_params
 
         # non-indexable object should be ignored
         nonindexable = Mock()
         IndexableSignalHandler.handle_save(Mock(), nonindexable)
-        nonindexable.index.assert_not_called()
+        assert not IndexQueue.pending()
 
     @pytest.mark.django_db
     def test_handle_delete(self):
-        with patch.object(Book, 'index'):
-            with patch.object(Book, 'remove_from_index') as mock_rmindex:
-                digwork = Book.objects.create()
-                digwork.delete()
-                mock_rmindex.assert_called_with(params=IndexableSignalHandler.index_params)
+        digwork = Book.objects.create()
+        pk = digwork.pk
+        digwork.delete()
+        assert (Book, pk) in IndexQueue.pending()
+
+        # book no longer exists, so it is removed from the index on flush
+        with patch.object(Indexable, 'index_items') as mock_index_items:
+            with patch.object(Indexable, 'remove_index_ids') as mock_remove_ids:
+                IndexQueue.flush()
+                mock_index_items.assert_not_called()
+                mock_remove_ids.assert_called_with(
+                    ['book:%s' % pk],
+                    params=IndexableSignalHandler.index_params)
 
         # non-indexable object should be ignored
         nonindexable = Mock()
         IndexableSignalHandler.handle_delete(Mock(), nonindexable)
-        nonindexable.remove_from_index.assert_not_called()
+        assert not IndexQueue.pending()
 
     @pytest.mark.django_db
     def test_handle_relation_change(self):
-        with patch.object(Book, 'index') as mockindex:
-            book = Book.objects.create(short_title='A long and arduous title', pub_year=1842)
-            author1 = Person.objects.create(authorized_name='Anne Onomous')
-            author = CreatorType.objects.get(name='Author')
-
-            # NOTE: explicit through model doesn't actually trigger
-            # m2m signals, so add/remove aren't actually testing the relation
-            # change signal handler here
-
-            # add author
-            mockindex.reset_mock()
-            Creator.objects.create(book=book, person=author1, creator_type=author)
-            mockindex.assert_called_with(params=IndexableSignalHandler.index_params)
-
-            # remove author
-            mockindex.reset_mock()
-            book.creator_set.filter(person=author1).delete()
-            mockindex.assert_called_with(params=IndexableSignalHandler.index_params)
-
-            # clear
-            mockindex.reset_mock()
-            book.contributors.clear()
-            mockindex.assert_called_with(params=IndexableSignalHandler.index_params)
-
-            # if action is not one we care about, should be ignored
-            mockindex.reset_mock()
-            IndexableSignalHandler.handle_relation_change(Mock(), book, 'pre_remove')
-            mockindex.assert_not_called()
-
-            # test with another of the change related sets, to ensure that
-            # different types follow same logic
-            mockindex.reset_mock()
-            subj = Subject.objects.first()
-            BookSubject.objects.create(book=book, subject=subj, is_primary=True)
-            mockindex.assert_called_with(params=IndexableSignalHandler.index_params)
+        book = Book.objects.create(short_title='A long and arduous title', pub_year=1842)
+        author1 = Person.objects.create(authorized_name='Anne Onomous')
+        author = CreatorType.objects.get(name='Author')
+
+        # NOTE: explicit through model doesn't actually trigger
+        # m2m signals, so add/remove aren't actually testing the relation
+        # change signal handler here
+
+        # add author
+        IndexQueue.clear()
+        Creator.objects.create(book=book, person=author1, creator_type=author)
+        assert IndexQueue.pending() == [(Book, book.pk)]
+
+        # remove author
+        IndexQueue.clear()
+        book.creator_set.filter(person=author1).delete()
+        assert IndexQueue.pending() == [(Book, book.pk)]
+
+        # clear
+        IndexQueue.clear()
+        book.contributors.clear()
+        assert IndexQueue.pending() == [(Book, book.pk)]
+
+        # if action is not one we care about, should be ignored
+        IndexQueue.clear()
+        IndexableSignalHandler.handle_relation_change(Mock(), book, 'pre_remove')
+        assert not IndexQueue.pending()
+
+        # test with another of the change related sets, to ensure that
+        # different types follow same logic
+        subj = Subject.objects.first()
+        BookSubject.objects.create(book=book, subject=subj, is_primary=True)
+        assert IndexQueue.pending() == [(Book, book.pk)]
 
         # non-indexable object should be ignored
+        IndexQueue.clear()
         nonindexable = Mock()
         IndexableSignalHandler.handle_relation_change(Mock(), nonindexable, 'post_add')
-        nonindexable.index.assert_not_called()
+        assert not IndexQueue.pending()
@@ -2,16 +2,23 @@ import json
 from unittest.mock import patch, Mock, MagicMock
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import PageNotAnInteger
 from django.db.models.query import QuerySet
 from django.test import TestCase, override_settings
 import pytest
 import requests
 from SolrClient import SolrClient
 
+from winthrop.annotation.models import Annotation
 from winthrop.books.models import Book, Creator
 from winthrop.people.models import Person
 from winthrop.common.solr import get_solr_connection, SolrSchema, CoreAdmin, \
-    PagedSolrQuery, Indexable
+    index_generation, index_changed, index_cleared, index_settled, INDEX_GENERATION_KEY, \
+    INDEX_SETTLED_KEY, \
+    PagedSolrQuery, SolrPaginator, Indexable, IndexQueue, SolrSession, reset_solr_connections, \
+    solr_connection_stats
+from winthrop.common.middleware import IndexQueueMiddleware
 
 
 TEST_SOLR_CONNECTIONS = {
@@ -33,11 +40,66 @@ def test_get_solr_connection():
 
     # TODO: test error handling once we have some
 
+    # connection is shared
+    assert get_solr_connection()[0] is solr
+    assert isinstance(solr.transport.session, SolrSession)
+    assert solr.transport.session.timeout == SolrSession.timeout
+
+    # different configuration gets a different client
+    solr_config = TEST_SOLR_CONNECTIONS['default'].copy()
+    solr_config.update({'POOL_SIZE': 2, 'TIMEOUT': 5, 'RETRIES': 3})
+    with override_settings(SOLR_CONNECTIONS={'default': solr_config}):
+        configured_solr = get_solr_connection()[0]
+        assert configured_solr is not solr
+        session = configured_solr.transport.session
+        assert session.timeout == 5
+        adapter = session.get_adapter(solr_config['URL'])
+        assert adapter._pool_maxsize == 2
+        assert adapter.max_retries.total == 3
+
+    # reset closes and discards shared clients
+    with patch.object(solr.transport.session, 'close') as mock_close:
+        reset_solr_connections()
+        mock_close.assert_called_with()
+    assert get_solr_connection()[0] is not solr
+
+
+def test_solr_session():
+    session = SolrSession(timeout=(1, 10))
+    with patch('requests.Session.request') as mock_request:
+        session.request('GET', 'http://localhost:8983/solr/')
+        mock_request.assert_called_with('GET', 'http://localhost:8983/solr/',
+                                        timeout=(1, 10))
+        # explicit timeout is used as is
+        session.request('GET', 'http://localhost:8983/solr/', timeout=3)
+        mock_request.assert_called_with('GET', 'http://localhost:8983/solr/',
+                                        timeout=3)
+
+
+@override_settings(SOLR_CONNECTIONS=TEST_SOLR_CONNECTIONS)
+def test_solr_connection_stats():
+    reset_solr_connections()
+    assert solr_connection_stats() == {'connections': 0, 'requests': 0, 'reused': 0}
+
+    solr = get_solr_connection()[0]
+    pool = solr.transport.session.get_adapter('http://localhost/') \
+        .poolmanager.connection_from_url('http://localhost:8983/solr/')
+    pool.num_connections = 2
+    pool.num_requests = 5
+    assert solr_connection_stats() == {'connections': 2, 'requests': 5, 'reused': 3}
+    reset_solr_connections()
+
 
 @override_settings(SOLR_CONNECTIONS=TEST_SOLR_CONNECTIONS)
 @patch('winthrop.common.solr.get_solr_connection')
 class TestSolrSchema(TestCase):
 
+    def test_copy_field_destinations(self, mock_get_solr_connection):
+        destinations = SolrSchema.copy_field_destinations()
+        assert destinations[0] == 'text'
+        assert 'author_exact' in destinations
+        assert 'author' not in destinations
+
     def test_solr_schema_fields(self, mock_get_solr_connection):
         mocksolr = Mock()
         mock_get_solr_connection.return_value = (mocksolr, 'testcoll')
@@ -173,12 +235,12 @@ class TestPagedSolrQuery(TestCase):
         mock_get_solr_connection.return_value = (mocksolr, coll)
         psq = PagedSolrQuery()
         # no result
-        assert psq._result is None
+        assert not psq._result_cache
         psq.get_facets()
         # result should be set by calling get_results()
-        assert psq._result
+        assert psq.result == mocksolr.query.return_value
         # mocksolr's get_facets should have been called
-        assert psq._result.get_facets.called
+        assert psq.result.get_facets.called
 
     def test_get_results(self, mock_get_solr_connection):
         mocksolr = Mock()
@@ -196,6 +258,28 @@ class TestPagedSolrQuery(TestCase):
         mocksolr.query.return_value.get_num_found.return_value = 42
         psq = PagedSolrQuery()
         assert psq.count() == 42
+        args = mocksolr.query.call_args[0]
+        assert args[1]['rows'] == 0
+
+        # if limits are set, results and count are retrieved together
+        mocksolr.reset_mock()
+        psq = PagedSolrQuery().set_limits(0, 10)
+        assert psq.count() == 42
+        mocksolr.query.assert_called_once_with(coll, psq.query_opts)
+        assert psq.query_opts['rows'] == 10
+        # result is reused for results, facets, and count
+        psq.get_results()
+        psq.get_facets()
+        assert psq.count() == 42
+        mocksolr.query.assert_called_once_with(coll, psq.query_opts)
+
+        # count after a slice uses the same response
+        mocksolr.reset_mock()
+        mocksolr.query.return_value.docs = []
+        psq = PagedSolrQuery()
+        psq[0:10]
+        assert psq.count() == 42
+        assert mocksolr.query.call_count == 1
 
     def test_get_json(self, mock_get_solr_connection):
         mocksolr = Mock()
@@ -250,42 +334,272 @@ class TestPagedSolrQuery(TestCase):
         with patch.object(PagedSolrQuery, 'raw_response', new={'highlighting': highlights}):
             assert psq.get_highlighting() == highlights
 
+    def test_get_stats(self, mock_get_solr_connection):
+        mock_get_solr_connection.return_value = (Mock(), 'testcoll')
+        psq = PagedSolrQuery()
+        # no stats, no error
+        with patch.object(PagedSolrQuery, 'raw_response', new={}):
+            assert psq.get_stats() == {}
+
+        stats = {'last_modified': {'max': '2018-07-23T00:00:00Z'}}
+        with patch.object(PagedSolrQuery, 'raw_response',
+                          new={'stats': {'stats_fields': stats}}):
+            assert psq.get_stats() == stats
+
+    def test_iterate(self, mock_get_solr_connection):
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        responses = [
+            Mock(docs=[{'id': 1}, {'id': 2}], data={'nextCursorMark': 'a'}),
+            Mock(docs=[{'id': 3}], data={'nextCursorMark': 'b'}),
+            Mock(docs=[], data={'nextCursorMark': 'b'}),
+        ]
+        mocksolr.query.side_effect = responses
+        psq = PagedSolrQuery({'q': '*:*', 'sort': 'pub_year asc', 'start': 50,
+                              'facet': 'true', 'facet.field': ['author'],
+                              'f.pub_year.facet.range.start': 1500,
+                              'hl': True, 'stats': True})
+        assert list(psq.iterate(chunk_size=2)) == [{'id': 1}, {'id': 2}, {'id': 3}]
+        assert mocksolr.query.call_count == 3
+        # cursor passed on from each response; id added to sort
+        cursors = [call[0][1]['cursorMark'] for call in mocksolr.query.call_args_list]
+        assert cursors == ['*', 'a', 'b']
+        opts = mocksolr.query.call_args[0][1]
+        assert opts['sort'] == 'pub_year asc, id asc'
+        assert opts['rows'] == 2
+        # options that don't apply to iterating are not sent
+        for opt in ['start', 'facet', 'facet.field', 'f.pub_year.facet.range.start',
+                    'hl', 'stats']:
+            assert opt not in opts
+        # results are not cached
+        assert not psq._result_cache
+
+        # sort on id is not duplicated; stops when cursor doesn't change
+        mocksolr.query.reset_mock()
+        mocksolr.query.side_effect = [
+            Mock(docs=[{'id': 1}], data={'nextCursorMark': '*'})]
+        psq = PagedSolrQuery({'q': '*:*', 'sort': 'id desc'})
+        assert list(psq.iterate()) == [{'id': 1}]
+        assert mocksolr.query.call_args[0][1]['sort'] == 'id desc'
+
     def test_set_limits(self, mock_get_solr_connection):
         mock_get_solr_connection.return_value = (Mock(), 'coll')
-        psq = PagedSolrQuery()
-        psq.set_limits(0, 10)
-        assert psq.query_opts['start'] == 0
-        assert psq.query_opts['rows'] == 10
-        psq.set_limits(100, 120)
-        assert psq.query_opts['start'] == 100
-        assert psq.query_opts['rows'] == 20
+        psq = PagedSolrQuery({'q': '*:*'})
+        limited = psq.set_limits(0, 10)
+        assert limited.query_opts == {'q': '*:*', 'start': 0, 'rows': 10}
+        # original query is not modified
+        assert psq.query_opts == {'q': '*:*'}
+        limited = psq.set_limits(100, 120)
+        assert limited.query_opts['start'] == 100
+        assert limited.query_opts['rows'] == 20
         # default to 0 if start is None
-        psq.set_limits(None, 10)
-        assert psq.query_opts['start'] == 0
-        assert psq.query_opts['rows'] == 10
+        limited = psq.set_limits(None, 10)
+        assert limited.query_opts['start'] == 0
+        assert limited.query_opts['rows'] == 10
 
     def test_slice(self, mock_get_solr_connection):
         mocksolr = Mock()
         mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        mocksolr.query.return_value.docs = list(range(10))
+        mocksolr.query.return_value.get_num_found.return_value = 42
 
-        psq = PagedSolrQuery()
-        with patch.object(psq, 'set_limits') as mock_set_limits:
-            # slice
-            psq[:10]
-            mock_set_limits.assert_any_call(None, 10)
-            psq[4:10]
-            mock_set_limits.assert_any_call(4, 10)
-            psq[20:]
-            mock_set_limits.assert_any_call(20, None)
-
-            with patch.object(psq, 'get_results') as mock_get_results:
-                mock_get_results.return_value = [3,]
-                assert psq[0] == 3
-                mock_set_limits.assert_any_call(0, 1)
+        psq = PagedSolrQuery({'q': '*:*'})
+        # slice
+        assert psq[:10] == list(range(10))
+        mocksolr.query.assert_called_with('coll', {'q': '*:*', 'start': 0, 'rows': 10})
+        # query options are not modified
+        assert psq.query_opts == {'q': '*:*'}
+        psq[4:10]
+        # served from cached results
+        assert mocksolr.query.call_count == 1
+        psq[20:]
+        mocksolr.query.assert_called_with('coll', {'q': '*:*', 'start': 20, 'rows': 22})
+
+        # single item
+        mocksolr.reset_mock()
+        mocksolr.query.return_value.docs = [3]
+        assert psq[50] == 3
+        mocksolr.query.assert_called_with('coll', {'q': '*:*', 'start': 50, 'rows': 1})
 
         with pytest.raises(TypeError):
             psq['foo']
 
+        # slices within cached results don't query solr again
+        mocksolr.reset_mock()
+        mocksolr.query.return_value.docs = list(range(10, 20))
+        psq = PagedSolrQuery()
+        psq.prefetch(10, 20)
+        assert psq[10:20] == list(range(10, 20))
+        assert psq[12:15] == [12, 13, 14]
+        assert mocksolr.query.call_count == 1
+        # outside the cached results
+        psq[20:30]
+        mocksolr.query.assert_called_with('coll', {'start': 20, 'rows': 10})
+
+    def test_current_response(self, mock_get_solr_connection):
+        # facets and highlighting match the most recent slice
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        responses = []
+        def query(collection, opts):
+            response = Mock(docs=list(range(opts['start'], opts['start'] + opts['rows'])))
+            response.get_json.return_value = json.dumps(
+                {'highlighting': {'start': opts['start']}})
+            responses.append(response)
+            return response
+        mocksolr.query.side_effect = query
+
+        psq = PagedSolrQuery()
+        psq[0:10]
+        assert psq.get_highlighting() == {'start': 0}
+        psq[10:20]
+        assert psq.get_highlighting() == {'start': 10}
+        psq.get_facets()
+        responses[1].get_facets.assert_called_with()
+        # back to the first page, from cache
+        psq[0:10]
+        assert psq.get_highlighting() == {'start': 0}
+        assert len(responses) == 2
+
+
+class TestIndexGeneration(TestCase):
+
+    def setUp(self):
+        cache.delete_many([INDEX_GENERATION_KEY, INDEX_SETTLED_KEY])
+
+    def test_index_generation(self):
+        generation = index_generation()
+        assert generation
+        assert index_generation() == generation
+        index_changed()
+        assert index_generation() == generation + 1
+        assert index_settled()
+
+    def test_index_settled(self):
+        with patch('winthrop.common.solr.time') as mocktime:
+            mocktime.time.return_value = 1000
+            index_changed({'commitWithin': 3000})
+            assert not index_settled()
+            mocktime.time.return_value = 1003
+            assert index_settled()
+
+
+@patch('winthrop.common.solr.get_solr_connection')
+class TestFacetCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_facet_cache_key(self, mock_get_solr_connection):
+        mock_get_solr_connection.return_value = (Mock(), 'coll')
+        opts = {'q': '*:*', 'fq': ['a:1', 'b:2'], 'facet.field': ['author'],
+                'f.pub_year.facet.range.start': 1500, 'sort': 'pub_year asc',
+                'hl': True}
+        key = PagedSolrQuery(opts).facet_cache_key()
+        # sort, highlighting and paging don't affect facets
+        other_opts = dict(opts, sort='author_sort asc', hl=False, start=50)
+        assert PagedSolrQuery(other_opts).facet_cache_key() == key
+        # filter order doesn't matter
+        other_opts = dict(opts, fq=['b:2', 'a:1'])
+        assert PagedSolrQuery(other_opts).facet_cache_key() == key
+        # query, filters and facet options do
+        assert PagedSolrQuery(dict(opts, q='text:foo')).facet_cache_key() != key
+        assert PagedSolrQuery(dict(opts, fq=['a:1'])).facet_cache_key() != key
+        assert PagedSolrQuery(dict(opts, **{'f.pub_year.facet.range.start': 1600})) \
+            .facet_cache_key() != key
+        # index changes invalidate
+        index_changed()
+        assert PagedSolrQuery(opts).facet_cache_key() != key
+
+    def test_cached_facets(self, mock_get_solr_connection):
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        mocksolr.query.return_value.get_num_found.return_value = 3
+        mocksolr.query.return_value.get_facets.return_value = {'author': {'foo': 3}}
+        mocksolr.query.return_value.get_facets_ranges.return_value = {'pub_year': {}}
+        expected = {'total': 3, 'facets': {'author': {'foo': 3}},
+                    'range_facets': {'pub_year': {}}}
+
+        assert PagedSolrQuery({'q': '*:*'}).cached_facets() == expected
+        assert mocksolr.query.call_count == 1
+        # second query for the same facets doesn't touch solr
+        assert PagedSolrQuery({'q': '*:*'}).cached_facets() == expected
+        assert mocksolr.query.call_count == 1
+
+        # not cached while index changes are pending
+        index_changed({'commitWithin': 60000})
+        PagedSolrQuery({'q': '*:*'}).cached_facets()
+        PagedSolrQuery({'q': '*:*'}).cached_facets()
+        assert mocksolr.query.call_count == 3
+
+
+@patch('winthrop.common.solr.get_solr_connection')
+class TestSolrPaginator(TestCase):
+
+    def test_page(self, mock_get_solr_connection):
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        mocksolr.query.return_value.docs = list(range(10, 15))
+        mocksolr.query.return_value.get_num_found.return_value = 15
+
+        # count and page retrieved in a single request
+        paginator = SolrPaginator(PagedSolrQuery({'q': '*:*'}), 10)
+        page = paginator.page(2)
+        assert list(page.object_list) == list(range(10, 15))
+        assert paginator.count == 15
+        mocksolr.query.assert_called_once_with(
+            'coll', {'q': '*:*', 'start': 10, 'rows': 10})
+
+        # orphans are included in the last page
+        mocksolr.reset_mock()
+        mocksolr.query.return_value.docs = list(range(15))
+        paginator = SolrPaginator(PagedSolrQuery({'q': '*:*'}), 10, orphans=5)
+        assert len(paginator.page(1).object_list) == 15
+        mocksolr.query.assert_called_once_with(
+            'coll', {'q': '*:*', 'start': 0, 'rows': 15})
+
+        # non-numeric page is handled by the django paginator
+        with pytest.raises(PageNotAnInteger):
+            paginator.page('foo')
+
+    def test_page_cursor(self, mock_get_solr_connection):
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        mocksolr.query.return_value = Mock(docs=list(range(10)),
+                                           data={'nextCursorMark': 'abc'})
+        mocksolr.query.return_value.get_num_found.return_value = 100
+        opts = {'q': '*:*', 'sort': 'pub_year asc', 'facet': 'true'}
+
+        # first page starts a cursor, with id added to the sort
+        SolrPaginator(PagedSolrQuery(opts), 10).page(1)
+        mocksolr.query.assert_called_once_with('coll', dict(
+            opts, rows=10, sort='pub_year asc, id asc', cursorMark='*'))
+
+        # next page (in a new query) continues from the cached cursor mark
+        mocksolr.reset_mock()
+        mocksolr.query.return_value.data = {'nextCursorMark': 'def'}
+        page = SolrPaginator(PagedSolrQuery(opts), 10).page(2)
+        assert list(page.object_list) == list(range(10))
+        mocksolr.query.assert_called_once_with('coll', dict(
+            opts, rows=10, sort='pub_year asc, id asc', cursorMark='abc'))
+        assert cache.get(PagedSolrQuery(opts).cursor_cache_key(20)) == 'def'
+        # cursor marks don't depend on facet options
+        assert PagedSolrQuery(opts).cursor_cache_key(20) == \
+            PagedSolrQuery({'q': '*:*', 'sort': 'pub_year asc'}).cursor_cache_key(20)
+
+        # pages out of sequence use an offset with the same sort
+        mocksolr.reset_mock()
+        SolrPaginator(PagedSolrQuery(opts), 10).page(5)
+        mocksolr.query.assert_called_once_with('coll', dict(
+            opts, start=40, rows=10, sort='pub_year asc, id asc'))
+        assert cache.get(PagedSolrQuery(opts).cursor_cache_key(50)) is None
+
+        # cursor marks are not used once the index changes
+        index_changed()
+        mocksolr.reset_mock()
+        SolrPaginator(PagedSolrQuery(opts), 10).page(2)
+        assert 'cursorMark' not in mocksolr.query.call_args[0][1]
+
 
 @patch('winthrop.common.solr.get_solr_connection')
 class TestIndexable(TestCase):
@@ -306,21 +620,115 @@ class TestIndexable(TestCase):
         def index_data(self):
             return {'id': self.index_id()}
 
+    @patch('winthrop.common.solr.cache_is_shared', new=Mock(return_value=True))
     def test_index(self, mock_get_solr_connection):
         # index method on a single object instance
         mocksolr = Mock()
         coll = 'coll'
         mock_get_solr_connection.return_value = (mocksolr, coll)
+        generation = index_generation()
 
         sindex = TestIndexable.SimpleIndexable(1)
         sindex.index()
         mocksolr.index.assert_called_with(coll, [sindex.index_data()],
                                           params=None)
-        # with params
+        # unchanged; nothing sent
+        mocksolr.index.reset_mock()
+        sindex.index()
+        mocksolr.index.assert_not_called()
+        # full document, with params
         params = {'foo': 'bar'}
-        sindex.index(params=params)
+        sindex.index(params=params, partial=False)
         mocksolr.index.assert_called_with(coll, [sindex.index_data()],
                                           params=params)
+        # index generation updated
+        assert index_generation() == generation + 2
+        # full documents aren't recorded, so the next update is complete
+        sindex.index()
+        mocksolr.index.assert_called_with(coll, [sindex.index_data()],
+                                          params=None)
+
+        # changed fields only sent as atomic updates
+        with patch.object(TestIndexable.SimpleIndexable, 'index_data') \
+          as mock_index_data:
+            mock_index_data.return_value = {'id': 'idx:1', 'title': 'Title'}
+            sindex.index()
+            mocksolr.index.assert_called_with(
+                coll, [Indexable.atomic_update_doc('idx:1', {'title': 'Title'})],
+                params=None)
+
+            # failed update; last indexed version is discarded
+            mocksolr.index.side_effect = Exception('connection refused')
+            mock_index_data.return_value = {'id': 'idx:1', 'title': 'Other'}
+            with pytest.raises(Exception):
+                sindex.index()
+            assert cache.get(Indexable.indexed_doc_key('idx:1')) is None
+            mocksolr.index.side_effect = None
+            sindex.index()
+            mocksolr.index.assert_called_with(
+                coll, [{'id': 'idx:1', 'title': 'Other'}], params=None)
+
+    def test_index_unshared_cache(self, mock_get_solr_connection):
+        # full documents are always sent with a process-local cache
+        mocksolr = Mock()
+        mock_get_solr_connection.return_value = (mocksolr, 'coll')
+        sindex = TestIndexable.SimpleIndexable(1)
+        sindex.index()
+        sindex.index()
+        assert mocksolr.index.call_count == 2
+        mocksolr.index.assert_called_with('coll', [sindex.index_data()],
+                                          params=None)
+        assert cache.get(Indexable.indexed_doc_key(sindex.index_id())) is None
+
+    def test_index_diff(self, mock_get_solr_connection):
+        old = {'id': 'a', 'title': 'A', 'author': ['x', 'y'], 'subject': ['s'],
+               'notes': 'n'}
+        assert Indexable.index_diff(old, old) == {}
+        assert Indexable.index_diff(old, dict(old, title='B')) == \
+            {'title': {'set': 'B'}}
+        # multivalued fields are set as a whole
+        assert Indexable.index_diff(old, dict(old, author=['x', 'y', 'z'])) == \
+            {'author': {'set': ['x', 'y', 'z']}}
+        assert Indexable.index_diff(old, dict(old, author=['y'])) == \
+            {'author': {'set': ['y']}}
+        assert Indexable.index_diff(old, dict(old, author=['y', 'x'])) == \
+            {'author': {'set': ['y', 'x']}}
+        # removed and added fields
+        new = dict(old, pub_year=1650)
+        del new['notes']
+        assert Indexable.index_diff(old, new) == \
+            {'notes': {'set': None}, 'pub_year': {'set': 1650}}
+
+    @patch('winthrop.common.solr.cache_is_shared')
+    def test_changed_docs(self, mock_cache_is_shared, mock_get_solr_connection):
+        mock_cache_is_shared.return_value = True
+        mock_get_solr_connection.return_value = (Mock(), 'coll')
+        doc = {'id': 'idx:changed', 'title': 'A'}
+        # no previous version
+        assert Indexable.changed_docs([doc]) == [doc]
+        # not stored until sent to solr
+        assert Indexable.changed_docs([doc]) == [doc]
+        Indexable.send_docs([doc], [doc])
+        assert Indexable.changed_docs([doc]) == []
+        new_doc = dict(doc, title='B')
+        assert Indexable.changed_docs([new_doc]) == \
+            [Indexable.atomic_update_doc('idx:changed', {'title': 'B'})]
+        # full documents if partial is false
+        assert Indexable.changed_docs([new_doc], partial=False) == [new_doc]
+        # previous versions not used once the index is cleared
+        index_cleared()
+        assert Indexable.changed_docs([new_doc]) == [new_doc]
+        # fingerprints stored rather than whole documents
+        Indexable.send_docs([new_doc], [new_doc])
+        assert cache.get(Indexable.indexed_doc_key('idx:changed')) == \
+            Indexable.index_fingerprint(new_doc)
+        # nothing stored for bulk updates
+        Indexable.send_docs([doc], [doc], partial=False)
+        assert cache.get(Indexable.indexed_doc_key('idx:changed')) == \
+            Indexable.index_fingerprint(new_doc)
+        # full documents unless the cache is shared
+        mock_cache_is_shared.return_value = False
+        assert Indexable.changed_docs([new_doc]) == [new_doc]
 
     def test_not_implemented(self, mock_get_solr_connection):
         with pytest.raises(NotImplementedError):
@@ -329,6 +737,41 @@ class TestIndexable(TestCase):
         with pytest.raises(NotImplementedError):
             Indexable().index_id()
 
+    def test_atomic_update_doc(self, mock_get_solr_connection):
+        doc = Indexable.atomic_update_doc('idx:1', {'author': ['Anon']})
+        assert doc['id'] == 'idx:1'
+        assert doc['author'] == {'set': ['Anon']}
+        assert doc['last_modified'] == {'set': 'NOW'}
+        # copy field destinations are cleared so solr regenerates them
+        for field in SolrSchema.copy_field_destinations():
+            assert doc[field] == {'set': None}
+
+    @patch.object(Indexable, 'index_items')
+    def test_index_partial(self, mock_index_items, mock_get_solr_connection):
+        with pytest.raises(NotImplementedError):
+            Indexable.index_field_values([1], ['author'])
+
+        TestIndexable.SimpleIndexable.partial_index_fields = ['author']
+        try:
+            with patch.object(TestIndexable.SimpleIndexable, 'index_field_values') \
+              as mock_field_values:
+                mock_field_values.return_value = {'idx:1': {'author': ['Anon']}}
+                TestIndexable.SimpleIndexable.index_partial([1], ['author'],
+                                                            params={'a': 'b'})
+                mock_field_values.assert_called_with([1], ['author'])
+                mock_index_items.assert_called_with(
+                    [Indexable.atomic_update_doc('idx:1', {'author': ['Anon']})],
+                    params={'a': 'b'})
+
+                # fields not supported for partial updates - full reindex
+                TestIndexable.SimpleIndexable.index_partial([1], ['author', 'title'])
+                TestIndexable.SimpleIndexable.objects.filter.assert_called_with(pk__in=[1])
+                mock_index_items.assert_called_with(
+                    TestIndexable.SimpleIndexable.objects.filter.return_value,
+                    params=None, partial=True)
+        finally:
+            del TestIndexable.SimpleIndexable.partial_index_fields
+
     def test_remove_from_index(self, mock_get_solr_connection):
         # remove from index method on a single object instance
         mocksolr = Mock()
@@ -336,7 +779,10 @@ class TestIndexable(TestCase):
         mock_get_solr_connection.return_value = (mocksolr, coll)
 
         sindex = TestIndexable.SimpleIndexable('foo')
+        sindex.index()
         sindex.remove_from_index()
+        # cached copy of indexed document removed
+        assert cache.get(Indexable.indexed_doc_key(sindex.index_id())) is None
         mocksolr.delete_doc_by_id.assert_called_with(
             coll, '"%s"' % sindex.index_id(), params=None)
         # with params
@@ -367,12 +813,31 @@ class TestIndexable(TestCase):
         mocksolr.index.assert_any_call(coll, [i.index_data() for i in items[6:]],
                                        params=None)
 
+        # bulk updates discard stored fingerprints once, rather than
+        # storing documents; partial updates and plain dicts don't
+        with patch('winthrop.common.solr.discard_indexed_docs') as mock_discard:
+            Indexable.index_items(items)
+            assert mock_discard.call_count == 1
+            Indexable.index_items(items, partial=True)
+            Indexable.index_items([{'id': 'idx:1'}])
+            assert mock_discard.call_count == 1
+
         # pass in a progressbar object
         mock_progbar = Mock()
         Indexable.index_items(items, progbar=mock_progbar)
         # progress bar update method should be called once for each chunk
         assert mock_progbar.update.call_count == 2
 
+        # indexable classes can bulk-load data for each chunk
+        with patch.object(TestIndexable.SimpleIndexable, 'prep_index_chunk') \
+          as mock_prep_chunk:
+            Indexable.index_items(items)
+            mock_prep_chunk.assert_any_call(items[:6])
+            mock_prep_chunk.assert_any_call(items[6:])
+            # dictionaries are indexed as is
+            Indexable.index_items([{'id': 'idx:1'}])
+            assert mock_prep_chunk.call_count == 2
+
         # index a queryset
         mockqueryset = MagicMock(spec=QuerySet)
         # Indexable.index_items(DigitizedWork.objects.all())
@@ -387,6 +852,112 @@ class TestIndexable(TestCase):
         # personmodel should be in related object config
         assert Person in Indexable.related
         # save/delete handler config options saved
-        assert Indexable.related[Person] == Book.index_depends_on['contributors']
+        assert Book.index_depends_on['contributors'] in Indexable.related[Person]
+        # related model specified by app label and model name
+        assert Book.index_depends_on['annotation.Annotation'] in \
+            Indexable.related[Annotation]
         # # through model added to m2m list
         assert Creator in Indexable.m2m
+        # options for more than one indexable model on the same related model
+        assert Annotation.index_depends_on['people.Person'] in \
+            Indexable.related[Person]
+        assert Annotation.tags.through in Indexable.m2m
+
+
+class TestIndexQueue(TestCase):
+    fixtures = ['sample_book_data.json']
+
+    def setUp(self):
+        IndexQueue.clear()
+
+    def tearDown(self):
+        IndexQueue.clear()
+
+    def test_add(self):
+        books = list(Book.objects.all()[:2])
+        IndexQueue.add(books[0])
+        IndexQueue.add_items(Book, [books[1].pk, books[0].pk])
+        # de-duplicated, in the order first added
+        assert IndexQueue.pending() == [(Book, books[0].pk), (Book, books[1].pk)]
+
+    @patch.object(Indexable, 'index_items')
+    def test_flush(self, mock_index_items):
+        books = list(Book.objects.all()[:2])
+        for book in books:
+            IndexQueue.add(book)
+        with patch.object(Indexable, 'remove_index_ids') as mock_remove_ids:
+            IndexQueue.add_items(Book, [-1, -2])
+            IndexQueue.flush()
+            # existing books indexed in one batch
+            assert mock_index_items.call_count == 1
+            args, kwargs = mock_index_items.call_args
+            assert set(args[0]) == set(books)
+            assert kwargs['params'] == IndexQueue.index_params
+            # missing books removed from the index in one batch
+            mock_remove_ids.assert_called_once_with(
+                ['book:-1', 'book:-2'], params=IndexQueue.index_params)
+        assert not IndexQueue.pending()
+
+        # nothing to do on an empty queue
+        mock_index_items.reset_mock()
+        IndexQueue.flush()
+        mock_index_items.assert_not_called()
+
+    def test_add_partial(self):
+        books = list(Book.objects.all()[:2])
+        IndexQueue.add_partial(Book, [books[0].pk, books[1].pk], ['subject'])
+        IndexQueue.add_partial(Book, [books[0].pk], ['language'])
+        assert IndexQueue.pending_partial() == {
+            (Book, books[0].pk): {'subject', 'language'},
+            (Book, books[1].pk): {'subject'}
+        }
+        # not included in the list of items for full reindexing
+        assert not IndexQueue.pending()
+
+        with patch.object(Book, 'index_partial') as mock_index_partial:
+            with patch.object(Indexable, 'index_items') as mock_index_items:
+                # books queued for full reindexing are not partially updated
+                IndexQueue.add(books[0])
+                IndexQueue.flush()
+                mock_index_partial.assert_called_once_with(
+                    [books[1].pk], ('subject',), params=IndexQueue.index_params)
+                assert mock_index_items.call_args[0][0] == [books[0]]
+        assert not IndexQueue.pending_partial()
+
+    @patch.object(Indexable, 'index_items')
+    def test_deferred(self, mock_index_items):
+        book = Book.objects.first()
+        with IndexQueue.deferred():
+            with IndexQueue.deferred():
+                IndexQueue.add(book)
+                IndexQueue.flush()
+            # not flushed until outermost block exits
+            IndexQueue.add(book)
+            IndexQueue.flush()
+            mock_index_items.assert_not_called()
+        assert mock_index_items.call_count == 1
+        assert mock_index_items.call_args[0][0] == [book]
+
+    @patch.object(IndexQueue, 'process')
+    def test_background(self, mock_process):
+        book = Book.objects.first()
+        with override_settings(SOLR_INDEX_QUEUE='background'):
+            IndexQueue.add(book)
+            IndexQueue.flush()
+            IndexQueue.join()
+        # processed in the worker thread
+        mock_process.assert_called_once_with([(Book, book.pk)], {})
+
+    @patch.object(Indexable, 'index_items')
+    def test_middleware(self, mock_index_items):
+        book = Book.objects.first()
+
+        def get_response(request):
+            IndexQueue.add(book)
+            IndexQueue.flush()
+            # not indexed until the request completes
+            mock_index_items.assert_not_called()
+            return 'response'
+
+        assert IndexQueueMiddleware(get_response)(Mock()) == 'response'
+        assert mock_index_items.call_count == 1
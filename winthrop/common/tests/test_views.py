@@ -1,7 +1,11 @@
 from datetime import datetime
-from django.test import TestCase
+from unittest.mock import patch
 
-from winthrop.common.views import LastModifiedMixin
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+
+from winthrop.common.views import CachedResponseMixin, LastModifiedMixin
 
 
 class TestLastModifiedMixin(TestCase):
@@ -15,3 +19,66 @@ class TestLastModifiedMixin(TestCase):
         assert solr_dt == datetime(2018, 7, 2, 21, 8, 46)
 
 
+class TestCachedResponseMixin(TestCase):
+
+    class CachedView(CachedResponseMixin):
+        vary_headers = ['X-Requested-With']
+        version = 1
+        render_count = 0
+
+        def cache_version(self):
+            return self.version
+
+        def get(self, request, *args, **kwargs):
+            self.__class__.render_count += 1
+            response = HttpResponse('content %d' % self.render_count)
+            response['Last-Modified'] = 'Mon, 02 Jul 2018 21:08:46 GMT'
+            return response
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.CachedView.render_count = 0
+        self.CachedView.version = 1
+
+    def test_dispatch(self):
+        view = self.CachedView.as_view()
+        response = view(self.factory.get('/books/'))
+        assert response.content == b'content 1'
+        # second request uses cached response
+        response = view(self.factory.get('/books/'))
+        assert response.content == b'content 1'
+        assert self.CachedView.render_count == 1
+
+        # different query string or vary header is cached separately
+        response = view(self.factory.get('/books/?query=psalms'))
+        assert response.content == b'content 2'
+        response = view(self.factory.get(
+            '/books/', HTTP_X_REQUESTED_WITH='XMLHttpRequest'))
+        assert response.content == b'content 3'
+
+        # conditional request answered from cache
+        response = view(self.factory.get(
+            '/books/', HTTP_IF_MODIFIED_SINCE='Mon, 02 Jul 2018 21:08:46 GMT'))
+        assert response.status_code == 304
+        assert self.CachedView.render_count == 3
+
+        # change in version invalidates the cached response
+        self.CachedView.version = 2
+        response = view(self.factory.get('/books/'))
+        assert response.content == b'content 4'
+
+        # no version - not cached
+        self.CachedView.version = None
+        view(self.factory.get('/books/'))
+        view(self.factory.get('/books/'))
+        assert self.CachedView.render_count == 6
+
+    def test_dispatch_not_cached(self):
+        view = self.CachedView.as_view()
+        # error responses are not cached
+        with patch.object(self.CachedView, 'get',
+                          return_value=HttpResponse(status=404)) as mockget:
+            view(self.factory.get('/books/'))
+            view(self.factory.get('/books/'))
+            assert mockget.call_count == 2
@@ -1,6 +1,9 @@
 from datetime import datetime
+import hashlib
 
+from django.core.cache import cache
 from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import parse_http_date_safe
 from django.views.generic.base import View
 
 
@@ -59,3 +62,60 @@ class LastModifiedListMixin(LastModifiedMixin):
         queryset = self.get_queryset()
         if queryset.exists():
             return queryset.order_by('updated').first().updated
+
+
+class CachedResponseMixin(View):
+    '''View mixin to cache rendered responses server-side.  Responses are
+    cached by full URL, the values of any :attr:`vary_headers`, and the
+    version returned by :meth:`cache_version`, so that cached responses
+    are no longer used as soon as the version changes.  Conditional
+    requests are answered from the cached response based on its
+    Last-Modified header.
+
+    Include before :class:`LastModifiedMixin` and :class:`VaryOnHeadersMixin`
+    so that the cached response includes their headers.
+    '''
+
+    #: timeout for cached responses, in seconds
+    cache_timeout = 60 * 60
+    #: prefix for response cache keys
+    cache_key_prefix = 'response'
+
+    def cache_version(self):
+        '''Version of the content displayed by this view, e.g. a
+        modification time; return None to skip caching.'''
+        return None
+
+    def response_cache_key(self, version):
+        request = self.request
+        key_parts = [request.build_absolute_uri()] + \
+            [request.META.get('HTTP_%s' % header.upper().replace('-', '_'), '')
+             for header in getattr(self, 'vary_headers', [])]
+        digest = hashlib.md5('|'.join(key_parts).encode('utf-8')).hexdigest()
+        return '%s:%s:%s' % (self.cache_key_prefix, digest, version)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+
+        # set for use by cache_version
+        self.request, self.args, self.kwargs = request, args, kwargs
+        version = self.cache_version()
+        if version is None:
+            return super().dispatch(request, *args, **kwargs)
+
+        cache_key = self.response_cache_key(version)
+        response = cache.get(cache_key)
+        if response is not None:
+            last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+            return get_conditional_response(
+                request, last_modified=last_modified, response=response)
+
+        response = super().dispatch(request, *args, **kwargs)
+        # only cache complete, successful responses that don't set cookies
+        if response.status_code == 200 and not response.streaming and \
+          not response.cookies:
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+            cache.set(cache_key, response, self.cache_timeout)
+        return response
@@ -1,10 +1,36 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.test import override_settings
 import pytest
 
 from winthrop.common.solr import SolrSchema, CoreAdmin, get_solr_connection
 
 
+@pytest.fixture(scope='session', autouse=True)
+def local_cache():
+    # tests run in a single process; use a local memory cache so that
+    # query counts only include application queries (benchmarks override
+    # this to measure with the configured database cache)
+    with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # clear cached responses, facets, etc. so tests don't affect each other
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def lookup_cache(tmpdir):
+    # use a temporary lookup cache, so tests don't share cached api results
+    with override_settings(LOOKUP_CACHE_PATH=str(tmpdir.join('lookups.sqlite3'))):
+        yield
+
+
 @pytest.fixture
 def empty_solr():
     # pytest solr fixture; updates solr schema
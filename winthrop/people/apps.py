@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class PeopleConfig(AppConfig):
     name = 'winthrop.people'
+
+    def ready(self):
+        # keep the person autocomplete index current
+        from winthrop.people.autocomplete import person_name_index
+        from winthrop.people.models import Person
+        signals.post_save.connect(person_name_index.handle_save, sender=Person,
+                                  dispatch_uid='person_name_index_save')
+        signals.post_delete.connect(person_name_index.handle_delete, sender=Person,
+                                    dispatch_uid='person_name_index_delete')
@@ -0,0 +1,157 @@
+'''
+In-process name index for person autocomplete lookups in the admin,
+so that typeahead searches don't require a substring scan of the
+person table.
+'''
+from collections import defaultdict
+import threading
+import time
+import unicodedata
+
+from django.core.cache import cache
+
+from winthrop.common import request_cache
+
+
+class PersonNameIndex(object):
+    '''Trigram index of normalized :class:`~winthrop.people.models.Person`
+    authorized names, held in memory.  The index is loaded on first use
+    and kept current by save and delete signals; changes are also
+    recorded with a version number in the django cache, so that an index
+    loaded in another process is rebuilt when it is out of date.  The
+    version is read from the cache once per request (see
+    :mod:`~winthrop.common.request_cache`).'''
+
+    #: cache key for the current index version
+    version_cache_key = 'person_name_index_version'
+
+    #: maximum number of matches to return; queries that match more
+    #: people than this should be run against the database instead
+    max_results = 500
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        #: normalized names, keyed on person id
+        self.names = {}
+        #: person ids for each trigram in their normalized names
+        self.trigrams = defaultdict(set)
+        #: version of the data loaded in the index; None if not loaded
+        self.version = None
+
+    @staticmethod
+    def normalize(text):
+        '''Normalize text for matching: ignore case, accents and extra
+        whitespace.'''
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+        return ' '.join(text.casefold().split())
+
+    @staticmethod
+    def ngrams(text):
+        '''Set of trigrams in a normalized string'''
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    @classmethod
+    def current_version(cls):
+        '''Current version of person names, from the django cache'''
+        return request_cache.memoize(cls.version_cache_key, cls._load_version)
+
+    @classmethod
+    def _load_version(cls):
+        version = cache.get(cls.version_cache_key)
+        if version is None:
+            # start from the current time rather than zero, so that a
+            # version lost from the cache doesn't reuse old versions
+            cache.add(cls.version_cache_key, int(time.time() * 1000), None)
+            version = cache.get(cls.version_cache_key)
+        return version
+
+    @classmethod
+    def invalidate(cls):
+        '''Record a change to person names, e.g. after a bulk update
+        that doesn't send signals; indexes are rebuilt on next use.
+        Returns the new version.'''
+        try:
+            version = cache.incr(cls.version_cache_key)
+        except ValueError:
+            request_cache.forget(cls.version_cache_key)
+            return cls.current_version()
+        request_cache.remember(cls.version_cache_key, version)
+        return version
+
+    def build(self):
+        '''Load all person names into the index'''
+        from winthrop.people.models import Person
+        with self.lock:
+            # get the version first, so that changes made while loading
+            # cause another rebuild
+            version = self.current_version()
+            self.names = {}
+            self.trigrams = defaultdict(set)
+            for pk, name in Person.objects.values_list('pk', 'authorized_name'):
+                self._add(pk, name)
+            self.version = version
+
+    def _add(self, pk, name):
+        self._remove(pk)
+        normalized = self.normalize(name)
+        self.names[pk] = normalized
+        for trigram in self.ngrams(normalized):
+            self.trigrams[trigram].add(pk)
+
+    def _remove(self, pk):
+        normalized = self.names.pop(pk, None)
+        if normalized is not None:
+            for trigram in self.ngrams(normalized):
+                self.trigrams[trigram].discard(pk)
+
+    def update(self, pk, name=None):
+        '''Update the index for a saved person, or a deleted person if
+        no name is specified.'''
+        with self.lock:
+            up_to_date = self.version is not None and \
+                self.version == self.current_version()
+            if name is None:
+                self._remove(pk)
+            else:
+                self._add(pk, name)
+            version = self.invalidate()
+            # if another process changed names in the meantime, rebuild
+            # on next use
+            self.version = version if up_to_date and \
+                version == self.version + 1 else None
+
+    def search(self, query):
+        '''Ids of people whose names include the query text, ignoring
+        case, accents and extra whitespace.  Returns None if the index
+        can't narrow the search usefully, i.e. the query is shorter than
+        a trigram or matches more than :attr:`max_results` people;
+        callers should query the database instead.'''
+        query = self.normalize(query)
+        trigrams = self.ngrams(query)
+        if not trigrams:
+            return None
+        with self.lock:
+            if self.version is None or self.version != self.current_version():
+                self.build()
+            # candidates must include every trigram in the query
+            candidates = set.intersection(
+                *(self.trigrams.get(trigram, set()) for trigram in trigrams))
+            matches = [pk for pk in candidates if query in self.names[pk]]
+        if len(matches) > self.max_results:
+            return None
+        return matches
+
+    # signal handlers
+
+    def handle_save(self, sender, instance, created=False, **kwargs):
+        # only names are indexed; other changes don't need a new version
+        if created or instance.authorized_name_changed:
+            self.update(instance.pk, instance.authorized_name)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.update(instance.pk)
+
+
+#: shared person name index for this process
+person_name_index = PersonNameIndex()
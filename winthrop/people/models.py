@@ -73,8 +73,10 @@ class Person(Notable, DateRange):
     def set_birth_death_years(self):
         '''Set local birth and death dates based on information from VIAF'''
         if self.viaf_id:
-            self.birth = self.viaf.birthyear
-            self.death = self.viaf.deathyear
+            # use the same entity for both, so rdf is only loaded once
+            viaf = self.viaf
+            self.birth = viaf.birthyear
+            self.death = viaf.deathyear
 
     @property
     def authorized_name_changed(self):
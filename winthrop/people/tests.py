@@ -12,7 +12,9 @@ from django.utils import safestring
 import rdflib
 
 from winthrop.books.models import Book, PersonBook, PersonBookRelationshipType
+from winthrop.common import request_cache
 from winthrop.places.models import Place
+from .autocomplete import PersonNameIndex, person_name_index
 from .models import Person, Residence, RelationshipType, Relationship
 from .viaf import ViafAPI, ViafEntity
 from .admin import ViafWidget
@@ -292,6 +294,12 @@ class TestViafAutoSuggest(TestCase):
         data = json.loads(result.content.decode('utf-8'))
         assert not data['results']
 
+        # suggestions are cached
+        mockviafapi.return_value.suggest.reset_mock()
+        result = self.client.get(viaf_autosuggest_url, {'q': ' Jersey'})
+        assert not json.loads(result.content.decode('utf-8'))['results']
+        mockviafapi.return_value.suggest.assert_not_called()
+
 
 class TestViafEntity(TestCase):
 
@@ -382,6 +390,94 @@ class TestPersonViews(TestCase):
         assert data['results'][0]['text'] == laski.authorized_name
         assert len(data['results']) == 1
 
+        # short queries are matched in the database
+        result = self.client.get(pub_autocomplete_url, {'q': 'Ab'})
+        data = json.loads(result.content.decode('utf-8'))
+        assert 'Abelin, Johann Philipp' in \
+            [item['text'] for item in data['results']]
+
+
+class TestPersonNameIndex(TestCase):
+    fixtures = ['sample_book_data.json']
+
+    def setUp(self):
+        self.index = PersonNameIndex()
+
+    def test_search(self):
+        abelin = Person.objects.get(authorized_name='Abelin, Johann Philipp')
+        assert self.index.search('abelin') == [abelin.pk]
+        assert self.index.search('  Johann   philipp') == [abelin.pk]
+        assert self.index.search('abelina') == []
+        # queries shorter than a trigram aren't handled by the index
+        assert self.index.search('Ab') is None
+        assert self.index.search(' ') is None
+        # nor are queries with too many matches
+        with patch.object(PersonNameIndex, 'max_results', 0):
+            assert self.index.search('abelin') is None
+
+        # accents are ignored
+        person = Person.objects.create(authorized_name='Mérian, Matthäus')
+        assert self.index.search('merian, matthaus') == [person.pk]
+        assert self.index.search('Mérian') == [person.pk]
+
+    def test_update(self):
+        person = Person.objects.create(authorized_name='Comenius, Jan Amos')
+        self.index.build()
+        self.index.handle_delete(Person, person)
+        # updated by signal handlers, without rebuilding
+        with patch.object(self.index, 'build') as mockbuild:
+            self.index.handle_save(Person, person, created=True)
+            assert self.index.search('comenius') == [person.pk]
+            # saves that don't change the name don't record a new version
+            version = PersonNameIndex.current_version()
+            self.index.handle_save(Person, person)
+            assert PersonNameIndex.current_version() == version
+            person.authorized_name = 'Komenský, Jan Amos'
+            self.index.handle_save(Person, person)
+            assert self.index.search('comenius') == []
+            assert self.index.search('komensky') == [person.pk]
+            self.index.handle_delete(Person, person)
+            assert self.index.search('komensky') == []
+            mockbuild.assert_not_called()
+
+    def test_rebuild(self):
+        self.index.build()
+        # changes recorded by another process or a bulk update
+        Person.objects.bulk_create([Person(authorized_name='Comenius, Jan Amos')])
+        assert self.index.search('comenius') == []
+        PersonNameIndex.invalidate()
+        assert len(self.index.search('comenius')) == 1
+
+        # update with changes from elsewhere causes a rebuild
+        other_index = PersonNameIndex()
+        other_index.build()
+        person = Person.objects.get(authorized_name='Comenius, Jan Amos')
+        other_index.handle_delete(Person, person)
+        person.delete()
+        self.index.update(person.pk)
+        assert self.index.version is None
+
+    def test_current_version_request(self):
+        self.index.build()
+        with patch('winthrop.people.autocomplete.cache') as mockcache:
+            mockcache.get.return_value = self.index.version
+            with request_cache.scope():
+                # several searches in one request
+                self.index.search('abe')
+                self.index.search('abel')
+                # version read once per request
+                assert mockcache.get.call_count == 1
+                # changes made during the request are seen
+                mockcache.incr.return_value = 'next'
+                assert PersonNameIndex.invalidate() == 'next'
+                assert PersonNameIndex.current_version() == 'next'
+
+    def test_signals(self):
+        person = Person.objects.create(authorized_name='Comenius, Jan Amos')
+        assert person_name_index.search('comenius') == [person.pk]
+        person.delete()
+        assert person_name_index.search('comenius') == []
+
 
 class TestViafWidget(TestCase):
 
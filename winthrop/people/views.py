@@ -1,5 +1,9 @@
+import hashlib
+
+from django.core.cache import cache
 from django.http import JsonResponse
 from dal import autocomplete
+from .autocomplete import person_name_index
 from .models import Person
 from winthrop.books.models import PersonBook
 from django.db.models import BooleanField, Case, When, Value
@@ -9,18 +13,27 @@ from .viaf import ViafAPI
 class ViafAutoSuggest(autocomplete.Select2ListView):
     """ View to provide VIAF suggestions for autocomplete info"""
 
-    def get(self, request, *args, **kwargs):
-        """Return JSON with suggested VIAF ids and display names."""
-        viaf = ViafAPI()
-        result = viaf.suggest(self.q)
+    #: timeout for cached suggestions, in seconds
+    cache_timeout = 60 * 10
 
-        return JsonResponse({
-            'results': [dict(
+    def get(self, request, *args, **kwargs):
+        """Return JSON with suggested VIAF ids and display names.
+        Suggestions are cached briefly, since they are requested
+        as the user types."""
+        query = ' '.join(self.q.lower().split())
+        cache_key = 'viaf_suggest:%s' % \
+            hashlib.md5(query.encode('utf-8')).hexdigest()
+        results = cache.get(cache_key)
+        if results is None:
+            viaf = ViafAPI()
+            results = [dict(
                 id=viaf.uri_from_id(item['viafid']),
                 text=(item['displayForm']),
             # exclude any names that are not personal
-            ) for item in result if item['nametype'] == 'personal'],
-        })
+            ) for item in viaf.suggest(self.q) if item['nametype'] == 'personal']
+            cache.set(cache_key, results, self.cache_timeout)
+
+        return JsonResponse({'results': results})
 
 
 class PersonAutocomplete(autocomplete.Select2QuerySetView):
@@ -35,7 +48,15 @@ class PersonAutocomplete(autocomplete.Select2QuerySetView):
         annotator_only = ''
         if len(self.args) > 0:
             annotator_only = self.args[0]
-        people = Person.objects.filter(authorized_name__icontains=self.q)
+        people = Person.objects.all()
+        if self.q:
+            # match names using the in-memory index rather than a table
+            # scan, unless the query is too short or too common for it
+            matches = person_name_index.search(self.q)
+            if matches is None:
+                people = people.filter(authorized_name__icontains=self.q)
+            else:
+                people = people.filter(pk__in=matches)
         if annotator_only == 'annotator':
                 people = people.filter(personbook__isnull=False)
         return people
@@ -1,19 +1,100 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+
 from django.conf import settings
+from django.utils.functional import cached_property
 import requests
 
+from winthrop.common.lookup_cache import LookupCache
+
 
 class GeoNamesAPI(object):
     '''Minimal wrapper around GeoNames API.  Currently supports simple
     searching by name and generating a uri from an id.  Expects
-    **GEONAMES_USERNAME** to be configured in django settings.'''
+    **GEONAMES_USERNAME** to be configured in django settings.
+
+    Search results are cached on disk (see
+    :class:`~winthrop.common.lookup_cache.LookupCache`), and identical
+    searches made at the same time share a single request, to stay
+    within the GeoNames rate limit.  Use as a context manager, or call
+    :meth:`close`, to close the cache when done.
+
+    :param use_cache: use cached search results (default True)
+    '''
 
     api_base = 'http://api.geonames.org'
 
-    def __init__(self):
+    #: lookup cache namespace for search results
+    cache_namespace = 'geonames_search'
+    #: timeout for cached search results, in seconds
+    cache_timeout = 60 * 60 * 24 * 30
+    #: maximum number of cached searches
+    cache_max_entries = 10000
+    #: default number of concurrent requests for :meth:`resolve_many`
+    max_workers = 4
+
+    #: searches currently in progress, shared by all instances
+    _in_flight = {}
+    _in_flight_lock = threading.Lock()
+
+    def __init__(self, use_cache=True):
         self.username = getattr(settings, "GEONAMES_USERNAME", None)
+        self.use_cache = use_cache
+
+    @cached_property
+    def cache(self):
+        return LookupCache(self.cache_namespace, timeout=self.cache_timeout,
+                           max_entries=self.cache_max_entries)
+
+    def close(self):
+        '''Close the lookup cache, if it was opened'''
+        if 'cache' in self.__dict__:
+            self.__dict__.pop('cache').close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def cache_key(query, max_rows=None):
+        '''Cache key for a search: query normalized for case and
+        whitespace, and maximum number of rows'''
+        return '%s|%s' % (' '.join(query.lower().split()), max_rows or '')
 
     def search(self, query, max_rows=None):
         '''Search for places and return the list of results'''
+        if not self.use_cache:
+            return self._search(query, max_rows)
+
+        key = self.cache_key(query, max_rows)
+        results = self.cache.get(key)
+        if results is not None:
+            return results
+
+        # if the same search is already in progress, wait for its results
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            in_progress = future is not None
+            if not in_progress:
+                future = self._in_flight[key] = Future()
+        if in_progress:
+            return future.result()
+
+        try:
+            results = self._search(query, max_rows)
+            self.cache.set(key, results)
+            future.set_result(results)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+        return results
+
+    def _search(self, query, max_rows=None):
         api_url = '%s/%s' % (self.api_base, 'searchJSON')
         params = {'username': self.username, 'q': query}
         if max_rows is not None:
@@ -22,7 +103,26 @@ class GeoNamesAPI(object):
         # return the list of results (present even when empty)
         return response.json()['geonames']
 
+    def resolve_many(self, names, max_rows=1, max_workers=None):
+        '''Search for a list of place names, making at most `max_workers`
+        requests at once; returns a dict of search results keyed on name.
+        Names that could not be searched (e.g. because of a network error
+        or the rate limit) are not included.'''
+        names = list(set(names))
+
+        def safe_search(name):
+            try:
+                return self.search(name, max_rows=max_rows)
+            except Exception:
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_workers) \
+          as executor:
+            results = dict(zip(names, executor.map(safe_search, names)))
+        return dict((name, result) for name, result in results.items()
+                    if result is not None)
+
     @classmethod
     def uri_from_id(cls, geonames_id):
         '''Convert a GeoNames id into a GeoNames URI'''
-        return 'http://sws.geonames.org/%d/' % geonames_id
\ No newline at end of file
+        return 'http://sws.geonames.org/%d/' % geonames_id
@@ -1,9 +1,12 @@
+from concurrent.futures import Future
+import threading
 from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.http import JsonResponse
 from django.test import TestCase, override_settings
 from django.urls import reverse
 import json
+import pytest
 
 from .models import Place
 from .geonames import GeoNamesAPI
@@ -46,6 +49,77 @@ class TestGeonamesApi(TestCase):
             params={'username': 'test_geonames_user', 'q': 'london',
                     'maxRows': 20})
 
+    @patch('winthrop.places.geonames.requests')
+    def test_search_cache(self, mockrequests):
+        mockrequests.get.return_value.json.return_value = \
+            {'geonames': [{'name': 'London'}]}
+        assert GeoNamesAPI().search('London', max_rows=1) == [{'name': 'London'}]
+        # cached across instances, with normalized query
+        assert GeoNamesAPI().search(' london ', max_rows=1) == [{'name': 'London'}]
+        assert mockrequests.get.call_count == 1
+        # different number of rows is a different search
+        GeoNamesAPI().search('london', max_rows=50)
+        assert mockrequests.get.call_count == 2
+        # cache not used
+        GeoNamesAPI(use_cache=False).search('london', max_rows=1)
+        assert mockrequests.get.call_count == 3
+
+        # errors are not cached
+        mockrequests.get.return_value.json.return_value = {'status': 'limit'}
+        with pytest.raises(KeyError):
+            GeoNamesAPI().search('paris')
+        mockrequests.get.return_value.json.return_value = {'geonames': []}
+        assert GeoNamesAPI().search('paris') == []
+
+    @patch('winthrop.places.geonames.LookupCache')
+    def test_close(self, mocklookupcache):
+        # no cache opened; nothing to close
+        GeoNamesAPI().close()
+        mocklookupcache.assert_not_called()
+
+        with GeoNamesAPI() as geo_api:
+            geo_api.cache.get('london')
+        mocklookupcache.return_value.close.assert_called_with()
+        assert 'cache' not in geo_api.__dict__
+
+    @patch('winthrop.places.geonames.requests')
+    def test_search_coalesced(self, mockrequests):
+        # a search already in progress is not repeated; wait for its results
+        key = GeoNamesAPI.cache_key('Emden')
+        future = Future()
+        GeoNamesAPI._in_flight[key] = future
+        try:
+            results = []
+            thread = threading.Thread(
+                target=lambda: results.append(GeoNamesAPI().search('Emden')))
+            thread.start()
+            future.set_result(['result'])
+            thread.join(5)
+        finally:
+            del GeoNamesAPI._in_flight[key]
+        assert results == [['result']]
+        mockrequests.get.assert_not_called()
+
+        # no searches in progress once complete, even on error
+        mockrequests.get.return_value.json.return_value = {}
+        with pytest.raises(KeyError):
+            GeoNamesAPI().search('Emden')
+        assert not GeoNamesAPI._in_flight
+
+    @patch.object(GeoNamesAPI, 'search')
+    def test_resolve_many(self, mocksearch):
+        def search(name, max_rows=None):
+            if name == 'Nowhere':
+                raise KeyError
+            return [{'name': name}]
+        mocksearch.side_effect = search
+        results = GeoNamesAPI().resolve_many(['Emden', 'Douai', 'Emden', 'Nowhere'],
+                                             max_workers=2)
+        # duplicates searched once; failed searches not included
+        assert results == {'Emden': [{'name': 'Emden'}], 'Douai': [{'name': 'Douai'}]}
+        assert mocksearch.call_count == 3
+        mocksearch.assert_any_call('Emden', max_rows=1)
+
     def test_uri_from_id(self):
         assert GeoNamesAPI.uri_from_id(12345) == \
             'http://sws.geonames.org/12345/'
@@ -96,6 +170,7 @@ class TestPlaceViews(TestCase):
         mockgeonamesapi.return_value.search.return_value = mock_response
         # patch in real uri from id logic
         mockgeonamesapi.return_value.uri_from_id = GeoNamesAPI.uri_from_id
+        mockgeonamesapi.cache_key = GeoNamesAPI.cache_key
 
         result = self.client.get(geo_autocomplete_url,
             params={'q': 'new york'})
@@ -111,6 +186,12 @@ class TestPlaceViews(TestCase):
         assert item['lng'] == mock_response[0]['lng']
         assert item['id'] == \
             GeoNamesAPI.uri_from_id(mock_response[0]['geonameId'])
+        # disk cache not used in the admin
+        mockgeonamesapi.assert_called_with(use_cache=False)
+
+        # results are cached in the django cache
+        self.client.get(geo_autocomplete_url, params={'q': ' New york'})
+        assert mockgeonamesapi.return_value.search.call_count == 1
 
     def test_get_label(self):
         geo_lookup = GeonamesLookup()
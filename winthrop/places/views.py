@@ -1,3 +1,6 @@
+import hashlib
+
+from django.core.cache import cache
 from django.http import JsonResponse
 from dal import autocomplete
 
@@ -19,10 +22,20 @@ class GeonamesLookup(autocomplete.Select2ListView):
     '''GeoNames ajax lookup for use as autocomplete.
     Currently restricted to staff only.'''
 
+    #: timeout for cached search results, in seconds
+    cache_timeout = 60 * 60 * 24
+
     def get(self, request, *args, **kwargs):
-        """"Return option list json response."""
-        geo_api = GeoNamesAPI()
-        results = geo_api.search(self.q, max_rows=50)
+        """"Return option list json response.  Search results are kept
+        in the django cache rather than the on-disk lookup cache used by
+        imports, so the web server doesn't need to write to it."""
+        geo_api = GeoNamesAPI(use_cache=False)
+        cache_key = 'geonames_search:%s' % hashlib.md5(
+            GeoNamesAPI.cache_key(self.q, 50).encode('utf-8')).hexdigest()
+        results = cache.get(cache_key)
+        if results is None:
+            results = geo_api.search(self.q, max_rows=50)
+            cache.set(cache_key, results, self.cache_timeout)
         return JsonResponse({
             'results': [dict(
                 id=geo_api.uri_from_id(item['geonameId']),
@@ -122,8 +122,34 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'winthrop.common.middleware.RequestCacheMiddleware',
+    'winthrop.common.middleware.IndexQueueMiddleware',
 ]
 
+# Cache shared by all processes.  Index generations, cached facets and
+# pages, and lookup caches are invalidated through the cache, so it must
+# not be process-local (e.g. local memory) when running more than one
+# process.  Create the table with `python manage.py createcachetable`.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'winthrop_cache',
+        'OPTIONS': {
+            # room for cached pages, facets, lookups and fingerprints of
+            # documents updated since the last bulk reindex (the default
+            # of 300 entries would be culled constantly)
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
+# Solr index queue mode: 'on_commit' to index changed items when the
+# transaction commits, or 'background' to index them in a worker thread
+SOLR_INDEX_QUEUE = 'on_commit'
+
+# on-disk cache for results of VIAF and GeoNames lookups during imports
+LOOKUP_CACHE_PATH = os.path.join(BASE_DIR, 'lookup_cache.sqlite3')
+
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
     'django_cas_ng.backends.CASBackend',
@@ -9,7 +9,7 @@ from django.contrib import admin
 from django.contrib.admin.views.decorators import staff_member_required
 from django.views.generic.base import RedirectView, TemplateView
 from annotator_store import views as annotator_views
-from winthrop.annotation.views import TagAutocomplete
+from winthrop.annotation import views as annotation_views
 
 
 urlpatterns = [
@@ -27,6 +27,11 @@ urlpatterns = [
     url(r'^books/', include('winthrop.books.urls', namespace='books')),
     url(r'^iiif-books/', include('djiffy.urls', namespace='djiffy')),
     # annotations api
+    # local versions of list and search views, to serialize annotations in a batch
+    url(r'^annotations/api/search$', annotation_views.AnnotationSearch.as_view(),
+        name='annotation-api-search'),
+    url(r'^annotations/api/annotations$', annotation_views.AnnotationList.as_view(),
+        name='annotation-api-list'),
     url(r'^annotations/api/', include('annotator_store.urls', namespace='annotation-api')),
     # annotatorjs doesn't handle trailing slash in api prefix url
     url(r'^annotations/api', annotator_views.AnnotationIndex.as_view(), name='annotation-api-prefix'),